@@ -0,0 +1,90 @@
+import gzip
+import json
+from datetime import datetime
+
+from hn2ebook import db
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("archive")
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def open_dump(path):
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return gzip.open(path, "rt", encoding="utf-8")
+    return open(path, "rt", encoding="utf-8")
+
+
+def read_items(f):
+    """
+    Yields the items of a line-delimited JSON dump one at a time, skipping
+    blank lines and the nulls the API returns for missing items.
+    """
+    for number, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            log.error(f"skipping malformed line {number}: {e}")
+            continue
+        if item and "id" in item:
+            yield item
+
+
+def import_dump(conn, path, batch_size, derive_best, best_per_day):
+    """
+    Loads a dump of HN items in the firebase item schema into the item store.
+
+    The dump is streamed, and inserted batch_size items per transaction. The
+    kids of items that came without them are rebuilt from the parent links,
+    the stories of the dump are recorded with their metadata, and with
+    derive_best the best_per_day highest scoring stories of every day become
+    that day's best stories.
+    """
+    n_items = 0
+    start_time, end_time = None, None
+    cur = conn.cursor()
+    with open_dump(path) as f:
+        batch = []
+        for item in read_items(f):
+            batch.append(item)
+            if item.get("type") == "story" and "time" in item:
+                start_time = min(start_time or item["time"], item["time"])
+                end_time = max(end_time or item["time"], item["time"] + 1)
+            if len(batch) >= batch_size:
+                n_items += insert_batch(cur, batch)
+                log.info(f"imported {n_items} items")
+                batch = []
+        if batch:
+            n_items += insert_batch(cur, batch)
+    log.info(f"imported {n_items} items from {path}")
+
+    n_linked = db.link_item_kids(conn)
+    log.info(f"linked the replies of {n_linked} items")
+
+    if start_time is None:
+        log.info("the dump contains no stories")
+        return n_items
+
+    n_stories = db.record_item_stories(conn, start_time, end_time, datetime.utcnow())
+    log.info(f"recorded the metadata of {n_stories} stories")
+    if derive_best:
+        n_best = db.derive_best_stories(conn, start_time, end_time, best_per_day)
+        log.info(f"recorded {n_best} new best stories")
+    return n_items
+
+
+def insert_batch(cur, items):
+    cur.execute("BEGIN")
+    try:
+        n = db.insert_items(cur, items)
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    return n
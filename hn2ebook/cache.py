@@ -0,0 +1,150 @@
+import os
+import json
+import hashlib
+import zipfile
+import importlib.resources
+from pathlib import Path
+
+from hn2ebook.writer import STORED_MIMETYPES, read_raw_entry
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("cache")
+
+# bump this whenever the way chapters are rendered or transformed changes, so
+# that chapters built by an older version are not reused
+CHAPTER_FORMAT_VERSION = 2
+
+# config keys that change the content of a built chapter
+CHAPTER_CONFIG_KEYS = ["use_chrome", "chapter_max_bytes", "chapter_max_comments"]
+
+
+def renderer_fingerprint(cfg):
+    """
+    Returns a digest of everything besides the story itself that affects a
+    rendered chapter: the chapter format version, the page template and the
+    relevant config values.
+    """
+    h = hashlib.sha1()
+    h.update(str(CHAPTER_FORMAT_VERSION).encode("utf-8"))
+    h.update(importlib.resources.read_binary("hn2ebook.resources", "comments.html"))
+    h.update(json.dumps([cfg.get(k) for k in CHAPTER_CONFIG_KEYS]).encode("utf-8"))
+    return h.hexdigest()
+
+
+def chapter_key(cfg, story):
+    """
+    Returns the cache key for the chapter of a story. The number of comments
+    stands in for the version of the comment tree, as HN only exposes the
+    descendants count cheaply.
+    """
+    h = hashlib.sha1()
+    h.update(renderer_fingerprint(cfg).encode("utf-8"))
+    h.update(str(story["num_comments"]).encode("utf-8"))
+    return "%s-%s" % (story["id"], h.hexdigest()[:16])
+
+
+def chapters_dir(cfg):
+    return Path(cfg["data_dir"]).joinpath("cache", "chapters")
+
+
+def chapter_path(cfg, key):
+    return chapters_dir(cfg).joinpath(f"{key}.zip")
+
+
+def has_chapter(cfg, key):
+    return chapter_path(cfg, key).is_file()
+
+
+def write_chapter(path, chapter, text=None):
+    """
+    Writes a built chapter to a zip file at path. Pages and images are stored
+    as the entries of the zip, next to a chapter.json that describes them,
+    and text.json with the plain text of the story if it is given.
+    """
+    index = {
+        "story_id": chapter["story_id"],
+        "title": chapter["title"],
+        "parts": [
+            {"file_name": part["file_name"], "label": part["label"]}
+            for part in chapter["parts"]
+        ],
+        "images": [
+            {
+                "uid": image["uid"],
+                "file_name": image["file_name"],
+                "mimetype": image["mimetype"],
+            }
+            for image in chapter["images"]
+        ],
+    }
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with zipfile.ZipFile(tmp_path, "w", zipfile.ZIP_DEFLATED) as z:
+        z.writestr("chapter.json", json.dumps(index))
+        if text:
+            z.writestr("text.json", json.dumps(text))
+        for part in chapter["parts"]:
+            z.writestr(part["file_name"], part["content"])
+        for image in chapter["images"]:
+            compress_type = (
+                zipfile.ZIP_STORED
+                if image["mimetype"] in STORED_MIMETYPES
+                else zipfile.ZIP_DEFLATED
+            )
+            z.writestr(image["file_name"], image["payload"], compress_type)
+    os.replace(tmp_path, path)
+
+
+def read_chapter(path):
+    """
+    Returns the chapter written to the zip file at path, or None if there is
+    none. Pages and images are returned still compressed, so they can be
+    copied straight into the epub.
+    """
+    try:
+        with zipfile.ZipFile(path) as z, open(path, "rb") as f:
+            index = json.loads(z.read("chapter.json"))
+            for part in index["parts"]:
+                info = z.getinfo(part["file_name"])
+                part["content"] = read_raw_entry(z, f, info)
+            for image in index["images"]:
+                info = z.getinfo(image["file_name"])
+                image["payload"] = read_raw_entry(z, f, info)
+    except FileNotFoundError:
+        return None
+    except (zipfile.BadZipFile, KeyError) as e:
+        log.error(f"ignoring broken chapter {path}: {e}")
+        return None
+    return index
+
+
+def store_chapter(cfg, key, chapter, text=None):
+    path = chapter_path(cfg, key)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_chapter(path, chapter, text)
+    log.debug(f"cached chapter for story id={chapter['story_id']} as {key}")
+
+
+def load_chapter(cfg, key):
+    """
+    Returns the cached chapter for the key, or None if it isn't cached.
+    """
+    index = read_chapter(chapter_path(cfg, key))
+    if index:
+        log.debug(f"using cached chapter for story id={index['story_id']}")
+    return index
+
+
+def load_chapter_text(cfg, key):
+    """
+    Returns the plain text of the story of a cached chapter, as the
+    article_text and comments_text a story is indexed by, or None if the
+    chapter isn't cached or was cached without its text.
+    """
+    try:
+        with zipfile.ZipFile(chapter_path(cfg, key)) as z:
+            return json.loads(z.read("text.json"))
+    except (FileNotFoundError, KeyError):
+        return None
+    except zipfile.BadZipFile as e:
+        log.error(f"ignoring broken chapter {key}: {e}")
+        return None
@@ -39,6 +39,131 @@ config_schema = {
                 "default": 5,
             },
             "use_chrome": {"type": "boolean", "required": False, "default": True},
+            "chapter_max_bytes": {
+                "type": "integer",
+                "required": False,
+                "default": 300000,
+            },
+            "chapter_max_comments": {
+                "type": "integer",
+                "required": False,
+                "default": 300,
+            },
+            "chapter_cache": {"type": "boolean", "required": False, "default": True},
+            "n_build_workers": {"type": "integer", "required": False, "default": 0},
+            "epub_compress_level": {
+                "type": "integer",
+                "required": False,
+                "default": 6,
+                "min": 0,
+                "max": 9,
+            },
+            "n_compress_threads": {"type": "integer", "required": False, "default": 0},
+            "backfill_concurrency": {
+                "type": "integer",
+                "required": False,
+                "default": 4,
+                "min": 1,
+            },
+            "opds_page_size": {
+                "type": "integer",
+                "required": False,
+                "default": 25,
+                "min": 1,
+            },
+            "algolia_url": {
+                "type": "string",
+                "required": False,
+                "default": "https://hn.algolia.com/api/v1",
+            },
+            "server_workers": {
+                "type": "integer",
+                "required": False,
+                "default": 0,
+                "min": 0,
+            },
+            "server_threads": {
+                "type": "integer",
+                "required": False,
+                "default": 8,
+                "min": 1,
+            },
+            "server_graceful_timeout": {
+                "type": "integer",
+                "required": False,
+                "default": 30,
+                "min": 0,
+            },
+            "n_build_jobs": {
+                "type": "integer",
+                "required": False,
+                "default": 2,
+                "min": 1,
+            },
+            "build_max_age_days": {
+                "type": "integer",
+                "required": False,
+                "default": 7,
+                "min": 1,
+            },
+            "work_max_age_days": {
+                "type": "integer",
+                "required": False,
+                "default": 7,
+                "min": 1,
+            },
+        },
+    },
+    "daemon": {
+        "type": "dict",
+        "required": False,
+        "default": {},
+        "schema": {
+            "update": {
+                "type": "string",
+                "required": False,
+                "default": "*/30 * * * *",
+                "check_with": configparse.is_cron_spec,
+            },
+            "daily": {
+                "type": "string",
+                "required": False,
+                "default": "15 0 * * *",
+                "check_with": configparse.is_cron_spec,
+            },
+            "weekly": {
+                "type": "string",
+                "required": False,
+                "default": "30 0 * * 1",
+                "check_with": configparse.is_cron_spec,
+            },
+            "monthly": {
+                "type": "string",
+                "required": False,
+                "default": "45 0 1 * *",
+                "check_with": configparse.is_cron_spec,
+            },
+            "generate_feed": {
+                "type": "string",
+                "required": False,
+                "default": "",
+                "check_with": configparse.is_cron_spec,
+            },
+            "prefetch": {
+                "type": "string",
+                "required": False,
+                "default": "",
+                "check_with": configparse.is_cron_spec,
+            },
+            "issue_limit": {"type": "integer", "required": False, "default": 10},
+            "issue_criteria": {
+                "type": "string",
+                "required": False,
+                "default": "points",
+                "allowed": ["time", "time-reverse", "points", "total-comments"],
+            },
+            "n_workers": {"type": "integer", "required": False, "default": 2, "min": 1},
+            "build_jobs": {"type": "boolean", "required": False, "default": True},
         },
     },
     "pushover": {
@@ -186,10 +311,15 @@ def app(ctx, config, logfile, loglevel, logformat, cache, verbose):
     type=click.Choice(["time", "time-reverse", "points", "total-comments"]),
     default="points",
 )
-def custom_issue(ctx, story_ids, output, criteria):
+@click.option(
+    "--resume",
+    metavar="BUILD_ID",
+    help="The id of an unfinished build to continue. Without it, an unfinished build with the same parameters is continued",
+)
+def custom_issue(ctx, story_ids, output, criteria, resume):
     from hn2ebook import commands
 
-    commands.new_custom_issue(ctx, story_ids, output, criteria)
+    commands.new_custom_issue(ctx, story_ids, output, criteria, resume)
 
 
 def validate_range(ctx, param, custom_range):
@@ -263,16 +393,57 @@ There are two ways to select the range in which the best stories are selected
     default=True,
     help="If true will persist the generated epub in the database",
 )
-def new_issue(ctx, output, period, as_of, custom_range, limit, criteria, persist):
+@click.option(
+    "--compose/--no-compose",
+    default=False,
+    help="If true stories that already appeared in a daily issue are copied from it instead of being fetched again",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    default=False,
+    help="Rebuild the issue even if an identical one was already built",
+)
+@click.option(
+    "--resume",
+    metavar="BUILD_ID",
+    help="The id of an unfinished build to continue. Without it, an unfinished build with the same parameters is continued",
+)
+def new_issue(
+    ctx,
+    output,
+    period,
+    as_of,
+    custom_range,
+    limit,
+    criteria,
+    persist,
+    compose,
+    force,
+    resume,
+):
     from hn2ebook import commands
 
     if output:
         persist = False
 
     if custom_range:
-        commands.new_issue(ctx, custom_range, None, output, limit, criteria, persist)
+        commands.new_issue(
+            ctx,
+            custom_range,
+            None,
+            output,
+            limit,
+            criteria,
+            persist,
+            compose,
+            force,
+            resume,
+        )
     else:
-        commands.new_issue(ctx, period, as_of, output, limit, criteria, persist)
+        commands.new_issue(
+            ctx, period, as_of, output, limit, criteria, persist, compose, force, resume
+        )
 
 
 @app.command(
@@ -286,6 +457,22 @@ def generate_feed(ctx, output):
     commands.generate_opds(ctx)
 
 
+@app.command(help="Search the stories and comments of the generated issues")
+@click.argument("words", nargs=-1, required=True)
+@click.option(
+    "--limit",
+    type=click.IntRange(min=1),
+    default=20,
+    show_default=True,
+    help="The maximum number of stories to show",
+)
+@click.pass_obj
+def search(ctx, words, limit):
+    from hn2ebook import commands
+
+    commands.search(ctx, " ".join(words), limit)
+
+
 @app.command(help="List previously generated issues in database")
 @click.pass_obj
 def list(ctx):
@@ -324,9 +511,9 @@ def update(ctx):
 @click.option(
     "--source",
     required=True,
-    type=click.Choice(["daemonology", "/front"]),
+    type=click.Choice(["daemonology", "/front", "algolia"]),
     default="/front",
-    help="Where to source the historical 'best' data from.",
+    help="Where to source the historical 'best' data from. Days that were already backfilled from the source are skipped.",
 )
 @click.pass_obj
 def backfill(ctx, start_date, end_date, source):
@@ -335,6 +522,37 @@ def backfill(ctx, start_date, end_date, source):
     commands.backfill_best(ctx, start_date, end_date, source)
 
 
+@app.command(
+    name="import",
+    help="Import a dump of HN items, one JSON item per line in the format of the HN API, optionally gzip compressed. Imported items are used instead of fetching them from the API.",
+)
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--batch-size",
+    type=int,
+    default=50000,
+    show_default=True,
+    help="The number of items inserted per transaction",
+)
+@click.option(
+    "--derive-best/--no-derive-best",
+    default=False,
+    help="If true the highest scoring stories of every day in the dump are recorded as that day's best stories",
+)
+@click.option(
+    "--best-per-day",
+    type=int,
+    default=30,
+    show_default=True,
+    help="The number of best stories derived per day",
+)
+@click.pass_obj
+def import_dump(ctx, path, batch_size, derive_best, best_per_day):
+    from hn2ebook import commands
+
+    commands.import_dump(ctx, path, batch_size, derive_best, best_per_day)
+
+
 @app.command(
     help="Apply all database migrations. Use this after an upgrade, or if the app complains."
 )
@@ -345,7 +563,7 @@ def migrate_db(ctx):
     commands.migrate_db(ctx)
 
 
-@app.command(help="Run a static http server to serve the OPML feed and ebook files")
+@app.command(help="Run a http server to serve the OPDS feed and ebook files")
 @click.option(
     "--port",
     type=int,
@@ -360,11 +578,53 @@ def migrate_db(ctx):
     default="127.0.0.1",
     help="The hostname to listen on",
 )
+@click.option(
+    "--development",
+    is_flag=True,
+    default=False,
+    help="Use the single process flask development server",
+)
+@click.option(
+    "--workers",
+    "n_workers",
+    type=click.IntRange(min=0),
+    default=None,
+    help="The number of worker processes, overrides server_workers",
+)
+@click.option(
+    "--threads",
+    "n_threads",
+    type=click.IntRange(min=1),
+    default=None,
+    help="The number of threads per worker, overrides server_threads",
+)
+@click.option(
+    "--build-jobs/--no-build-jobs",
+    default=True,
+    help="Build the issues requested over http, disable when a daemon builds them",
+)
+@click.pass_obj
+def server(ctx, host, port, development, n_workers, n_threads, build_jobs):
+    from hn2ebook import commands
+
+    commands.server(ctx, host, port, development, n_workers, n_threads, build_jobs)
+
+
+@app.command(
+    help="Run the scheduled updates, issue builds and requested builds in one long-running process"
+)
+@click.option(
+    "--workers",
+    "n_workers",
+    type=click.IntRange(min=1),
+    default=None,
+    help="The number of tasks run at the same time, overrides n_workers of the daemon config",
+)
 @click.pass_obj
-def server(ctx, host, port):
+def daemon(ctx, n_workers):
     from hn2ebook import commands
 
-    commands.server(ctx, host, port)
+    commands.daemon(ctx, n_workers)
 
 
 if __name__ == "__main__":
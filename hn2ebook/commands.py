@@ -1,8 +1,11 @@
 import sys
+import json
+import hashlib
 
 from uuid import uuid4
 from pathlib import Path
-from datetime import datetime
+from collections import Counter
+from datetime import datetime, timedelta, timezone
 from dateutil.relativedelta import relativedelta
 
 
@@ -12,6 +15,10 @@ import requests_cache
 from hn2ebook import core
 from hn2ebook import hn
 from hn2ebook import db
+from hn2ebook import cache
+from hn2ebook import opds
+from hn2ebook import store
+from hn2ebook.store import StoryStore
 from hn2ebook.misc.log import logger
 
 log = logger.get_logger("commands")
@@ -21,7 +28,9 @@ def isoformat(d):
     return d.isoformat() + "Z"
 
 
-def persist_epub_meta(conn, at, stories, meta, epub_path_name, period):
+def persist_epub_meta(
+    conn, at, stories, meta, epub_path_name, period, fingerprint=None
+):
     story_ids = [story["id"] for story in stories]
 
     assert len(story_ids) == meta["num_stories"]
@@ -31,6 +40,7 @@ def persist_epub_meta(conn, at, stories, meta, epub_path_name, period):
         "at": at,
         "meta": meta,
         "num_stories": meta["num_stories"],
+        "fingerprint": fingerprint,
     }
 
     epub_path = Path(epub_path_name)
@@ -44,7 +54,7 @@ def persist_epub_meta(conn, at, stories, meta, epub_path_name, period):
         }
     ]
 
-    db.insert_issue(conn, issue, story_ids, formats, period)
+    return db.insert_issue(conn, issue, story_ids, formats, period)
 
 
 def format_range(start_or_date_range, end=None):
@@ -115,7 +125,7 @@ def issue_meta(stories, creation_params, pub_date, uuid):
 
 def check_writable(path):
     try:
-        f = open(path, "w")
+        f = open(path, "a")
         f.close()
     except:
         raise click.BadParameter(f"cannot write to output path {path}")
@@ -131,24 +141,181 @@ def get_output_path(cfg, user_output, suffix):
     return output
 
 
+def daily_epubs_for(cfg, conn, story_ids):
+    """
+    Returns the epubs of the daily issues the stories already appeared in,
+    skipping those whose file is gone from the data dir.
+    """
+    issues_path = Path(cfg["data_dir"]).joinpath("issues")
+    daily_epubs = {}
+    for story_id, file_name in db.daily_issue_files(conn, story_ids).items():
+        path = issues_path.joinpath(file_name)
+        if path.is_file():
+            daily_epubs[story_id] = path
+    log.info(
+        "%d of %d stories are in daily issues" % (len(daily_epubs), len(story_ids))
+    )
+    return daily_epubs
+
+
+def story_summary(row):
+    return {
+        "title": row["title"],
+        "id": str(row["story_id"]),
+        "points": row["score"],
+        "num_comments": row["descendants"],
+        "time": row["time"],
+        "datetime": datetime.fromtimestamp(row["time"], tz=timezone.utc),
+        "author": row["author"],
+        "source": row["url"],
+    }
+
+
 def stories_for_range(cfg, conn, date_range, limit, criteria):
-    story_ids = [
-        story_id
-        for story_id, _ in db.best_stories_for(
-            conn, date_range[0].date(), date_range[1].date()
+    """
+    Picks the top stories per day from the recorded story metadata. Only the
+    stories recorded before there was any metadata are fetched.
+    """
+    start, end = date_range[0].date(), date_range[1].date()
+    story_ids = [story_id for story_id, _ in db.best_stories_for(conn, start, end)]
+    missing = db.story_ids_without_metadata(conn, story_ids)
+    if missing:
+        log.info("fetching metadata of %d stories" % len(missing))
+        hn.record_story_metadata(conn, missing, cfg["n_concurrent_requests"])
+
+    rows = db.top_stories_for(conn, start, end, limit, criteria)
+    log.info("winnowed %d stories down to %d total" % (len(story_ids), len(rows)))
+    return [story_summary(row) for row in rows]
+
+
+def collect_stories(cfg, conn, chosen_stories, store, compose=False, progress=None):
+    story_ids = [int(story["id"]) for story in chosen_stories]
+    daily_epubs = daily_epubs_for(cfg, conn, story_ids) if compose else None
+    return core.resolve_chosen_stories(
+        cfg, chosen_stories, store, daily_epubs, progress
+    )
+
+
+def issue_fingerprint(cfg, period, date_range, limit, criteria, stories):
+    """
+    Returns a digest of everything that goes into an issue: the period and
+    range, the selection parameters, the chosen stories with the size of
+    their comment trees, and the chapter renderer.
+    """
+    inputs = {
+        "period": period,
+        "range": format_range(date_range),
+        "limit": limit,
+        "criteria": criteria,
+        "stories": [[story["id"], story["num_comments"]] for story in stories],
+        "renderer": cache.renderer_fingerprint(cfg),
+    }
+    payload = json.dumps(inputs, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()
+
+
+def existing_issue_path(cfg, conn, fingerprint):
+    """
+    Returns the path of the epub of a persisted issue built from the same
+    inputs, or None if there is none or its file went missing.
+    """
+    issue = db.issue_by_fingerprint(conn, fingerprint)
+    if not issue:
+        return None
+    for f in issue["formats"]:
+        path = Path(cfg["data_dir"]).joinpath("issues", f["file_name"])
+        if path.is_file() and path.stat().st_size == f["file_size"]:
+            return path
+    return None
+
+
+def checkpoint_key(cfg, kind, params):
+    """
+    Returns the key the checkpoints of a build are resumed by: a digest of
+    its kind, its parameters and the chapter renderer. Builds with the same
+    key make the same issue, so one can resume where another stopped.
+    """
+    payload = json.dumps(
+        [kind, params, cache.renderer_fingerprint(cfg)], sort_keys=True, default=str
+    ).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:32]
+
+
+def build_progress(stories):
+    chosen = stories.chosen() or []
+    states = Counter(stories.state(summary["id"]) for summary in chosen)
+    done = ", ".join(
+        f"{states[state]} at {state}" for state in store.STORY_STATES if states[state]
+    )
+    return f"{len(chosen)} stories chosen" + (f" ({done})" if done else "")
+
+
+def open_build(cfg, kind, params, resume=None, build_id=None):
+    """
+    Returns the story store of a build, locked for this process.
+
+    With resume, the build of that id is continued. Otherwise a build with
+    the same key that was left unfinished is continued, or a new one is
+    started, under build_id if given. Unfinished builds older than
+    work_max_age_days are removed first.
+    """
+    key = checkpoint_key(cfg, kind, params)
+    if resume:
+        record = store.read_json(store.work_dir(cfg, resume).joinpath("build.json"))
+        if not record:
+            raise click.BadParameter(
+                f"there is no unfinished build {resume}", param_hint="--resume"
+            )
+        if record["key"] != key:
+            raise click.BadParameter(
+                f"build {resume} was started with other parameters: {record['params']}",
+                param_hint="--resume",
+            )
+        stories = StoryStore.for_build(cfg, resume)
+        if not stories.lock():
+            raise click.BadParameter(
+                f"build {resume} is still running", param_hint="--resume"
+            )
+    else:
+        store.expire_builds(cfg, timedelta(days=cfg["work_max_age_days"]))
+        stories = next(
+            (
+                s
+                for record, s in store.unfinished_builds(cfg)
+                if record["key"] == key and s.lock()
+            ),
+            None,
         )
-    ]
-    return core.resolve_stories(cfg, story_ids, limit, criteria)
 
+    if stories is not None:
+        log.info(f"resuming build {stories.build_id}: {build_progress(stories)}")
+        return stories
 
-def collect_stories(cfg, date_range, limit, criteria):
-    log.info("collecting stories for range %s - %s" % format_range(date_range))
-    conn = db.connect(cfg["db_path"])
-    stories = stories_for_range(cfg, conn, date_range, limit, criteria)
-    conn.close()
+    stories = StoryStore.for_build(cfg, build_id or str(uuid4()))
+    stories.lock()
+    stories.write_record(
+        {
+            "id": stories.build_id,
+            "kind": kind,
+            "key": key,
+            "params": params,
+            "created_at": isoformat(datetime.utcnow()),
+        }
+    )
+    log.info(
+        f"starting build {stories.build_id}, it is checkpointed in {stories.path} until the issue is built"
+    )
     return stories
 
 
+def report_failed_build(stories):
+    stories.unlock()
+    log.error(
+        f"build {stories.build_id} stopped with {build_progress(stories)}. "
+        f"Run the same command again, or with --resume {stories.build_id}, to continue it"
+    )
+
+
 period_to_delta = {
     "weekly": "weeks",
     "daily": "days",
@@ -163,9 +330,21 @@ def range_for_period(as_of, period):
     return [start, end]
 
 
-def new_issue(ctx, period_or_range, as_of, user_output, limit, criteria, persist):
+def new_issue(
+    ctx,
+    period_or_range,
+    as_of,
+    user_output,
+    limit,
+    criteria,
+    persist,
+    compose=False,
+    force=False,
+    resume=None,
+):
     cfg = ctx.cfg["hn2ebook"]
     now = datetime.utcnow()
+    core.use_local_items(cfg["db_path"])
 
     log.info(
         "⚠️ Please be warned! This can take awhile, as walking the HN comments tree with the API is time intensive."
@@ -204,26 +383,71 @@ def new_issue(ctx, period_or_range, as_of, user_output, limit, criteria, persist
         }
         period = "custom"
 
-    stories = collect_stories(cfg, date_range, limit, criteria)
-    if len(stories) == 0:
+    if compose and period == "daily":
+        compose = False
+
+    log.info("collecting stories for range %s - %s" % format_range(date_range))
+    conn = db.connect(cfg["db_path"])
+    build_params = {
+        "period": period,
+        "range": format_range(date_range),
+        "limit": limit,
+        "criteria": criteria,
+        "compose": compose,
+    }
+    stories = open_build(cfg, "issue", build_params, resume)
+    # a resumed build keeps the stories it chose when it started
+    chosen_stories = stories.chosen()
+    if chosen_stories is None:
+        chosen_stories = stories_for_range(cfg, conn, date_range, limit, criteria)
+    if len(chosen_stories) == 0:
         log.info(
             "No stories were found in the given range. You should run the backfill command."
         )
+        stories.remove()
         sys.exit(2)
 
-    log.info("collected %d stories for the issue" % len(stories))
-    meta = issue_meta(stories, creation_params, isoformat(now), str(uuid4()))
-
-    epub_path = core.epub_from_stories(cfg, stories, meta, output)
-
-    if persist:
-        with db.connect(cfg["db_path"]) as conn:
-            persist_epub_meta(conn, now, stories, meta, epub_path, period)
-
+    fingerprint = issue_fingerprint(
+        cfg, period, date_range, limit, criteria, chosen_stories
+    )
+    if persist and not force:
+        existing_path = existing_issue_path(cfg, conn, fingerprint)
+        if existing_path:
+            log.info(
+                f"nothing changed since {existing_path} was built, use --force to rebuild it"
+            )
+            stories.remove()
+            return existing_path
 
-def new_custom_issue(ctx, story_ids, user_output, criteria):
+    try:
+        collect_stories(cfg, conn, chosen_stories, stories, compose)
+
+        log.info("collected %d stories for the issue" % len(stories))
+        summaries = stories.summaries()
+        meta = issue_meta(summaries, creation_params, isoformat(now), stories.build_id)
+
+        epub_path = core.epub_from_stories(cfg, stories, meta, output)
+
+        if persist:
+            meta["images"] = core.write_cover_images(epub_path, meta)
+            replaced = persist_epub_meta(
+                conn, now, summaries, meta, epub_path, period, fingerprint
+            )
+            # the issue it replaced may sit in any page of the feed
+            opds.update_feed(cfg, conn, period, full=replaced > 0)
+            n_indexed = db.index_stories(conn, stories)
+            log.info(f"indexed {n_indexed} stories for search")
+    except (Exception, KeyboardInterrupt):
+        report_failed_build(stories)
+        raise
+    stories.remove()
+    return epub_path
+
+
+def new_custom_issue(ctx, story_ids, user_output, criteria, resume=None):
     cfg = ctx.cfg["hn2ebook"]
     now = datetime.utcnow()
+    core.use_local_items(cfg["db_path"])
     check_writable(user_output)
 
     creation_params = {
@@ -231,58 +455,36 @@ def new_custom_issue(ctx, story_ids, user_output, criteria):
         "criteria": criteria,
     }
 
-    stories = core.resolve_stories(cfg, story_ids, 9999, criteria)
-    meta = issue_meta(stories, creation_params, isoformat(now), str(uuid4()))
-    epub_path = core.epub_from_stories(cfg, stories, meta, user_output)
+    stories = open_build(cfg, "custom-issue", creation_params, resume)
+    try:
+        core.resolve_stories(cfg, story_ids, 9999, criteria, stories)
+        meta = issue_meta(
+            stories.summaries(), creation_params, isoformat(now), stories.build_id
+        )
+        epub_path = core.epub_from_stories(cfg, stories, meta, user_output)
+    except (Exception, KeyboardInterrupt):
+        report_failed_build(stories)
+        raise
+    stories.remove()
 
 
 def generate_opds(ctx):
     cfg = ctx.cfg["hn2ebook"]
     conn = db.connect(cfg["db_path"])
+    opds.generate_all(cfg, conn)
+    log.info("OPDS feed available at %s/index.xml" % cfg["root_url"])
 
-    instance = {
-        "root_url": cfg["root_url"],
-        "name": cfg["instance_name"],
-        "url": "/index.xml",
-    }
-    feeds = [
-        {
-            "period": "daily",
-            "name": "Hacker News Daily",
-            "url": f"/daily.xml",
-            "up_url": f"/index.xml",
-            "start_url": f"/index.xml",
-            "content": "Daily periodicals of the best stories on Hacker News",
-        },
-        {
-            "period": "weekly",
-            "name": "Hacker News Weekly",
-            "url": f"/weekly.xml",
-            "up_url": f"/index.xml",
-            "start_url": f"/index.xml",
-            "content": "Weekly periodicals of the best stories on Hacker News",
-        },
-        {
-            "period": "monthly",
-            "name": "Hacker News Monthly",
-            "url": f"/monthly.xml",
-            "up_url": f"/index.xml",
-            "start_url": f"/index.xml",
-            "content": "Monthly periodicals of the best stories on Hacker News",
-        },
-    ]
 
-    for feed in feeds:
-        core.generate_opds(
-            ctx.cfg["hn2ebook"],
-            instance,
-            feed,
-            db.issues_by_period(conn, feed["period"]),
-        )
-
-    core.generate_opds_index(ctx.cfg["hn2ebook"], instance, feeds)
-
-    log.info("OPDS feed available at %s/index.xml" % ctx.cfg["hn2ebook"]["root_url"])
+def search(ctx, text, limit):
+    conn = db.connect(ctx.cfg["hn2ebook"]["db_path"])
+    stories = db.search_stories(conn, text, limit)
+    if not stories:
+        log.info(f"no stories match {text}")
+    for story in stories:
+        click.echo(f"{story['title']} (id={story['story_id']})")
+        click.echo(f"    {' '.join(story['snippet'].split())}")
+        if story["files"]:
+            click.echo(f"    in {', '.join(story['files'])}")
 
 
 def list_generated_issues(ctx):
@@ -290,27 +492,44 @@ def list_generated_issues(ctx):
     import pprint
 
     conn = db.connect(ctx.cfg["hn2ebook"]["db_path"])
-    issues = db.all_issues(conn)
     pp = pprint.PrettyPrinter(indent=2)
-    log.info(pp.pformat(issues))
+    for issue in db.iter_issues(conn):
+        log.info(pp.pformat(issue))
 
 
 def update_best(ctx):
-    conn = db.connect(ctx.cfg["hn2ebook"]["db_path"])
+    cfg = ctx.cfg["hn2ebook"]
+    conn = db.connect(cfg["db_path"])
     day = datetime.utcnow().date()
     with conn:
-        hn.update_best_stories(conn, day)
+        hn.update_best_stories(conn, day, cfg["n_concurrent_requests"])
 
 
 def backfill_best(ctx, start_date, end_date, source):
-    conn = db.connect(ctx.cfg["hn2ebook"]["db_path"])
+    cfg = ctx.cfg["hn2ebook"]
+    conn = db.connect(cfg["db_path"])
     log.info("Backfilling from %s to %s" % format_range(start_date, end_date))
-    if source == "/front":
-        with conn:
-            hn.backfill_frontpage(conn, start_date, end_date)
-    elif source == "daemonology":
-        with conn:
-            hn.backfill_daemonology(conn, start_date, end_date)
+    failed = hn.backfill(
+        conn,
+        source,
+        start_date.date(),
+        end_date.date(),
+        cfg["backfill_concurrency"],
+        cfg["n_concurrent_requests"],
+        algolia_url=cfg["algolia_url"],
+    )
+    if failed:
+        log.error(
+            f"{failed} days failed to backfill, run the backfill again to retry them"
+        )
+        sys.exit(1)
+
+
+def import_dump(ctx, path, batch_size, derive_best, best_per_day):
+    from hn2ebook import archive
+
+    conn = db.connect(ctx.cfg["hn2ebook"]["db_path"])
+    archive.import_dump(conn, path, batch_size, derive_best, best_per_day)
 
 
 def migrate_db(ctx):
@@ -324,6 +543,44 @@ def enable_cache(ctx):
     requests_cache.install_cache(cache_path)
 
 
-def server(ctx, host, port):
-    core.app.config["data_dir"] = ctx.cfg["hn2ebook"]["data_dir"]
-    core.app.run(host=host, port=port, debug=False)
+def server(ctx, host, port, development, n_workers, n_threads, build_jobs=True):
+    import os
+
+    from hn2ebook import jobs
+
+    cfg = ctx.cfg["hn2ebook"]
+    core.app.config["data_dir"] = cfg["data_dir"]
+    # the feeds are rendered from the database by the opds routes
+    core.app.config["hn2ebook"] = cfg
+
+    # the builds requested over http run in their own process, forked before
+    # the server starts any thread
+    server_pid = os.getpid()
+    runner_pid = jobs.start_runner(cfg, cfg["n_build_jobs"]) if build_jobs else None
+    try:
+        if development:
+            core.app.run(host=host, port=port, debug=False)
+            return
+
+        from hn2ebook import server
+
+        server.serve(
+            core.app,
+            host,
+            port,
+            n_workers if n_workers is not None else cfg["server_workers"],
+            n_threads if n_threads is not None else cfg["server_threads"],
+            cfg["server_graceful_timeout"],
+        )
+    finally:
+        # the gunicorn workers are forked inside serve() and unwind through
+        # here when they exit, only the process that started the runner
+        # stops it
+        if runner_pid and os.getpid() == server_pid:
+            jobs.stop_runner(runner_pid)
+
+
+def daemon(ctx, n_workers):
+    from hn2ebook.daemon import Daemon
+
+    Daemon(ctx).run(n_workers or ctx.cfg["daemon"]["n_workers"])
@@ -0,0 +1,81 @@
+import re
+import zipfile
+
+import lxml.etree
+
+from hn2ebook import writer
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("compose")
+
+OPF_NS = "{http://www.idpf.org/2007/opf}"
+XHTML_NS = "{http://www.w3.org/1999/xhtml}"
+
+
+def manifest_media_types(z):
+    opf = lxml.etree.fromstring(z.read(f"{writer.ROOT}/content.opf"))
+    return {
+        item.get("href"): (item.get("id"), item.get("media-type"))
+        for item in opf.iter(f"{OPF_NS}item")
+    }
+
+
+def toc_labels(z):
+    """
+    Returns the table of contents label of every page. The sub-entries of a
+    split chapter come after the chapter entry, so their labels win.
+    """
+    nav = lxml.etree.fromstring(z.read(f"{writer.ROOT}/nav.xhtml"))
+    return {a.get("href"): a.text for a in nav.iter(f"{XHTML_NS}a")}
+
+
+def chapter_from_epub(epub_path, story):
+    """
+    Returns the chapter of a story out of an epub built by hn2ebook, or None
+    if the epub doesn't contain it. Pages and images are returned still
+    compressed, so composing an issue is just copying zip entries.
+    """
+    story_id = story["id"]
+    root = f"{writer.ROOT}/"
+    page_re = re.compile(rf"^chap_{story_id}(?:_(\d+))?\.xhtml$")
+    image_prefix = f"images/image_{story_id}_"
+
+    with zipfile.ZipFile(epub_path) as z, open(epub_path, "rb") as f:
+        infos = {
+            info.filename[len(root) :]: info
+            for info in z.infolist()
+            if info.filename.startswith(root)
+        }
+        matches = [page_re.match(name) for name in infos]
+        pages = [
+            m.string
+            for m in sorted(filter(None, matches), key=lambda m: int(m.group(1) or 0))
+        ]
+        if not pages:
+            return None
+        media_types = manifest_media_types(z)
+        labels = toc_labels(z)
+
+        log.info(f"copying chapter for story id={story_id} from {epub_path}")
+        return {
+            "story_id": story_id,
+            "title": story["title"],
+            "parts": [
+                {
+                    "file_name": name,
+                    "label": labels.get(name) or story["title"],
+                    "content": writer.read_raw_entry(z, f, infos[name]),
+                }
+                for name in pages
+            ],
+            "images": [
+                {
+                    "uid": media_types[name][0],
+                    "file_name": name,
+                    "mimetype": media_types[name][1],
+                    "payload": writer.read_raw_entry(z, f, infos[name]),
+                }
+                for name in infos
+                if name.startswith(image_prefix) and name in media_types
+            ],
+        }
@@ -1,5 +1,7 @@
 import subprocess
 import os
+import atexit
+import threading
 import math
 import json
 import io
@@ -11,23 +13,37 @@ import traceback
 import urllib
 import multiprocessing
 import cgi
+import html
+import gzip
+import functools
 from pathlib import Path
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from itertools import groupby
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import PIL.Image
 import requests
 import lxml.etree
 import lxml.html
 
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 from selenium.webdriver import Chrome
 from selenium.webdriver.chrome.options import Options
 from selenium.webdriver.common.keys import Keys
 from flask import Flask, request, jsonify, send_from_directory
-from flask.templating import render_template
-from ebooklib import epub
-
+from flask.templating import render_template, stream_template
+
+from hn2ebook import cache
+from hn2ebook import compose
+from hn2ebook import db
+from hn2ebook import net
+from hn2ebook import writer
+from hn2ebook.store import StoryStore
 from hn2ebook.misc.log import logger
 
 log = logger.get_logger("hn2ebook")
@@ -37,22 +53,45 @@ ALLOWED_MIMETYPES = ["text/html", "text/plain"]
 
 
 def fetch_mimetype(url):
-    h = requests.head(url, allow_redirects=True)
+    h = net.session().head(url, allow_redirects=True)
     header = h.headers
     content_type = header.get("content-type")
     mimetype, _ = cgi.parse_header(content_type)
     return mimetype
 
 
+# the headless chrome of every thread, kept between pages as starting one
+# takes seconds
+_browsers = threading.local()
+
+
+def chrome_browser(driver_path, wait_seconds):
+    if getattr(_browsers, "pid", None) != os.getpid():
+        _browsers.pid = os.getpid()
+        _browsers.browser = None
+    if _browsers.browser is None:
+        opts = Options()
+        opts.headless = True
+        browser = Chrome(executable_path=driver_path, options=opts)
+        browser.implicitly_wait(wait_seconds)
+        atexit.register(browser.quit)
+        _browsers.browser = browser
+    return _browsers.browser
+
+
 def chrome_get(driver_path, url, wait_seconds=3):
-    opts = Options()
-    opts.headless = True
-    browser = Chrome(executable_path=driver_path, options=opts)
-    browser.implicitly_wait(wait_seconds)
-    browser.get(url)
-    source = browser.page_source
-    browser.close()
-    return source
+    browser = chrome_browser(driver_path, wait_seconds)
+    try:
+        browser.get(url)
+        return browser.page_source
+    except Exception:
+        # a crashed or stuck browser is replaced for the next page
+        _browsers.browser = None
+        try:
+            browser.quit()
+        except Exception:
+            pass
+        raise
 
 
 def parse_srcset(cfg, srcset):
@@ -75,7 +114,7 @@ def readable(cfg, url):
     if cfg["use_chrome"]:
         text = chrome_get(cfg["chromedriver_bin"], url)
     else:
-        response = requests.get(url, allow_redirects=True)
+        response = net.get(url, allow_redirects=True)
         response.raise_for_status()
         if response.encoding == "ISO-8859-1":
             response.encoding = response.apparent_encoding
@@ -108,9 +147,32 @@ def url_for_item(id):
     return f"https://hacker-news.firebaseio.com/v0/item/{id}.json?print=pretty"
 
 
+# the database holding imported items, looked up before asking the API
+item_db_path = None
+
+# HN closes threads to new comments and votes after about two weeks, so an
+# imported item older than that is as final as what the API would return
+ITEM_FINAL_AGE = timedelta(days=14)
+
+
+def use_local_items(db_path):
+    global item_db_path
+    item_db_path = db_path
+
+
 def get_item(id):
+    """
+    Returns an HN item from the imported items if it is old enough to be
+    final, from the API otherwise. Items that were imported while their
+    thread was still open have to be fetched again to be up to date.
+    """
     # log.debug(f"getting item {id}")
-    r = requests.get(url_for_item(id))
+    if item_db_path:
+        posted_before = (datetime.now(timezone.utc) - ITEM_FINAL_AGE).timestamp()
+        item = db.get_item(db.connect(item_db_path), id, posted_before)
+        if item:
+            return item
+    r = net.get(url_for_item(id))
     r.raise_for_status()
     return r.json()
 
@@ -121,7 +183,7 @@ def expand_item(pool, self, parent=None):
         return None
     if "kids" in self:
         # children = [expand_item(get_item(kid)) for kid in self["kids"][:10]]
-        items = pool.map(get_item, self["kids"][:10])
+        items = list(pool.map(get_item, self["kids"][:10]))
         children = [expand_item(pool, item, self) for item in items]
     else:
         children = []
@@ -162,7 +224,7 @@ def expand_body(cfg, story):
         traceback.print_exc()
 
 
-def expand_story(cfg, story_id, summary_only):
+def expand_story(cfg, story_id, summary_only, store=None):
     if summary_only:
         log.debug(f"fetching story summary id={story_id}")
     else:
@@ -179,10 +241,19 @@ def expand_story(cfg, story_id, summary_only):
         story["body"] = story["text"]
         del story["text"]
     else:
-        story["body"] = expand_body(cfg, story)
+        # the extracted article is checkpointed, a build resumed after the
+        # comments crawl failed doesn't extract it again
+        body = store.get_article(story_id) if store else None
+        if body is None:
+            body = expand_body(cfg, story)
+            if store and body is not None:
+                store.put_article(story_id, body)
+        story["body"] = body
 
     log.info("walking descendants tree for comments")
-    with multiprocessing.Pool(cfg["n_concurrent_requests"]) as pool:
+    # threads, not processes: fetching comments is io bound, and a story may
+    # be resolved again inside a chapter worker, which can't fork a pool
+    with ThreadPoolExecutor(cfg["n_concurrent_requests"]) as pool:
         story["comments"] = expand_item(pool, story)
     return story
 
@@ -195,14 +266,15 @@ comment_template = """
 <div class="comment-body">
 {text}
 </div>
-<ol>{children}</ol>
-"""
+<ol>"""
 
 comment_op_template = """
 <footer class="hn2ebook-op">{by}</footer>
 {text}
-<ol>{children}</ol>
-"""
+<ol>"""
+
+# written after a comment's replies, closes the <ol> opened by the templates
+comment_close = "</ol>\n</li>"
 
 
 def load_resource_text(file_name):
@@ -220,86 +292,83 @@ def to_link(href, label):
         return ""
 
 
-def indices_to_heading(indices):
-    return ".".join([str(i) for i in indices])
-
-
-def to_html_numbers(indices, comment, op, story_id, sibling_pre, sibling_story):
-    children = []
-    for idx, reply in enumerate(comment["children"]):
-        child_sibling_pre = when_index(comment["children"], idx - 1)
-        child_sibling_story = when_index(comment["children"], idx + 1)
-        human_index = idx + 1
-        child_indices = indices.copy()
-        child_indices.append(human_index)
-        if "by" in reply:
-            children.append(
-                "<li>"
-                + to_html_numbers(
-                    child_indices,
-                    reply,
-                    op,
-                    story_id,
-                    child_sibling_pre,
-                    child_sibling_story,
-                )
-                + "</li>"
-            )
+def comment_to_html(number, comment, op, story_id, sibling_pre, sibling_story):
+    """
+    Renders the opening of a single comment, up to where its replies go.
+    """
     if "by" in comment:
         tmpl = comment_op_template if op == comment["by"] else comment_template
         text_body = comment["text"]
-    elif "deleted" in comment and comment["deleted"]:
+    else:
         tmpl = comment_template
         text_body = "deleted"
-    descendants = "<span>(%d)</span>" % (len(children)) if len(children) > 0 else ""
+    n_replies = 0
+    for reply in comment["children"]:
+        if "by" in reply:
+            n_replies += 1
+    parent = comment["parent"]
+    links = "%s %s %s" % (
+        to_link(sibling_pre.get("id") if sibling_pre else None, "previous"),
+        to_link(parent, "parent") if str(parent) != str(story_id) else "",
+        to_link(sibling_story.get("id") if sibling_story else None, "next"),
+    )
     return tmpl.format(
-        **{
-            "number": indices_to_heading(indices),
-            "kid": comment["id"],
-            "text": text_body,
-            "by": comment.get("by"),
-            "date": datetime.fromtimestamp(comment["time"]).strftime(
-                "%Y-%m-%d %H:%M:%S"
-            ),
-            "descendants": descendants,
-            "children": "".join(children),
-            "links": "{} {} {}".format(
-                to_link(sibling_pre.get("id") if sibling_pre else None, "previous"),
-                to_link(comment["parent"], "parent")
-                if str(comment["parent"]) != str(story_id)
-                else "",
-                to_link(sibling_story.get("id") if sibling_story else None, "next"),
-            ),
-        }
+        number=number,
+        kid=comment["id"],
+        text=text_body,
+        by=comment.get("by"),
+        date=datetime.fromtimestamp(comment["time"]).strftime("%Y-%m-%d %H:%M:%S"),
+        descendants="<span>(%d)</span>" % n_replies if n_replies > 0 else "",
+        links=links,
     )
 
 
-def is_index(a, i):
-    return 0 <= i < len(a)
+def push_comments(stack, parent_number, comments, authored_only):
+    # pushed in reverse so that they pop off the stack in thread order
+    last = len(comments) - 1
+    for idx in range(last, -1, -1):
+        comment = comments[idx]
+        if authored_only and "by" not in comment:
+            continue
+        stack.append(
+            (
+                f"{parent_number}.{idx + 1}" if parent_number else str(idx + 1),
+                comment,
+                comments[idx - 1] if idx > 0 else None,
+                comments[idx + 1] if idx < last else None,
+            )
+        )
 
 
-def when_index(a, i):
-    if is_index(a, i):
-        return a[i]
-    return None
+def render_comments(out, story_id, comments, op="op"):
+    """
+    Appends the numbered comment tree to the list of html fragments out.
+
+    The tree is walked depth first with an explicit stack, so deep threads
+    can't exhaust the recursion limit and each fragment is written exactly once.
+    """
+    out.append("<ol>")
+    stack = []
+    push_comments(stack, None, comments, authored_only=False)
+    while stack:
+        entry = stack.pop()
+        if entry is None:
+            out.append(comment_close)
+            continue
+        number, comment, sibling_pre, sibling_story = entry
+        out.append("<li>")
+        out.append(
+            comment_to_html(number, comment, op, story_id, sibling_pre, sibling_story)
+        )
+        # marks where this comment's replies end
+        stack.append(None)
+        push_comments(stack, number, comment["children"], authored_only=True)
+    out.append("</ol>")
+    return out
 
 
 def comments_to_html(story_id, comments):
-    comments_style = "numbers"
-    out = "<ol>"
-    op = "op"
-    for idx, comment in enumerate(comments):
-        sibling_pre = when_index(comments, idx - 1)
-        sibling_story = when_index(comments, idx + 1)
-        human_idx = idx + 1
-        out += (
-            "<li>"
-            + to_html_numbers(
-                [human_idx], comment, op, story_id, sibling_pre, sibling_story
-            )
-            + "</li>"
-        )
-    return out + ("</ol>" if comments_style == "numbers" else "")
+    return "".join(render_comments([], story_id, comments))
 
 
 def story_to_html(story):
@@ -319,8 +388,12 @@ def story_to_html(story):
         return attachment
 
 
-def story_to_data(cfg, story_id, summary_only):
-    story = expand_story(cfg, story_id, summary_only)
+# the plain text of a resolved story that it is found by in searches
+SEARCH_TEXT_KEYS = ["article_text", "comments_text"]
+
+
+def story_to_data(cfg, story_id, summary_only, store=None):
+    story = expand_story(cfg, story_id, summary_only, store)
     data = {
         "title": story["title"],
         "id": str(story["id"]),
@@ -333,15 +406,37 @@ def story_to_data(cfg, story_id, summary_only):
     }
     if not summary_only:
         data["html"] = story_to_html(story)
+        # the plain text is what the story is found by in searches
+        data["article_text"] = html_to_text(story["body"])
+        data["comments_text"] = comments_text(story["children"])
     return data
 
 
-def calc_width(n):
-    return min(2, len(str(n)))
+def html_to_text(html):
+    if not html or not html.strip():
+        return ""
+    try:
+        return lxml.html.fromstring(html).text_content()
+    except lxml.etree.ParserError:
+        return ""
+
+
+def comments_text(comments):
+    """
+    Returns the text of all the comments of a comment tree, one comment per
+    line, in reading order.
+    """
+    texts = []
+    stack = list(reversed(comments))
+    while stack:
+        comment = stack.pop()
+        texts.append(html_to_text(comment.get("text")))
+        stack.extend(reversed(comment.get("children", [])))
+    return "\n".join(texts)
 
 
 def image_to_svg_string(image_url):
-    response = requests.get(image_url)
+    response = net.get(image_url)
     response.raise_for_status()
     return response.text
 
@@ -356,7 +451,7 @@ def image_to_png_bytes(image_url):
             if not mimetype.startswith("image"):
                 log.debug(f"skipping src with mimetype {mimetype}")
                 return None
-            response = requests.get(image_url, stream=True)
+            response = net.get(image_url, stream=True)
             response.raise_for_status()
             response.raw.decode_content = True
             data = response.raw
@@ -471,36 +566,214 @@ def remove_rich_media(html):
     return lxml.etree.tostring(tree)
 
 
-def build_chapter(cfg, book, number, total_chapters, story):
+def comment_threads(tree):
+    """
+    Returns the top-level comment threads of a rendered story page.
+    """
+    containers = tree.find_class("hn2ebook-comments")
+    if not containers:
+        return []
+    ol = containers[0].find("ol")
+    if ol is None:
+        return []
+    return [li for li in ol if li.tag == "li"]
+
+
+def group_threads(cfg, base_size, threads, sizes):
+    """
+    Packs consecutive top-level threads into groups that stay under the
+    configured chapter size and comment count. The first group shares its
+    budget with the article. A single thread that is over budget on its own
+    still gets a group to itself.
+    """
+    max_bytes = cfg["chapter_max_bytes"]
+    max_comments = cfg["chapter_max_comments"]
+    groups = [[]]
+    size, count = base_size, 0
+    for thread, thread_size in zip(threads, sizes):
+        thread_count = 1 + len(thread.findall(".//li"))
+        if groups[-1] and (
+            size + thread_size > max_bytes or count + thread_count > max_comments
+        ):
+            groups.append([])
+            size, count = 0, 0
+        groups[-1].append(thread)
+        size += thread_size
+        count += thread_count
+    return groups
+
+
+def comments_part(title, heading, threads, start):
+    part = lxml.html.fromstring(
+        f"""<html><head><meta charset="utf-8"/><title></title></head><body>
+<main class="hn2ebook-container"><div class="hn2ebook-comments"><h2></h2><ol start="{start}"></ol></div></main>
+</body></html>"""
+    )
+    part.find(".//title").text = title
+    part.find(".//h2").text = heading
+    # moves the threads out of the first page
+    part.find(".//ol").extend(threads)
+    return part
+
+
+def split_chapter(cfg, story, html):
+    """
+    Splits a rendered story page into one or more pages.
+
+    The first page keeps the article and as many top-level comment threads as
+    fit, the remaining threads are moved to continuation pages. Returns a list
+    of (label, tree) tuples.
+    """
+    tree = lxml.html.fromstring(html)
+    threads = comment_threads(tree)
+    if not threads:
+        return [(story["title"], tree)]
+
+    sizes = [len(lxml.etree.tostring(thread)) for thread in threads]
+    groups = group_threads(cfg, len(html) - sum(sizes), threads, sizes)
+    if len(groups) == 1:
+        return [(story["title"], tree)]
+
+    log.info(
+        "splitting story id=%s into %d parts, %d comment threads"
+        % (story["id"], len(groups), len(threads))
+    )
+    parts = []
+    start = 1
+    for n, group in enumerate(groups):
+        end = start + len(group) - 1
+        if n == 0:
+            parts.append(("Article and comments %d-%d" % (start, end), tree))
+        else:
+            heading = "Comments for %s (%d-%d)" % (story["title"], start, end)
+            parts.append(
+                (
+                    "Comments %d-%d" % (start, end),
+                    comments_part(story["title"], heading, group, start),
+                )
+            )
+        start = end + 1
+    return parts
+
+
+def link_parts(trees, file_names):
+    """
+    Points in-page anchors (#id) that now live on another page of the same
+    chapter to that page, so the previous/parent/next comment links keep working.
+    """
+    ids_by_part = [
+        {el.get("id") for el in tree.iter() if el.get("id")} for tree in trees
+    ]
+    locations = {}
+    for file_name, ids in zip(file_names, ids_by_part):
+        for id in ids:
+            locations.setdefault(id, file_name)
+
+    for tree, ids in zip(trees, ids_by_part):
+        for a in tree.iter("a"):
+            href = a.get("href")
+            if not href or not href.startswith("#"):
+                continue
+            target = href[1:]
+            if target not in ids and target in locations:
+                a.set("href", f"{locations[target]}#{target}")
+
+
+xhtml_page = """<?xml version="1.0" encoding="utf-8"?>
+<!DOCTYPE html>
+<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" lang="en" xml:lang="en">
+<head>
+<title>{title}</title>
+<link href="style/comments.css" rel="stylesheet" type="text/css"/>
+</head>
+{body}
+</html>
+"""
+
+
+def to_xhtml(tree, title):
+    """
+    Serializes a parsed html page as an XHTML content document.
+    """
+    body = tree.find("body")
+    if body is None:
+        body_xml = "<body>%s</body>" % lxml.etree.tostring(tree, encoding="unicode")
+    else:
+        body_xml = lxml.etree.tostring(body, encoding="unicode")
+    return xhtml_page.format(title=html.escape(title), body=body_xml).encode("utf-8")
+
+
+def build_chapter(cfg, story):
+    """
+    Builds the chapter for a resolved story: the transformed pages and the
+    images they reference. File names only depend on the story id, so a built
+    chapter can be put into any issue.
+    """
     log.info("building chapter for story id=%s" % (story["id"]))
-    filename = "chap_%s.xhtml" % (str(number).zfill(calc_width(total_chapters)))
-    c1 = epub.EpubHtml(title=story["title"], file_name=filename, lang="en")
     story_id = story["id"]
+    name = f"chap_{story_id}"
     html, images = rewrite_images(cfg, f"images/image_{story_id}_", story["html"])
     html = remove_rich_media(html)
-    for image in images:
-        idx = image["idx"]
-        uid = f"image_{story_id}_{idx}"
-        image_item = epub.EpubItem(
-            uid=uid,
-            file_name=image["filename"],
-            media_type=image["mimetype"],
-            content=image["payload"],
-        )
-        book.add_item(image_item)
 
-    c1.content = html
-    return c1
+    parts = split_chapter(cfg, story, html)
+    file_names = [f"{name}.xhtml"] + [f"{name}_{n}.xhtml" for n in range(1, len(parts))]
+    link_parts([tree for _, tree in parts], file_names)
+
+    return {
+        "story_id": story_id,
+        "title": story["title"],
+        "parts": [
+            {
+                "file_name": file_name,
+                "label": label,
+                "content": to_xhtml(
+                    tree, story["title"] if n == 0 else f"{story['title']}: {label}"
+                ),
+            }
+            for n, ((label, tree), file_name) in enumerate(zip(parts, file_names))
+        ],
+        "images": [
+            {
+                "uid": f"image_{story_id}_{image['idx']}",
+                "file_name": image["filename"],
+                "mimetype": image["mimetype"],
+                "payload": image["payload"],
+            }
+            for image in images
+        ],
+    }
 
 
-def read_comments_css():
-    style = load_resource_text("styles.css")
-    return epub.EpubItem(
-        uid="style_nav",
-        file_name="style/comments.css",
-        media_type="text/css",
-        content=style,
-    )
+def chapter_for_story(cfg, story):
+    """
+    Returns the chapter for a story, from the chapter cache when the story was
+    resolved against it, from a daily issue when it was composed out of one,
+    otherwise by building (and caching) it. A built chapter is cached under
+    the cache_key of the story when it has one, along with its text.
+    """
+    if "daily_epub" in story:
+        chapter = compose.chapter_from_epub(story["daily_epub"], story)
+        if chapter:
+            return chapter
+        log.info("story id=%s is missing from %s" % (story["id"], story["daily_epub"]))
+        story = story_to_data(cfg, story["id"], False)
+    elif "chapter_key" in story:
+        chapter = cache.load_chapter(cfg, story["chapter_key"])
+        if chapter:
+            return chapter
+        log.info("cached chapter for story id=%s went missing" % story["id"])
+        story = dict(
+            story_to_data(cfg, story["id"], False), cache_key=story["chapter_key"]
+        )
+
+    chapter = build_chapter(cfg, story)
+    if cfg["chapter_cache"]:
+        key = story.get("cache_key") or cache.chapter_key(cfg, story)
+        # the text is kept with the chapter, so that an issue reusing the
+        # chapter can still index the story for searches
+        text = {k: story[k] for k in SEARCH_TEXT_KEYS if k in story}
+        cache.store_chapter(cfg, key, chapter, text)
+    return chapter
 
 
 def epub_description(metadata):
@@ -513,68 +786,148 @@ def epub_description(metadata):
     return f"{start}\n\n{description}\n\n{headlines_txt}"
 
 
-def epub_cover(metadata):
-    from PIL import Image, ImageDraw, ImageFont
+COVER_FONT = "/usr/share/fonts/dejavu-sans-fonts/DejaVuSans-Bold.ttf"
 
-    title, _, subtitle = metadata["title"].rpartition(" ")
+# the widths of the jpeg images written next to a persisted issue for the
+# opds feeds, by kind
+COVER_IMAGE_WIDTHS = {"cover": 600, "thumbnail": 160}
+
+
+@functools.lru_cache(maxsize=None)
+def cover_font(size):
+    from PIL import ImageFont
 
-    bold = "/usr/share/fonts/dejavu-sans-fonts/DejaVuSans-Bold.ttf"
-    regular = "/usr/share/fonts/dejavu-sans-fonts/DejaVuSans.ttf"
+    return ImageFont.truetype(COVER_FONT, size)
+
+
+def draw_centered(draw, width, y, text, font):
+    left, _, right, _ = draw.textbbox((0, 0), text, font=font)
+    draw.text(((width - (right - left)) / 2, y), text, fill=(255, 255, 255), font=font)
+
+
+@functools.lru_cache(maxsize=4)
+def render_cover(title, subtitle, subsubtitle):
+    from PIL import Image, ImageDraw
 
     with load_resource_path("cover.png") as cover_path:
         img = Image.open(cover_path)
         W, H = img.size
         draw = ImageDraw.Draw(img)
-
-        font = ImageFont.truetype(bold, 110)
-        w, h = draw.textsize(title, font=font)
-        draw.text(((W - w) / 2, 260), title, fill=(255, 255, 255), font=font)
-
-        w, h = draw.textsize(subtitle, font=font)
-        draw.text(((W - w) / 2, 441), subtitle, fill=(255, 255, 255), font=font)
-
-        subsubtitle = metadata["subtitle"]
-        font = ImageFont.truetype(bold, 40)
-        w, h = draw.textsize(subsubtitle, font=font)
-        draw.text(((W - w) / 2, 1162), subsubtitle, fill=(255, 255, 255), font=font)
+        draw_centered(draw, W, 260, title, cover_font(110))
+        draw_centered(draw, W, 441, subtitle, cover_font(110))
+        draw_centered(draw, W, 1162, subsubtitle, cover_font(40))
         b = io.BytesIO()
         img.save(b, "png")
         return b.getvalue()
 
 
-def build_epub(cfg, stories, metadata, out_path):
-    comments_css = read_comments_css()
-    book = epub.EpubBook()
-    book.set_identifier(metadata["identifier"])
-    book.set_title(metadata["longtitle"])
-    for author in metadata["authors"]:
-        book.add_author(author)
-    book.set_language(metadata["language"])
-
-    for k, v in metadata["DC"].items():
-        book.add_metadata("DC", k, v)
+def epub_cover(metadata):
+    """
+    Returns the cover of an issue as png. The last few covers are kept, so
+    the cover images of an issue are made from the cover of its epub without
+    drawing it again.
+    """
+    title, _, subtitle = metadata["title"].rpartition(" ")
+    return render_cover(title, subtitle, metadata["subtitle"])
 
-    book.add_metadata("DC", "description", epub_description(metadata))
 
-    book.add_item(comments_css)
-    book.set_cover("cover.png", epub_cover(metadata))
+def cover_image_path(epub_path, kind):
+    epub_path = Path(epub_path)
+    return epub_path.with_name(f"{epub_path.stem}-{kind}.jpg")
 
-    chapters = []
-    for idx, story in enumerate(stories):
-        chapters.append(build_chapter(cfg, book, idx, len(stories), story))
-    toc = []
-    for chapter in chapters:
-        chapter.add_item(comments_css)
-        book.add_item(chapter)
-        toc.append(chapter)
 
-    book.toc = toc
+def write_cover_images(epub_path, metadata):
+    """
+    Writes the cover of an issue as jpeg images next to its epub, one per
+    kind in COVER_IMAGE_WIDTHS, small enough for e-readers to show in the
+    catalog. Returns their file names by kind.
+    """
+    cover = PIL.Image.open(io.BytesIO(epub_cover(metadata))).convert("RGB")
+    file_names = {}
+    for kind, width in COVER_IMAGE_WIDTHS.items():
+        height = round(cover.height * width / cover.width)
+        img = cover.resize((width, height), PIL.Image.LANCZOS)
+        b = io.BytesIO()
+        img.save(b, "jpeg", quality=85, optimize=True, progressive=True)
+        path = cover_image_path(epub_path, kind)
+        write_atomically(path, [b.getvalue()], "wb")
+        file_names[kind] = path.name
+    return file_names
+
+
+def stored_chapter(cfg, stories, story_id):
+    """
+    Returns the chapter for a story of the store, rendered by an earlier
+    attempt at the build if there was one. Rendered chapters are checkpointed
+    in the store, unless they were copied out of the chapter cache or a daily
+    issue, which is as cheap as reading them back.
+    """
+    chapter = stories.get_chapter(story_id)
+    if chapter:
+        log.info("using the chapter rendered earlier for story id=%s" % story_id)
+        return chapter
+    story = stories.get(story_id)
+    chapter = chapter_for_story(cfg, story)
+    if "chapter_key" not in story and "daily_epub" not in story:
+        stories.put_chapter(chapter)
+    return chapter
+
+
+def build_stored_chapter(cfg, store_path, story_id):
+    return stored_chapter(cfg, StoryStore(store_path), story_id)
+
+
+def build_chapters(cfg, stories):
+    """
+    Yields the chapters for the stories of a story store, in order.
+
+    The CPU bound work (parsing, image conversion, serializing) is fanned out
+    to a pool of n_build_workers processes. Each worker reads its story from
+    the store itself, and at most two chapters per worker are in flight, so
+    memory stays bounded even when writing the epub is the slower side.
+    """
+    n_workers = cfg["n_build_workers"] or os.cpu_count()
+    if n_workers <= 1 or len(stories) <= 1:
+        for summary in stories.summaries():
+            yield stored_chapter(cfg, stories, summary["id"])
+        return
+
+    log.info("building chapters with %d workers" % n_workers)
+    store_path = str(stories.path)
+    with multiprocessing.Pool(n_workers) as pool:
+        pending = deque()
+        for summary in stories.summaries():
+            pending.append(
+                pool.apply_async(build_stored_chapter, (cfg, store_path, summary["id"]))
+            )
+            if len(pending) >= 2 * n_workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
 
-    book.add_item(epub.EpubNcx())
-    book.add_item(epub.EpubNav())
 
-    book.spine = ["nav"] + chapters
-    return book
+def build_epub(cfg, stories, metadata, out_path):
+    """
+    Builds the chapters of the stories one by one, streaming each into the
+    epub at out_path as soon as it is done.
+    """
+    with writer.EpubWriter(
+        out_path,
+        metadata,
+        epub_description(metadata),
+        cfg["epub_compress_level"],
+        cfg["n_compress_threads"],
+    ) as book:
+        book.add_item(
+            "style_nav",
+            "style/comments.css",
+            "text/css",
+            load_resource_text("styles.css"),
+        )
+        book.set_cover("cover.png", epub_cover(metadata))
+        for chapter in build_chapters(cfg, stories):
+            book.add_chapter(chapter)
+    return out_path
 
 
 def sort_stories(stories, criteria):
@@ -588,7 +941,31 @@ def sort_stories(stories, criteria):
         return sorted(stories, key=lambda p: p["num_comments"], reverse=True)
 
 
-def resolve_stories(cfg, story_ids, limit, criteria):
+def resolve_story(cfg, summary, store=None):
+    """
+    Fetches the article and comments of a story, unless its chapter is already
+    in the chapter cache, in which case the summary and the text cached with
+    the chapter are all the build needs. The article is checkpointed in the
+    store when one is given.
+    """
+    if cfg["chapter_cache"]:
+        key = cache.chapter_key(cfg, summary)
+        if cache.has_chapter(cfg, key):
+            log.info("using cached chapter for story id=%s" % summary["id"])
+            text = cache.load_chapter_text(cfg, key) or {}
+            return dict(summary, chapter_key=key, **text)
+        # the chapter is cached under the key of the summary, which is what
+        # the next build looks it up by, rather than under the live comment
+        # count of the fetched story
+        return dict(story_to_data(cfg, summary["id"], False, store), cache_key=key)
+    return story_to_data(cfg, summary["id"], False, store)
+
+
+def winnow_stories(cfg, story_ids, limit, criteria):
+    """
+    Fetches the summaries of the stories and picks the top stories per day.
+    Returns the chosen summaries in chronological order.
+    """
     stories = [story_to_data(cfg, story_id, True) for story_id in story_ids]
     import pprint
 
@@ -607,17 +984,55 @@ def resolve_stories(cfg, story_ids, limit, criteria):
     log.info(
         "winnowed %d stories down to %d total" % (len(story_ids), len(chosen_stories))
     )
+    return sort_stories(chosen_stories, "time")
+
+
+def resolve_chosen_stories(cfg, chosen_stories, store, daily_epubs=None, progress=None):
+    """
+    Resolves the chosen stories into the story store, one at a time. Returns
+    the store.
+
+    daily_epubs maps story ids to the daily issue epub they already appeared
+    in. Those stories are not fetched, their chapter is copied out of the
+    daily epub instead. Stories already in the store, resolved by an earlier
+    attempt at the build, are skipped. progress, when given, is called with
+    the number of stories resolved so far and the total after every story.
+    """
+    daily_epubs = daily_epubs or {}
+    store.choose(chosen_stories)
     log.info("extracting article and comments from %d stories" % len(chosen_stories))
 
-    chosen_stories = sort_stories(chosen_stories, "time")
-    return [story_to_data(cfg, story["id"], False) for story in chosen_stories]
+    for n, story in enumerate(chosen_stories, start=1):
+        daily_epub = daily_epubs.get(int(story["id"]))
+        if story["id"] in store:
+            log.info("story id=%s was resolved earlier" % story["id"])
+        elif daily_epub:
+            log.info("reusing story id=%s from %s" % (story["id"], daily_epub))
+            store.put(dict(story, daily_epub=str(daily_epub)))
+        else:
+            store.put(resolve_story(cfg, story, store))
+        if progress:
+            progress(n, len(chosen_stories))
+    return store
+
+
+def resolve_stories(
+    cfg, story_ids, limit, criteria, store, daily_epubs=None, progress=None
+):
+    """
+    Picks the top stories per day and resolves them into the story store,
+    one at a time. Returns the store. The stories chosen by an earlier
+    attempt at the build are not picked again.
+    """
+    chosen_stories = store.chosen()
+    if chosen_stories is None:
+        chosen_stories = winnow_stories(cfg, story_ids, limit, criteria)
+    return resolve_chosen_stories(cfg, chosen_stories, store, daily_epubs, progress)
 
 
 def epub_from_stories(cfg, stories, metadata, output):
-    book = build_epub(cfg, stories, metadata, output)
     log.info(f"writing epub: {output}")
-    epub.write_epub(output, book, {})
-    return output
+    return build_epub(cfg, stories, metadata, output)
 
 
 def entry_description(metadata):
@@ -651,8 +1066,9 @@ def issue_to_entry(root_url, issue):
         % (metadata["title"], metadata["subtitle"], metadata["num_stories"]),
         "content_xhtml": content_xhtml,
         # "content": metadata[""]
-        "has_cover": False,
-        "cover_url": "",
+        "has_cover": "images" in metadata,
+        "cover_url": "/issues/%s" % metadata.get("images", {}).get("cover"),
+        "thumbnail_url": "/issues/%s" % metadata.get("images", {}).get("thumbnail"),
         "formats": [
             {
                 "url": "/issues/%s" % f["file_name"],
@@ -664,39 +1080,122 @@ def issue_to_entry(root_url, issue):
     }
 
 
+def feed_path(cfg, url):
+    return Path(cfg["data_dir"]).joinpath(url[1:])
+
+
+# the content encodings feeds are precompressed with, in order of preference,
+# as (encoding, file suffix, compress function)
+FEED_ENCODINGS = ([("br", ".br", brotli.compress)] if brotli else []) + [
+    ("gzip", ".gz", functools.partial(gzip.compress, compresslevel=9, mtime=0))
+]
+
+
+def write_atomically(path, chunks, mode="w"):
+    """
+    Writes the chunks to a temporary file next to path, then moves it into
+    place, so readers never see a half written feed.
+    """
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp_path, mode) as f:
+            f.writelines(chunks)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+
 def generate_opds(cfg, instance, feed, issues):
-    root_url = instance["root_url"]
-    entries = [issue_to_entry(root_url, issue) for issue in issues]
-    feed_path = Path(cfg["data_dir"]).joinpath(feed["url"][1:])
-    log.info(f"writing feed {feed_path} with {len(issues)}")
+    """
+    Writes the feed for the issues. issues may be an iterator, the entries
+    are rendered and written out as they are read.
+    """
+    path = feed_path(cfg, feed["url"])
+    log.info(f"writing feed {path}")
     with app.app_context():
-        current_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
-        xml = render_template(
-            "opds-feed.xml.j2",
-            current_time=current_time,
-            root_url=root_url,
-            feed=feed,
-            instance=instance,
-            entries=entries,
-        )
-        with open(feed_path, "w") as f:
-            f.write(xml)
+        write_atomically(path, render_opds(instance, feed, issues))
+    write_compressed(path)
+
+
+def write_compressed(path):
+    """
+    Writes the compressed variants of a feed next to it, so the server never
+    compresses a feed on request.
+    """
+    data = path.read_bytes()
+    for _, suffix, compress in FEED_ENCODINGS:
+        write_atomically(path.with_name(path.name + suffix), [compress(data)], "wb")
+
+
+def compress_variants(data):
+    """
+    Returns the content of a feed by content encoding, None being the
+    uncompressed one.
+    """
+    variants = {None: data}
+    for encoding, _, compress in FEED_ENCODINGS:
+        variants[encoding] = compress(data)
+    return variants
+
+
+def accepted_encoding(available):
+    """
+    Returns the preferred content encoding among the available ones that the
+    client of the current request accepts, or None.
+    """
+    for encoding, _, _ in FEED_ENCODINGS:
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return None
+
+
+def opds_time(updated=None):
+    return (updated or datetime.now()).strftime("%Y-%m-%dT%H:%M:%S+00:00")
+
+
+def render_opds(instance, feed, issues, updated=None):
+    """
+    Renders the feed for the issues, yielding it in chunks. Must be consumed
+    within an app context. updated is the time the feed says it was updated
+    at, the current time if not given.
+    """
+    root_url = instance["root_url"]
+    entries = (issue_to_entry(root_url, issue) for issue in issues)
+    current_time = opds_time(updated)
+    return stream_template(
+        "opds-feed.xml.j2",
+        current_time=current_time,
+        root_url=root_url,
+        feed=feed,
+        instance=instance,
+        entries=entries,
+    )
+
+
+def render_opds_index(instance, feeds, updated=None):
+    current_time = opds_time(updated)
+    return render_template(
+        "opds-index.xml.j2",
+        current_time=current_time,
+        root_url=instance["root_url"],
+        feeds=feeds,
+        instance=instance,
+    )
+
+
+def render_opensearch(instance):
+    return render_template(
+        "opensearch.xml.j2", root_url=instance["root_url"], instance=instance
+    )
 
 
 def generate_opds_index(cfg, instance, feeds):
-    feed_path = Path(cfg["data_dir"]).joinpath(instance["url"][1:])
-    log.info(f"writing feed {feed_path} as index")
+    path = feed_path(cfg, instance["url"])
+    log.info(f"writing feed {path} as index")
     with app.app_context():
-        current_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S+00:00")
-        xml = render_template(
-            "opds-index.xml.j2",
-            current_time=current_time,
-            root_url=instance["root_url"],
-            feeds=feeds,
-            instance=instance,
-        )
-        with open(feed_path, "w") as f:
-            f.write(xml)
+        write_atomically(path, [render_opds_index(instance, feeds)])
+    write_compressed(path)
 
 
 @app.route("/<path:path>")
@@ -710,7 +1209,36 @@ def serve_resource(path):
     if filename.endswith(".epub"):
         as_attachment = True
         mimetype = "application/epub+zip"
+    elif filename.endswith(".jpg"):
+        mimetype = "image/jpeg"
+
+    # send_from_directory answers conditional and range requests on its own,
+    # with an etag derived from the mtime and size of the file sent
+    if not filename.endswith(".xml"):
+        return send_from_directory(
+            data_dir, filename, as_attachment=as_attachment, mimetype=mimetype
+        )
 
-    return send_from_directory(
-        data_dir, filename, as_attachment=as_attachment, mimetype=mimetype
+    path = Path(data_dir).joinpath(filename)
+    variants = {
+        encoding: filename + suffix
+        for encoding, suffix, _ in FEED_ENCODINGS
+        if is_fresh_variant(path, path.with_name(path.name + suffix))
+    }
+    encoding = accepted_encoding(variants)
+    response = send_from_directory(
+        data_dir,
+        variants.get(encoding, filename),
+        mimetype=mimetype,
+        download_name=filename,
     )
+    response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    return response
+
+
+def is_fresh_variant(path, variant):
+    try:
+        return variant.stat().st_mtime >= path.stat().st_mtime
+    except FileNotFoundError:
+        return False
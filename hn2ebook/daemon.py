@@ -0,0 +1,216 @@
+import queue
+import signal
+import itertools
+import threading
+import traceback
+from datetime import date, datetime, time, timedelta
+
+from hn2ebook import cache
+from hn2ebook import commands
+from hn2ebook import core
+from hn2ebook import db
+from hn2ebook import jobs
+from hn2ebook import schedule
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("daemon")
+
+# task priorities, lower runs first: issues requested over http come before
+# the scheduled issues, which come before polling and prefetching
+INTERACTIVE = 0
+SCHEDULED = 1
+BACKGROUND = 2
+
+# how often the daemon checks the schedule and the build job queue, in seconds
+TICK = 1.0
+# when the daemon removes the expired builds requested over http
+EVICT_BUILDS = "5 * * * *"
+
+
+class Daemon:
+    """
+    Runs the scheduled tasks and the requested builds on a pool of worker
+    threads, taking them from a priority queue.
+
+    Everything lives as long as the daemon: the config and imports, the
+    checked migrations, and per worker thread the database connection, the
+    http session and the headless chrome. A worker finishes its task before
+    taking the next one, so priorities only order the tasks that wait.
+    """
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.cfg = ctx.cfg["hn2ebook"]
+        self.daemon_cfg = ctx.cfg["daemon"]
+        self.tasks = queue.PriorityQueue()
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.stopping = threading.Event()
+
+    def submit(self, priority, name, fn):
+        """
+        Queues a task unless one with the same name is waiting or running.
+        Returns whether it was queued.
+        """
+        with self.lock:
+            if name in self.pending:
+                log.info(f"{name} is still pending, skipping it")
+                return False
+            self.pending.add(name)
+        self.tasks.put((priority, next(self.order), name, fn))
+        return True
+
+    def work(self):
+        while True:
+            priority, _, name, fn = self.tasks.get()
+            if fn is None:
+                return
+            log.info(f"running {name}")
+            try:
+                fn()
+            except (Exception, SystemExit) as e:
+                log.error(f"{name} failed: {e!r}")
+                log.debug(traceback.format_exc())
+            finally:
+                with self.lock:
+                    self.pending.discard(name)
+
+    def scheduled_tasks(self):
+        tasks = [
+            ("update", BACKGROUND, lambda: commands.update_best(self.ctx)),
+            ("daily", SCHEDULED, lambda: self.new_issue("daily")),
+            ("weekly", SCHEDULED, lambda: self.new_issue("weekly")),
+            ("monthly", SCHEDULED, lambda: self.new_issue("monthly")),
+            ("generate_feed", SCHEDULED, lambda: commands.generate_opds(self.ctx)),
+            ("prefetch", BACKGROUND, self.prefetch),
+        ]
+        return [
+            (name, schedule.parse_cron(self.daemon_cfg[name]), priority, fn)
+            for name, priority, fn in tasks
+            if self.daemon_cfg[name]
+        ]
+
+    def new_issue(self, period):
+        """
+        Builds the issue of the period that ended yesterday.
+        """
+        as_of = datetime.combine(date.today() - timedelta(days=1), time())
+        commands.new_issue(
+            self.ctx,
+            period,
+            as_of,
+            None,
+            self.daemon_cfg["issue_limit"],
+            self.daemon_cfg["issue_criteria"],
+            True,
+            compose=period != "daily",
+        )
+
+    def prefetch(self):
+        """
+        Queues the chapters of the stories bound for the next daily issue to be
+        built into the chapter cache, one background task per story, so that
+        requested builds can run between them.
+        """
+        if not self.cfg["chapter_cache"]:
+            log.info("prefetching needs the chapter cache, skipping it")
+            return
+        conn = db.connect(self.cfg["db_path"])
+        today = datetime.combine(date.today(), time())
+        stories = commands.stories_for_range(
+            self.cfg,
+            conn,
+            commands.range_for_period(today, "daily"),
+            self.daemon_cfg["issue_limit"],
+            self.daemon_cfg["issue_criteria"],
+        )
+        for story in stories:
+            if not cache.has_chapter(self.cfg, cache.chapter_key(self.cfg, story)):
+                self.submit(
+                    BACKGROUND,
+                    f"prefetch {story['id']}",
+                    lambda story=story: self.prefetch_story(story),
+                )
+
+    def prefetch_story(self, summary):
+        # resolved from the summary, so the chapter is cached under the key
+        # the daily build looks it up by
+        core.chapter_for_story(self.cfg, core.resolve_story(self.cfg, summary))
+
+    def evict_builds(self):
+        jobs.evict_builds(self.cfg, db.connect(self.cfg["db_path"]))
+
+    def claim_build_jobs(self, conn, n_workers):
+        """
+        Takes build jobs from the queue in the database while fewer than
+        n_workers of them are pending. They go ahead of everything else in
+        the task queue.
+        """
+        with self.lock:
+            n_builds = len([n for n in self.pending if n.startswith("build job ")])
+        for _ in range(n_workers - n_builds):
+            job = db.claim_build_job(conn, datetime.utcnow())
+            if not job:
+                return
+            self.submit(
+                INTERACTIVE,
+                f"build job {job['id']}",
+                lambda job=job: jobs.run_job(self.cfg, job),
+            )
+
+    def stop(self, signum=None, frame=None):
+        log.info("stopping after the running tasks")
+        self.stopping.set()
+
+    def run(self, n_workers):
+        core.use_local_items(self.cfg["db_path"])
+        conn = db.connect(self.cfg["db_path"])
+        build_jobs = self.daemon_cfg["build_jobs"]
+        if build_jobs:
+            n = db.requeue_build_jobs(conn, datetime.utcnow())
+            if n:
+                log.info(f"requeued {n} interrupted build jobs")
+
+        now = datetime.now()
+        scheduled = []
+        tasks = self.scheduled_tasks()
+        if build_jobs:
+            evict = schedule.parse_cron(EVICT_BUILDS)
+            tasks.append(("evict builds", evict, BACKGROUND, self.evict_builds))
+        for name, cron, priority, fn in tasks:
+            next_time = schedule.next_run(cron, now)
+            log.info(f"{name} runs next at {next_time}")
+            scheduled.append([next_time, name, cron, priority, fn])
+
+        workers = [
+            threading.Thread(target=self.work, name=f"worker-{n}")
+            for n in range(n_workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        while not self.stopping.is_set():
+            now = datetime.now()
+            for task in scheduled:
+                next_time, name, cron, priority, fn = task
+                if now >= next_time:
+                    self.submit(priority, name, fn)
+                    task[0] = schedule.next_run(cron, now)
+            if build_jobs:
+                self.claim_build_jobs(conn, n_workers)
+            self.stopping.wait(TICK)
+
+        # the waiting tasks are dropped, build jobs among them are queued
+        # again when the daemon starts next
+        while True:
+            try:
+                self.tasks.get_nowait()
+            except queue.Empty:
+                break
+        for _ in workers:
+            self.tasks.put((BACKGROUND + 1, next(self.order), "stop", None))
+        for worker in workers:
+            worker.join()
@@ -1,8 +1,9 @@
+import os
 import sys
 import sqlite3
 import json
+import threading
 from pathlib import Path
-from itertools import groupby
 
 from hn2ebook.misc.log import logger
 from yoyo import get_backend
@@ -10,6 +11,24 @@ from yoyo import read_migrations
 
 log = logger.get_logger("db")
 
+BUSY_TIMEOUT_MS = 30000
+
+# applied to every new connection. WAL lets readers (the server) carry on
+# while a writer (a cron job) holds the write lock, and with WAL synchronous
+# NORMAL is still safe against corruption.
+PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA temp_store = MEMORY",
+]
+
+_migration_lock = threading.Lock()
+_migration_checked = set()
+_local = threading.local()
+
 
 def yoyo_context(db_path):
     backend_uri = f"sqlite:///{db_path}"
@@ -30,23 +49,74 @@ def migrate(db_path):
     backend, migrations = yoyo_context(db_path)
     with backend.lock():
         backend.apply_migrations(backend.to_apply(migrations))
+    with _migration_lock:
+        _migration_checked.add(db_path)
+
+
+def check_migrations(db_path):
+    """
+    Exits if the database needs to be migrated. Reading the migrations is
+    slow, so every database is only checked once per process.
+    """
+    with _migration_lock:
+        if db_path in _migration_checked:
+            return
+        if needs_migration(db_path):
+            log.error(f"ERROR: database {db_path} needs to be migrated")
+            sys.exit(2)
+        _migration_checked.add(db_path)
 
 
 def select_keys(d, keys):
     return {k: d[k] for k in keys}
 
 
-def connect(db_path):
-    if needs_migration(db_path):
-        log.error(f"ERROR: database {db_path} needs to be migrated")
-        sys.exit(2)
-
-    conn = sqlite3.connect(db_path)
+def open_connection(db_path):
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
     conn.isolation_level = None
     conn.row_factory = sqlite3.Row
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def thread_connections():
+    # connections must not cross threads, nor processes forked by a pool
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.connections = {}
+    return _local.connections
+
+
+def is_open(conn):
+    try:
+        conn.total_changes
+        return True
+    except sqlite3.ProgrammingError:
+        return False
+
+
+def connect(db_path):
+    """
+    Returns the connection to the database for the calling thread. The
+    connection is opened on first use and reused afterwards, so callers
+    should not close it.
+    """
+    check_migrations(db_path)
+    connections = thread_connections()
+    conn = connections.get(db_path)
+    if conn is None or not is_open(conn):
+        conn = open_connection(db_path)
+        connections[db_path] = conn
     return conn
 
 
+def close(db_path):
+    conn = thread_connections().pop(db_path, None)
+    if conn is not None:
+        conn.close()
+
+
 def insert_best_stories(conn, tuples):
     cur = conn.cursor()
     cur.executemany(
@@ -76,6 +146,128 @@ def best_stories_for(conn, start_date, end_date):
     ).fetchall()
 
 
+def _insert_story_snapshots(cur, stories, at):
+    rows = [
+        {
+            "story_id": int(story["id"]),
+            "title": story["title"],
+            "author": story["author"],
+            "url": story["url"],
+            "time": story["time"],
+            "score": story["score"],
+            "descendants": story["descendants"],
+            "at": at,
+        }
+        for story in stories
+    ]
+    cur.executemany(
+        "INSERT INTO hn_story (story_id, title, author, url, time, score, descendants, updated_at) VALUES (:story_id, :title, :author, :url, :time, :score, :descendants, :at) "
+        "ON CONFLICT (story_id) DO UPDATE SET title = excluded.title, url = excluded.url, score = excluded.score, descendants = excluded.descendants, updated_at = excluded.updated_at",
+        rows,
+    )
+    cur.executemany(
+        "INSERT INTO hn_story_snapshot (story_id, at, score, descendants) VALUES (:story_id, :at, :score, :descendants)",
+        rows,
+    )
+    return len(rows)
+
+
+def insert_story_snapshots(conn, stories, at):
+    """
+    Records the current metadata of the stories, both as their latest known
+    state and as a snapshot in their history.
+    """
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        n = _insert_story_snapshots(cur, stories, at)
+        cur.execute("COMMIT")
+    except conn.Error:
+        cur.execute("ROLLBACK")
+        raise
+    return n
+
+
+def completed_backfill_days(conn, source, start_date, end_date):
+    cur = conn.cursor()
+    return set(
+        row["day"]
+        for row in cur.execute(
+            "SELECT day FROM backfill_checkpoint WHERE source = ? AND day >= ? AND day < ?",
+            (source, str(start_date), str(end_date)),
+        ).fetchall()
+    )
+
+
+def insert_backfilled_days(conn, source, days, at):
+    """
+    Records the best stories and their metadata for a batch of backfilled
+    days, and checkpoints the days, all in one transaction. days is a list of
+    (day, story ids, story metadata) tuples.
+    """
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        cur.executemany(
+            "INSERT OR IGNORE INTO hn_best_story (story_id, day) VALUES (?, ?)",
+            [(story_id, day) for day, story_ids, _ in days for story_id in story_ids],
+        )
+        _insert_story_snapshots(
+            cur, [story for _, _, stories in days for story in stories], at
+        )
+        cur.executemany(
+            "INSERT OR REPLACE INTO backfill_checkpoint (source, day, num_stories, at) VALUES (?, ?, ?, ?)",
+            [(source, str(day), len(story_ids), at) for day, story_ids, _ in days],
+        )
+        cur.execute("COMMIT")
+    except conn.Error:
+        cur.execute("ROLLBACK")
+        raise
+
+
+def story_ids_without_metadata(conn, story_ids):
+    cur = conn.cursor()
+    known = set(
+        row["story_id"]
+        for row in cur.execute(
+            "SELECT story_id FROM hn_story WHERE story_id IN (SELECT value FROM json_each(?))",
+            (json.dumps([int(story_id) for story_id in story_ids]),),
+        ).fetchall()
+    )
+    return [story_id for story_id in story_ids if int(story_id) not in known]
+
+
+# the order in which the stories of a day are ranked for each sort criteria
+criteria_order = {
+    "time": "s.time ASC",
+    "time-reverse": "s.time DESC",
+    "points": "s.score DESC",
+    "total-comments": "s.descendants DESC",
+}
+
+
+def top_stories_for(conn, start_date, end_date, limit, criteria):
+    """
+    Returns the latest metadata of the top limit best stories of every day
+    between [start,end), ranked by the criteria, in chronological order.
+    Stories are grouped by the day they were posted on.
+    """
+    cur = conn.cursor()
+    return cur.execute(
+        f"""
+        SELECT * FROM (
+            SELECT s.*, ROW_NUMBER() OVER (
+                PARTITION BY date(s.time, 'unixepoch')
+                ORDER BY {criteria_order[criteria]}, s.story_id
+            ) AS rank
+            FROM hn_best_story b INNER JOIN hn_story s ON s.story_id = b.story_id
+            WHERE b.day >= ? AND b.day < ?
+        ) WHERE rank <= ? ORDER BY time ASC, story_id ASC
+        """,
+        (start_date, end_date, limit),
+    ).fetchall()
+
+
 def insert_issue(conn, issue, post_ids, formats, period):
     payload = {
         "uuid": issue["uuid"],
@@ -83,12 +275,23 @@ def insert_issue(conn, issue, post_ids, formats, period):
         "num_stories": issue["num_stories"],
         "meta": json.dumps(issue["meta"]),
         "period": period,
+        "fingerprint": issue.get("fingerprint"),
     }
     cur = conn.cursor()
     cur.execute("BEGIN")
     try:
+        # a rebuilt issue overwrites the epub of the issue it replaces
+        replaced = [
+            row["issue_id"]
+            for row in cur.execute(
+                "SELECT DISTINCT issue_id FROM issue_format WHERE file_name IN (SELECT value FROM json_each(?))",
+                (json.dumps([f["file_name"] for f in formats]),),
+            ).fetchall()
+        ]
+        for issue_id in replaced:
+            delete_issue(cur, issue_id)
         cur.execute(
-            "INSERT INTO issue (uuid, at, num_stories, meta, period) VALUES (:uuid, :at, :num_stories, :meta, :period)",
+            "INSERT INTO issue (uuid, at, num_stories, meta, period, fingerprint) VALUES (:uuid, :at, :num_stories, :meta, :period, :fingerprint)",
             payload,
         )
         issue_id = cur.lastrowid
@@ -105,39 +308,508 @@ def insert_issue(conn, issue, post_ids, formats, period):
             story_issues,
         )
         cur.execute("COMMIT")
+        return len(replaced)
     except conn.Error as e:
         log.error(e)
         cur.execute("ROLLBACK")
+        return 0
+
+
+def delete_issue(cur, issue_id):
+    cur.execute("DELETE FROM story_issue WHERE issue_id = ?", (issue_id,))
+    cur.execute("DELETE FROM issue_format WHERE issue_id = ?", (issue_id,))
+    cur.execute("DELETE FROM issue WHERE id = ?", (issue_id,))
+
+
+ISSUE_KEYS = ["id", "uuid", "at", "num_stories", "meta", "period"]
+FORMAT_KEYS = ["file_name", "file_size", "mimetype"]
 
 
 def _post_issues(raw):
-    issue_rows = [dict(issue) for issue in raw]
+    """
+    Groups rows of issues joined with their formats into issues, keeping the
+    order in which each issue first appears.
+    """
     issues = {}
-    for k, g in groupby(issue_rows, key=lambda t: t["issue_id"]):
-        rows = list(g)
-        issue = select_keys(
-            rows[0], ["id", "uuid", "at", "num_stories", "meta", "period"]
-        )
-        issue["formats"] = [
-            select_keys(row, ["file_name", "file_size", "mimetype"]) for row in rows
-        ]
+    for row in raw:
+        row = dict(row)
+        issue = issues.get(row["issue_id"])
+        if issue is None:
+            issue = select_keys(row, ISSUE_KEYS)
+            issue["meta"] = json.loads(issue["meta"])
+            issue["formats"] = []
+            issues[row["issue_id"]] = issue
+        issue["formats"].append(select_keys(row, FORMAT_KEYS))
+    return list(issues.values())
+
+
+def formats_for(conn, issue_ids):
+    cur = conn.cursor()
+    formats = {issue_id: [] for issue_id in issue_ids}
+    for row in cur.execute(
+        "SELECT * FROM issue_format WHERE issue_id IN (SELECT value FROM json_each(?))",
+        (json.dumps(issue_ids),),
+    ).fetchall():
+        formats[row["issue_id"]].append(select_keys(row, FORMAT_KEYS))
+    return formats
+
+
+def issues_page(conn, period=None, after=None, limit=100, with_formats=True, offset=0):
+    """
+    Returns a page of at most limit issues, newest first. after is the
+    (at, id) cursor of the last issue of the previous page, so a page costs
+    an index seek no matter how deep into the table it is. offset skips
+    issues instead, for random access to a page without its cursor.
+    """
+    where, params = [], []
+    if period:
+        where.append("period = ?")
+        params.append(period)
+    if after:
+        where.append("(at, id) < (?, ?)")
+        params.extend(after)
+    where_sql = f"WHERE {' AND '.join(where)}" if where else ""
+    cur = conn.cursor()
+    issues = []
+    for row in cur.execute(
+        f"SELECT * FROM issue {where_sql} ORDER BY at DESC, id DESC LIMIT ? OFFSET ?",
+        params + [limit, offset],
+    ).fetchall():
+        issue = select_keys(row, ISSUE_KEYS)
         issue["meta"] = json.loads(issue["meta"])
-        issues[k] = issue
-    return issues.values()
+        issues.append(issue)
+    if with_formats:
+        formats = formats_for(conn, [issue["id"] for issue in issues])
+        for issue in issues:
+            issue["formats"] = formats[issue["id"]]
+    return issues
+
+
+def count_issues(conn, period):
+    cur = conn.cursor()
+    return cur.execute(
+        "SELECT COUNT(*) FROM issue WHERE period = ?", (period,)
+    ).fetchone()[0]
+
+
+def issues_version(conn):
+    """
+    Returns the id of the newest issue row, which changes whenever an issue
+    is added or replaced, and the time of the newest issue.
+    """
+    cur = conn.cursor()
+    return tuple(cur.execute("SELECT MAX(id), MAX(at) FROM issue").fetchone())
+
+
+def page_cursor(issues):
+    last = issues[-1]
+    return last["at"], last["id"]
+
+
+def iter_issues(conn, period=None, page_size=100):
+    """
+    Yields all issues, newest first, reading them from the database one page
+    at a time.
+    """
+    after = None
+    while True:
+        issues = issues_page(conn, period, after, page_size)
+        yield from issues
+        if len(issues) < page_size:
+            return
+        after = page_cursor(issues)
 
 
 def all_issues(conn):
+    return list(iter_issues(conn))
+
+
+def issue_by_fingerprint(conn, fingerprint):
+    """
+    Returns the most recent issue built from the inputs with the given
+    fingerprint, or None.
+    """
     cur = conn.cursor()
     raw = cur.execute(
-        "SELECT * FROM issue b INNER JOIN issue_format f on f.issue_id = b.id ORDER BY at DESC"
+        "SELECT * FROM issue b INNER JOIN issue_format f on f.issue_id = b.id WHERE b.id = (SELECT MAX(id) FROM issue WHERE fingerprint = ?)",
+        (fingerprint,),
     ).fetchall()
-    return _post_issues(raw)
+    issues = _post_issues(raw)
+    return issues[0] if issues else None
 
 
 def issues_by_period(conn, period):
+    return list(iter_issues(conn, period))
+
+
+def fts_query(text):
+    """
+    Turns free text into a full text query matching all of its words, so
+    that quotes, dashes and the like in the text are never taken for query
+    syntax.
+    """
+    words = [w.replace('"', '""') for w in text.split()]
+    return " ".join(f'"{w}"' for w in words)
+
+
+def index_stories(conn, stories):
+    """
+    Adds the stories to the full text index. Stories that carry their
+    article and comments text replace what was indexed for them before. The
+    others, whose chapter came from a daily issue or from a cached chapter
+    without text, are only indexed by title when they are missing from the
+    index.
+    """
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        n = 0
+        for story in stories:
+            story_id = int(story["id"])
+            if "article_text" in story:
+                cur.execute("DELETE FROM story_text WHERE rowid = ?", (story_id,))
+            elif cur.execute(
+                "SELECT 1 FROM story_text WHERE rowid = ?", (story_id,)
+            ).fetchone():
+                continue
+            cur.execute(
+                "INSERT INTO story_text (rowid, title, article, comments) VALUES (?, ?, ?, ?)",
+                (
+                    story_id,
+                    story["title"],
+                    story.get("article_text", ""),
+                    story.get("comments_text", ""),
+                ),
+            )
+            n += 1
+        cur.execute("COMMIT")
+        return n
+    except conn.Error as e:
+        log.error(e)
+        cur.execute("ROLLBACK")
+        return 0
+
+
+# matches in titles weigh the most, then the article, then the comments
+SEARCH_RANK = "bm25(story_text, 10.0, 2.0, 1.0)"
+
+
+def search_stories(conn, text, limit=20):
+    """
+    Returns the stories matching the text, best first, each with a snippet of
+    the matching text and the file names of the issues it is in.
+    """
+    query = fts_query(text)
+    if not query:
+        return []
+    cur = conn.cursor()
+    stories = [
+        dict(row)
+        for row in cur.execute(
+            f"SELECT rowid AS story_id, title, snippet(story_text, -1, '[', ']', '…', 16) AS snippet FROM story_text WHERE story_text MATCH ? ORDER BY {SEARCH_RANK} LIMIT ?",
+            (query, limit),
+        ).fetchall()
+    ]
+    files = {story["story_id"]: [] for story in stories}
+    for row in cur.execute(
+        "SELECT si.story_id, f.file_name FROM story_issue si INNER JOIN issue_format f on f.issue_id = si.issue_id WHERE si.story_id IN (SELECT value FROM json_each(?)) ORDER BY si.issue_id",
+        (json.dumps(list(files)),),
+    ).fetchall():
+        files[row["story_id"]].append(row["file_name"])
+    for story in stories:
+        story["files"] = files[story["story_id"]]
+    return stories
+
+
+def search_issues(conn, text, limit=50):
+    """
+    Returns the issues holding the stories that best match the text, ordered
+    by their best matching story. limit bounds the stories looked at.
+    """
+    query = fts_query(text)
+    if not query:
+        return []
     cur = conn.cursor()
     raw = cur.execute(
-        "SELECT * FROM issue b INNER JOIN issue_format f on f.issue_id = b.id WHERE b.period = ? ORDER BY at DESC",
-        (period,),
+        f"SELECT * FROM (SELECT rowid AS story_id, {SEARCH_RANK} AS story_rank FROM story_text WHERE story_text MATCH ? ORDER BY story_rank LIMIT ?) hits INNER JOIN story_issue si on si.story_id = hits.story_id INNER JOIN issue b on b.id = si.issue_id INNER JOIN issue_format f on f.issue_id = b.id ORDER BY hits.story_rank, b.at DESC",
+        (query, limit),
     ).fetchall()
     return _post_issues(raw)
+
+
+ITEM_KEYS = [
+    "id",
+    "type",
+    "by",
+    "time",
+    "parent",
+    "kids",
+    "title",
+    "url",
+    "text",
+    "score",
+    "descendants",
+    "dead",
+    "deleted",
+]
+
+
+def insert_items(cur, items):
+    """
+    Inserts HN items in the firebase item schema, replacing the ones already
+    stored. Must be called inside a transaction.
+    """
+    rows = [
+        (
+            item["id"],
+            item.get("type"),
+            item.get("by"),
+            item.get("time"),
+            item.get("parent"),
+            json.dumps(item["kids"]) if "kids" in item else None,
+            item.get("title"),
+            item.get("url"),
+            item.get("text"),
+            item.get("score"),
+            item.get("descendants"),
+            item.get("dead"),
+            item.get("deleted"),
+        )
+        for item in items
+    ]
+    cur.executemany(
+        "INSERT OR REPLACE INTO hn_item (id, type, by, time, parent, kids, title, url, text, score, descendants, dead, deleted) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+    return len(rows)
+
+
+def get_item(conn, item_id, posted_before=None):
+    """
+    Returns a stored item in the firebase item schema, or None. With
+    posted_before, items posted at or after that unix time count as missing.
+    """
+    cur = conn.cursor()
+    if posted_before is None:
+        row = cur.execute("SELECT * FROM hn_item WHERE id = ?", (item_id,)).fetchone()
+    else:
+        row = cur.execute(
+            "SELECT * FROM hn_item WHERE id = ? AND time < ?", (item_id, posted_before)
+        ).fetchone()
+    if not row:
+        return None
+    item = {k: row[k] for k in ITEM_KEYS if row[k] is not None}
+    if "kids" in item:
+        item["kids"] = json.loads(item["kids"])
+    for flag in ["dead", "deleted"]:
+        if flag in item:
+            item[flag] = bool(item[flag])
+    return item
+
+
+def link_item_kids(conn):
+    """
+    Fills in the kids of the items that were stored without them from the
+    parent links of their children, oldest child first. HN lists kids in its
+    ranked display order, which can't be rebuilt from the items, so replies
+    linked this way read in the order they were posted instead.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE hn_item SET kids = (SELECT json_group_array(id) FROM (SELECT c.id FROM hn_item c WHERE c.parent = hn_item.id ORDER BY c.id)) "
+        "WHERE kids IS NULL AND id IN (SELECT parent FROM hn_item WHERE parent IS NOT NULL)"
+    )
+    return cur.rowcount
+
+
+def record_item_stories(conn, start_time, end_time, at):
+    """
+    Records the metadata of the stored stories posted in [start,end) as if
+    they were fetched from the API.
+    """
+    cur = conn.cursor()
+    cur.execute("BEGIN")
+    try:
+        cur.execute(
+            "INSERT INTO hn_story (story_id, title, author, url, time, score, descendants, updated_at) "
+            "SELECT id, coalesce(title, ''), coalesce(by, ''), CASE WHEN url IS NOT NULL AND text IS NULL THEN url ELSE 'https://news.ycombinator.com/item?id=' || id END, time, coalesce(score, 0), coalesce(descendants, 0), ? "
+            "FROM hn_item WHERE type = 'story' AND time >= ? AND time < ? AND dead IS NOT 1 AND deleted IS NOT 1 "
+            "ON CONFLICT (story_id) DO UPDATE SET title = excluded.title, url = excluded.url, score = excluded.score, descendants = excluded.descendants, updated_at = excluded.updated_at",
+            (at, start_time, end_time),
+        )
+        n = cur.rowcount
+        cur.execute(
+            "INSERT INTO hn_story_snapshot (story_id, at, score, descendants) SELECT story_id, updated_at, score, descendants FROM hn_story WHERE time >= ? AND time < ? AND updated_at = ?",
+            (start_time, end_time, at),
+        )
+        cur.execute("COMMIT")
+    except conn.Error:
+        cur.execute("ROLLBACK")
+        raise
+    return n
+
+
+def derive_best_stories(conn, start_time, end_time, per_day):
+    """
+    Records the per_day highest scoring stored stories of every day in
+    [start,end) as that day's best stories.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        """
+        INSERT OR IGNORE INTO hn_best_story (story_id, day)
+        SELECT id, day FROM (
+            SELECT id, date(time, 'unixepoch') AS day, ROW_NUMBER() OVER (
+                PARTITION BY date(time, 'unixepoch') ORDER BY score DESC, id
+            ) AS rank
+            FROM hn_item
+            WHERE type = 'story' AND time >= ? AND time < ?
+            AND dead IS NOT 1 AND deleted IS NOT 1
+        ) WHERE rank <= ?
+        """,
+        (start_time, end_time, per_day),
+    )
+    return cur.rowcount
+
+
+def daily_issue_files(conn, story_ids):
+    """
+    Returns the epub file name of the most recent daily issue each of the
+    given stories appeared in, keyed by story id.
+    """
+    cur = conn.cursor()
+    files = {}
+    for row in cur.execute(
+        "SELECT si.story_id, f.file_name FROM story_issue si INNER JOIN issue b on b.id = si.issue_id INNER JOIN issue_format f on f.issue_id = b.id WHERE b.period = 'daily' AND f.mimetype = 'application/epub+zip' AND si.story_id IN (SELECT value FROM json_each(?)) ORDER BY b.at ASC",
+        (json.dumps([int(story_id) for story_id in story_ids]),),
+    ).fetchall():
+        files[int(row["story_id"])] = row["file_name"]
+    return files
+
+
+BUILD_JOB_KEYS = [
+    "id",
+    "key",
+    "params",
+    "status",
+    "phase",
+    "done",
+    "total",
+    "file_name",
+    "error",
+    "created_at",
+    "updated_at",
+]
+
+
+def _post_build_job(row):
+    if row is None:
+        return None
+    job = select_keys(row, BUILD_JOB_KEYS)
+    job["params"] = json.loads(job["params"])
+    return job
+
+
+def enqueue_build_job(conn, job_id, key, params, at, reusable):
+    """
+    Returns the job building the issue with the given key, queueing a new one
+    unless a job for the key is queued or running already, or is done and
+    reusable(job) says its epub can be served as it is. The check and the
+    insert are one write transaction, so identical requests arriving at the
+    same time, even in different processes, share a single job.
+    """
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        for row in cur.execute(
+            "SELECT * FROM build_job WHERE key = ? AND status != 'failed' ORDER BY created_at DESC",
+            (key,),
+        ).fetchall():
+            job = _post_build_job(row)
+            if job["status"] != "done" or reusable(job):
+                cur.execute("COMMIT")
+                return job
+        cur.execute(
+            "INSERT INTO build_job (id, key, params, status, created_at, updated_at) VALUES (?, ?, ?, 'queued', ?, ?)",
+            (job_id, key, json.dumps(params), at, at),
+        )
+        job = _post_build_job(
+            cur.execute("SELECT * FROM build_job WHERE id = ?", (job_id,)).fetchone()
+        )
+        cur.execute("COMMIT")
+        return job
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+
+
+def get_build_job(conn, job_id):
+    cur = conn.cursor()
+    return _post_build_job(
+        cur.execute("SELECT * FROM build_job WHERE id = ?", (job_id,)).fetchone()
+    )
+
+
+def claim_build_job(conn, at):
+    """
+    Marks the oldest queued job as running and returns it, or None when the
+    queue is empty.
+    """
+    cur = conn.cursor()
+    # fetching every row finishes the statement, which ends its transaction
+    rows = cur.execute(
+        "UPDATE build_job SET status = 'running', updated_at = ? WHERE id = (SELECT id FROM build_job WHERE status = 'queued' ORDER BY created_at LIMIT 1) RETURNING *",
+        (at,),
+    ).fetchall()
+    return _post_build_job(rows[0]) if rows else None
+
+
+def update_build_job(conn, job_id, at, **fields):
+    assignments = ", ".join(f"{k} = ?" for k in fields)
+    cur = conn.cursor()
+    cur.execute(
+        f"UPDATE build_job SET {assignments}, updated_at = ? WHERE id = ?",
+        list(fields.values()) + [at, job_id],
+    )
+
+
+def expire_build_jobs(conn, before):
+    """
+    Deletes the finished jobs last updated before the given time. Returns the
+    file names of their epubs that no remaining job refers to.
+    """
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE")
+    try:
+        file_names = [
+            row["file_name"]
+            for row in cur.execute(
+                "DELETE FROM build_job WHERE status IN ('done', 'failed') AND updated_at < ? RETURNING file_name",
+                (before,),
+            ).fetchall()
+            if row["file_name"]
+        ]
+        kept = {
+            row["file_name"]
+            for row in cur.execute(
+                "SELECT file_name FROM build_job WHERE file_name IN (SELECT value FROM json_each(?))",
+                (json.dumps(file_names),),
+            ).fetchall()
+        }
+        cur.execute("COMMIT")
+    except Exception:
+        cur.execute("ROLLBACK")
+        raise
+    return sorted(set(file_names) - kept)
+
+
+def requeue_build_jobs(conn, at):
+    """
+    Puts the jobs left running by a runner that went away back in the queue.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        "UPDATE build_job SET status = 'queued', phase = NULL, done = 0, total = 0, updated_at = ? WHERE status = 'running'",
+        (at,),
+    )
+    return cur.rowcount
@@ -1,20 +1,26 @@
-import requests
+import math
 import re
-from datetime import timedelta
+from datetime import datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 from hn2ebook import db
+from hn2ebook import net
 from hn2ebook.misc.log import logger
 
 log = logger.get_logger("hn")
 
+ALGOLIA_URL = "https://hn.algolia.com/api/v1"
+# algolia never returns more than this many hits for one query, however it is
+# paginated, so a time window must hold fewer stories than this
+ALGOLIA_MAX_HITS = 1000
+ALGOLIA_HITS_PER_PAGE = 500
+
 
 def best_story_ids():
-    return requests.get(
-        f"https://hacker-news.firebaseio.com/v0/beststories.json"
-    ).json()
+    return net.get(f"https://hacker-news.firebaseio.com/v0/beststories.json").json()
 
 
-def best_story_ids_daemonology(day):
+def best_story_ids_daemonology(day, request_pool=None):
     """
     Returns the story ids from cperciva's hn daily for the given day
     """
@@ -22,14 +28,51 @@ def best_story_ids_daemonology(day):
 
     date_str = day.strftime("%Y-%m-%d")
     url = f"http://www.daemonology.net/hn-daily/{date_str}.html"
-    response = requests.get(url)
+    response = net.get(url)
     response.raise_for_status()
 
     matches = re.finditer(regex, response.text, re.MULTILINE)
     return [match.group(1) for match in matches]
 
 
-def update_best_stories(conn, day):
+def get_story_metadata(story_id):
+    """
+    Returns the metadata needed to rank a story, or None for deleted or dead
+    items.
+    """
+    response = net.get(f"https://hacker-news.firebaseio.com/v0/item/{story_id}.json")
+    response.raise_for_status()
+    item = response.json()
+    if not item or item.get("deleted") or item.get("dead"):
+        return None
+    url = item.get("url")
+    if not url or "text" in item:
+        url = f"https://news.ycombinator.com/item?id={story_id}"
+    return {
+        "id": item["id"],
+        "title": item.get("title", ""),
+        "author": item.get("by", ""),
+        "url": url,
+        "time": item["time"],
+        "score": item.get("score", 0),
+        "descendants": item.get("descendants", 0),
+    }
+
+
+def record_story_metadata(conn, story_ids, n_workers):
+    """
+    Fetches and records a snapshot of the metadata of the given stories.
+    """
+    if not story_ids:
+        return 0
+    with ThreadPoolExecutor(n_workers) as pool:
+        stories = [s for s in pool.map(get_story_metadata, story_ids) if s]
+    n = db.insert_story_snapshots(conn, stories, datetime.utcnow())
+    log.info("Recorded metadata of %d stories" % n)
+    return n
+
+
+def update_best_stories(conn, day, n_workers):
     """
     Records the best hn stories from the current hn best stories feed for the given day.
     """
@@ -38,81 +81,213 @@ def update_best_stories(conn, day):
     n = db.insert_best_stories(conn, tuples)
 
     log.info("Processed %d stories with %d new entries" % (len(current_story_ids), n))
+    record_story_metadata(conn, current_story_ids, n_workers)
+
 
+def frontpage_ids(url):
+    regex = r"<span class=\"age\"><a href=\"item\?id=(\d+)"
 
-def update_best_stories_daemonology(conn, day):
+    response = net.get(url)
+    # past the last page there is nothing to list, but a 403 or 429 means hn
+    # is rate limiting, which must fail the day rather than empty it
+    if response.status_code in [401, 404, 405]:
+        log.debug(f"encountered {response.status_code} on {url}")
+        return []
+    else:
+        response.raise_for_status()
+
+    matches = re.finditer(regex, response.text, re.MULTILINE)
+    return [match.group(1) for match in matches]
+
+
+def best_story_ids_frontpage(day, request_pool=None, pages=3):
     """
-    Records the best hn stories from cperciva's hn daily for the given day.
+    Returns the story ids from hn's /front for the given day. The pages are
+    fetched on the request pool when one is given.
     """
-    story_ids = best_story_ids_daemonology(day)
-    tuples = [(item_id, day) for item_id in story_ids]
-    db.insert_best_stories(conn, tuples)
+    date_str = day.strftime("%Y-%m-%d")
+    urls = [
+        f"https://news.ycombinator.com/front?day={date_str}&p={page}"
+        for page in range(1, pages + 2)
+    ]
+    mapper = request_pool.map if request_pool else map
+    ids = set()
+    for page_ids in mapper(frontpage_ids, urls):
+        ids.update(page_ids)
+    return list(ids)
 
 
-def backfill_daemonology(conn, start_date, end_date):
+def fetch_day(source, day, request_pool, algolia_url):
     """
-    Backfills the best stories of the day  between [start,end) using cperciva's daily best feed.
+    Returns the best story ids of a day from the source, along with the
+    metadata of the stories.
     """
+    if source == "algolia":
+        stories = best_stories_algolia(day, request_pool, algolia_url)
+        return [story["id"] for story in stories], stories
+    story_ids = backfill_sources[source](day, request_pool)
+    stories = [s for s in request_pool.map(get_story_metadata, story_ids) if s]
+    return story_ids, stories
+
+
+def backfill(
+    conn,
+    source,
+    start_date,
+    end_date,
+    n_days,
+    n_requests,
+    batch_size=30,
+    algolia_url=ALGOLIA_URL,
+):
+    """
+    Backfills the best stories of every day between [start,end) from the
+    source. n_days days are fetched concurrently, sharing a pool of
+    n_requests http requests. Completed days are checkpointed in batches of
+    batch_size, together with their stories, and skipped on later runs.
+    Returns the number of days that failed.
+    """
+    done = db.completed_backfill_days(conn, source, start_date, end_date)
+    days = []
     current = start_date
     while current < end_date:
-        log.info(f"backfill from daemonology {current}")
-        update_best_stories_daemonology(conn, current)
+        if str(current) not in done:
+            days.append(current)
         current = current + timedelta(days=1)
+    log.info(
+        "backfilling %d days from %s, %d already done" % (len(days), source, len(done))
+    )
+
+    failed = 0
+    batch = []
+    with ThreadPoolExecutor(n_requests) as request_pool, ThreadPoolExecutor(
+        n_days
+    ) as day_pool:
+        futures = {
+            day_pool.submit(fetch_day, source, day, request_pool, algolia_url): day
+            for day in days
+        }
+        for future in as_completed(futures):
+            day = futures[future]
+            try:
+                story_ids, stories = future.result()
+            except Exception as e:
+                log.error(f"backfill from {source} {day} failed: {e}")
+                failed += 1
+                continue
+            if not story_ids:
+                # not checkpointed, so the day is tried again on the next run
+                log.error(f"backfill from {source} {day} found no stories")
+                failed += 1
+                continue
+            log.info(f"backfill from {source} {day}: {len(story_ids)} stories")
+            batch.append((day, story_ids, stories))
+            if len(batch) >= batch_size:
+                db.insert_backfilled_days(conn, source, batch, datetime.utcnow())
+                batch = []
+        if batch:
+            db.insert_backfilled_days(conn, source, batch, datetime.utcnow())
+    return failed
 
 
-def best_story_ids_frontpage(day, pages=3):
+def algolia_search(algolia_url, tags, start, end, page=0, hits_per_page=0):
     """
-    Returns the story ids from hn's /front for the given day
+    Searches the stories with the given tags created in [start,end), start
+    and end being unix timestamps.
     """
-    regex = r"<span class=\"age\"><a href=\"item\?id=(\d+)"
+    params = {
+        "tags": tags,
+        "numericFilters": f"created_at_i>={start},created_at_i<{end}",
+        "page": page,
+        "hitsPerPage": hits_per_page,
+    }
+    response = net.get(f"{algolia_url}/search_by_date", params=params)
+    response.raise_for_status()
+    return response.json()
 
-    date_str = day.strftime("%Y-%m-%d")
-    ids = set()
-    for page in range(pages + 1):
-        url = f"https://news.ycombinator.com/front?day={date_str}?pg={page}"
-        response = requests.get(url)
-        if response.status_code in [401, 403, 404, 405]:
-            log.debug("encountered {response.status_code} on {url}")
-            continue
-        else:
-            response.raise_for_status()
-
-        matches = re.finditer(regex, response.text, re.MULTILINE)
-        page_ids = [match.group(1) for match in matches]
-        ids.update(page_ids)
-    return list(ids)
+
+def algolia_windows(algolia_url, tags, start, end):
+    """
+    Splits [start,end) into time windows that each hold few enough stories
+    for all of them to be paged through. Returns (start, end, hits) tuples.
+    """
+    hits = algolia_search(algolia_url, tags, start, end)["nbHits"]
+    if hits < ALGOLIA_MAX_HITS or end - start <= 1:
+        return [(start, end, hits)]
+    middle = (start + end) // 2
+    return algolia_windows(algolia_url, tags, start, middle) + algolia_windows(
+        algolia_url, tags, middle, end
+    )
 
 
-def update_best_stories_frontpage(conn, day):
+def algolia_hits_in_range(algolia_url, tags, start, end, request_pool):
     """
-    Records the best hn stories from /front
+    Returns all the stories with the given tags created in [start,end) as
+    algolia hits, deduplicated and sorted by creation time. The pages of all
+    windows are fetched on the request pool.
     """
-    story_ids = best_story_ids_frontpage(day)
-    tuples = [(item_id, day) for item_id in story_ids]
-    db.insert_best_stories(conn, tuples)
+    pages = [
+        (window_start, window_end, page)
+        for window_start, window_end, hits in algolia_windows(
+            algolia_url, tags, start, end
+        )
+        for page in range(math.ceil(hits / ALGOLIA_HITS_PER_PAGE))
+    ]
+    results = request_pool.map(
+        lambda p: algolia_search(
+            algolia_url, tags, p[0], p[1], p[2], ALGOLIA_HITS_PER_PAGE
+        ),
+        pages,
+    )
+    hits = {}
+    for result in results:
+        for hit in result["hits"]:
+            hits[hit["objectID"]] = hit
+    return sorted(hits.values(), key=lambda hit: hit["created_at_i"])
+
+
+def hit_to_story_metadata(hit):
+    story_id = int(hit["objectID"])
+    url = hit.get("url") or f"https://news.ycombinator.com/item?id={story_id}"
+    return {
+        "id": story_id,
+        "title": hit.get("title") or "",
+        "author": hit.get("author") or "",
+        "url": url,
+        "time": hit["created_at_i"],
+        "score": hit.get("points") or 0,
+        "descendants": hit.get("num_comments") or 0,
+    }
 
 
-def backfill_frontpage(conn, start_date, end_date):
+def day_timestamps(day):
+    start = datetime(day.year, day.month, day.day, tzinfo=timezone.utc)
+    return int(start.timestamp()), int((start + timedelta(days=1)).timestamp())
+
+
+def best_stories_algolia(day, request_pool, algolia_url):
     """
-    Backfills the best stories of the day  between [start,end) using the /front hn feature
+    Returns the metadata of the stories created on the given day that made it
+    to the front page, according to algolia.
     """
-    current = start_date
-    while current < end_date:
-        log.info(f"backfill from /front {current}")
-        update_best_stories_frontpage(conn, current)
-        current = current + timedelta(days=1)
+    start, end = day_timestamps(day)
+    hits = algolia_hits_in_range(algolia_url, "front_page", start, end, request_pool)
+    return [hit_to_story_metadata(hit) for hit in hits]
 
 
-def story_ids_in_range(start, end):
+def story_ids_in_range(start, end, algolia_url=ALGOLIA_URL, n_requests=5):
     """
-    Returns a list of story ids storyed in the interval [start,end) sorted by story date. start and end are numeric timestamps.
+    Returns a list of story ids storyed in the interval [start,end) sorted by story date. start and end are datetimes.
     """
-    start = datetime.timestamp(start)
-    end = datetime.timestamp(end)
+    start = int(datetime.timestamp(start))
+    end = int(datetime.timestamp(end))
     tags = "(story,show_hn,ask_hn)"
-    url = f"https://hn.algolia.com/api/v1/search?tags={tags}&numericFilters=created_at_i>={start},created_at_i<{end}"
-    response = requests.get(url)
-    response.raise_for_status()
-    payload = response.json()
-    sorted_hits = sorted(payload["hits"], key=lambda k: k["created_at_i"])
-    return [hit["objectID"] for hit in sorted_hits]
+    with ThreadPoolExecutor(n_requests) as request_pool:
+        hits = algolia_hits_in_range(algolia_url, tags, start, end, request_pool)
+    return [hit["objectID"] for hit in hits]
+
+
+backfill_sources = {
+    "/front": best_story_ids_frontpage,
+    "daemonology": best_story_ids_daemonology,
+}
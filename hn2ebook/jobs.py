@@ -0,0 +1,312 @@
+import os
+import json
+import time
+import signal
+import hashlib
+import traceback
+from uuid import uuid4
+from pathlib import Path
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import jsonify, request, url_for
+
+from hn2ebook import cache
+from hn2ebook import commands
+from hn2ebook import core
+from hn2ebook import db
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("jobs")
+
+CRITERIA = ["time", "time-reverse", "points", "total-comments"]
+MAX_STORIES = 300
+MAX_DAYS = 93
+MAX_LIMIT = 50
+# how often an idle runner looks for queued jobs, in seconds
+POLL_INTERVAL = 1.0
+# how often the runner removes expired builds, in seconds
+EVICT_INTERVAL = 3600
+
+
+def normalize_params(params):
+    """
+    Validates the parameters of a build request and returns them in a
+    canonical form, so requests for the same issue get the same key. Raises
+    ValueError on invalid parameters.
+    """
+    if not isinstance(params, dict):
+        raise ValueError("the request must be a json object")
+    criteria = params.get("criteria", "points")
+    if criteria not in CRITERIA:
+        raise ValueError(f"criteria must be one of {', '.join(CRITERIA)}")
+
+    if "story_ids" in params:
+        try:
+            story_ids = sorted({int(story_id) for story_id in params["story_ids"]})
+        except (TypeError, ValueError):
+            raise ValueError("story_ids must be a list of story ids")
+        if not 0 < len(story_ids) <= MAX_STORIES:
+            raise ValueError(f"between 1 and {MAX_STORIES} story ids are needed")
+        return {"story_ids": story_ids, "criteria": criteria}
+
+    try:
+        start = date.fromisoformat(params["start"])
+        end = date.fromisoformat(params["end"])
+        limit = int(params.get("limit", 10))
+    except (KeyError, TypeError, ValueError):
+        raise ValueError(
+            "either story_ids, or start and end as YYYY-MM-DD dates are needed"
+        )
+    if not 0 < (end - start).days <= MAX_DAYS:
+        raise ValueError(f"the range must span 1 to {MAX_DAYS} days")
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValueError(f"limit must be between 1 and {MAX_LIMIT}")
+    return {"start": str(start), "end": str(end), "limit": limit, "criteria": criteria}
+
+
+def build_key(cfg, params):
+    """
+    Returns the key of the issue built from normalized parameters. The
+    renderer is part of it, so epubs built by an older renderer are not
+    served.
+    """
+    payload = json.dumps(
+        [params, cache.renderer_fingerprint(cfg)], sort_keys=True
+    ).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:32]
+
+
+def build_path(cfg, file_name):
+    return Path(cfg["data_dir"]).joinpath("builds", file_name)
+
+
+def submit(cfg, conn, params):
+    """
+    Returns the job building the issue for the request parameters, which is
+    an earlier job when the same issue is queued, being built, or built
+    already and its epub is still there.
+    """
+    params = normalize_params(params)
+    key = build_key(cfg, params)
+
+    def reusable(job):
+        return job["file_name"] and build_path(cfg, job["file_name"]).is_file()
+
+    job = db.enqueue_build_job(
+        conn, str(uuid4()), key, params, datetime.utcnow(), reusable
+    )
+    log.info(f"build request {params} is job {job['id']} ({job['status']})")
+    return job
+
+
+def build_issue(cfg, job, progress):
+    """
+    Builds the epub of a job into the builds dir and returns its file name.
+    Stories that appeared in a daily issue are copied out of it. A build
+    with the same parameters left unfinished by an earlier job is resumed.
+    """
+    store = commands.open_build(cfg, "job", job["params"], build_id=job["id"])
+    try:
+        file_name = build_into(cfg, job, store, progress)
+    except Exception:
+        commands.report_failed_build(store)
+        raise
+    store.remove()
+    return file_name
+
+
+def build_into(cfg, job, store, progress):
+    params = job["params"]
+    now = datetime.utcnow()
+    core.use_local_items(cfg["db_path"])
+    progress("resolving", 0, 0)
+    if "story_ids" in params:
+        story_ids = [str(story_id) for story_id in params["story_ids"]]
+        creation_params = {"story_ids": story_ids, "criteria": params["criteria"]}
+        stories = core.resolve_stories(
+            cfg,
+            story_ids,
+            MAX_STORIES,
+            params["criteria"],
+            store,
+            progress=lambda n, total: progress("resolving", n, total),
+        )
+    else:
+        start = datetime.fromisoformat(params["start"])
+        end = datetime.fromisoformat(params["end"])
+        creation_params = {"start": start, "end": end}
+        conn = db.connect(cfg["db_path"])
+        chosen_stories = store.chosen()
+        if chosen_stories is None:
+            chosen_stories = commands.stories_for_range(
+                cfg, conn, [start, end], params["limit"], params["criteria"]
+            )
+        if not chosen_stories:
+            raise ValueError("no stories were found in the range")
+        stories = commands.collect_stories(
+            cfg,
+            conn,
+            chosen_stories,
+            store,
+            compose=True,
+            progress=lambda n, total: progress("resolving", n, total),
+        )
+
+    progress("building", len(stories), len(stories))
+    meta = commands.issue_meta(
+        stories.summaries(), creation_params, commands.isoformat(now), job["id"]
+    )
+    file_name = f"hn2ebook-{job['key']}.epub"
+    out_path = build_path(cfg, file_name)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    # built under a temporary name, so a half written epub is never served
+    tmp_path = out_path.with_name(f".{job['id']}.epub")
+    core.epub_from_stories(cfg, stories, meta, tmp_path)
+    tmp_path.replace(out_path)
+    return file_name
+
+
+def evict_builds(cfg, conn):
+    """
+    Removes the jobs that finished more than build_max_age_days ago, along
+    with their epubs, and the epubs of builds that were interrupted before
+    then. Returns the number of epubs removed.
+    """
+    now = datetime.utcnow()
+    before = now - timedelta(days=cfg["build_max_age_days"])
+    paths = [build_path(cfg, name) for name in db.expire_build_jobs(conn, before)]
+    # the temporary files of builds whose runner went away
+    paths.extend(
+        path
+        for path in build_path(cfg, "").glob(".*.epub")
+        if datetime.utcfromtimestamp(path.stat().st_mtime) < before
+    )
+    n = 0
+    for path in paths:
+        try:
+            path.unlink()
+            n += 1
+        except FileNotFoundError:
+            pass
+    if n:
+        log.info(f"removed {n} builds older than {cfg['build_max_age_days']} days")
+    return n
+
+
+def run_job(cfg, job):
+    conn = db.connect(cfg["db_path"])
+
+    def progress(phase, done, total):
+        db.update_build_job(
+            conn, job["id"], datetime.utcnow(), phase=phase, done=done, total=total
+        )
+
+    log.info(f"running build job {job['id']} {job['params']}")
+    try:
+        file_name = build_issue(cfg, job, progress)
+    except Exception as e:
+        log.error(f"build job {job['id']} failed: {e}")
+        log.debug(traceback.format_exc())
+        db.update_build_job(
+            conn, job["id"], datetime.utcnow(), status="failed", error=str(e)
+        )
+        return
+    db.update_build_job(
+        conn,
+        job["id"],
+        datetime.utcnow(),
+        status="done",
+        phase=None,
+        file_name=file_name,
+    )
+    log.info(f"build job {job['id']} done: {file_name}")
+
+
+def run_jobs(cfg, n_jobs):
+    """
+    Runs the queued build jobs, n_jobs at a time, forever, and removes the
+    expired builds every EVICT_INTERVAL. There must be a single runner per
+    database: jobs left running by an earlier runner are queued again when
+    it starts.
+    """
+    # ctrl-c reaches the whole process group, the server stops the runner
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    conn = db.connect(cfg["db_path"])
+    n = db.requeue_build_jobs(conn, datetime.utcnow())
+    if n:
+        log.info(f"requeued {n} interrupted build jobs")
+    running = set()
+    evicted_at = 0
+    with ThreadPoolExecutor(n_jobs) as pool:
+        while True:
+            if time.monotonic() - evicted_at > EVICT_INTERVAL:
+                evict_builds(cfg, conn)
+                evicted_at = time.monotonic()
+            running = {future for future in running if not future.done()}
+            while len(running) < n_jobs:
+                job = db.claim_build_job(conn, datetime.utcnow())
+                if not job:
+                    break
+                running.add(pool.submit(run_job, cfg, job))
+            time.sleep(POLL_INTERVAL)
+
+
+def start_runner(cfg, n_jobs):
+    """
+    Forks a process running the build jobs and returns its pid.
+
+    It is forked with os.fork rather than multiprocessing: the gunicorn
+    workers are forked later from the same process, and would inherit the
+    runner as a multiprocessing child that they try to join when they exit.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_jobs(cfg, n_jobs)
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(1)
+    log.info(f"running build jobs in process {pid}")
+    return pid
+
+
+def stop_runner(pid):
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+
+
+def job_to_json(job):
+    result = {
+        "id": job["id"],
+        "status": job["status"],
+        "params": job["params"],
+        "progress": {"phase": job["phase"], "done": job["done"], "total": job["total"]},
+        "status_url": url_for("serve_job", job_id=job["id"]),
+    }
+    if job["status"] == "done":
+        result["result_url"] = f"/builds/{job['file_name']}"
+    if job["status"] == "failed":
+        result["error"] = job["error"]
+    return result
+
+
+@core.app.route("/jobs", methods=["POST"])
+def create_job():
+    cfg = core.app.config["hn2ebook"]
+    try:
+        job = submit(cfg, db.connect(cfg["db_path"]), request.get_json(silent=True))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    status = 200 if job["status"] == "done" else 202
+    return jsonify(job_to_json(job)), status, {"Location": f"/jobs/{job['id']}"}
+
+
+@core.app.route("/jobs/<job_id>")
+def serve_job(job_id):
+    cfg = core.app.config["hn2ebook"]
+    job = db.get_build_job(db.connect(cfg["db_path"]), job_id)
+    if not job:
+        return jsonify({"error": f"no job {job_id}"}), 404
+    return jsonify(job_to_json(job))
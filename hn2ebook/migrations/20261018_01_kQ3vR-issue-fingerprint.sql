@@ -0,0 +1,7 @@
+-- issue fingerprint
+-- depends: 20210407_01_nEsUF-first-migration
+
+alter table issue add column fingerprint text;
+
+create index issue_fingerprint_index
+	on issue (fingerprint);
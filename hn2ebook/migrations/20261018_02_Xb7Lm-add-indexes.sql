@@ -0,0 +1,20 @@
+-- add indexes
+-- depends: 20261018_01_kQ3vR-issue-fingerprint
+
+create index hn_best_story_day_index
+	on hn_best_story (day);
+
+create index issue_format_issue_id_index
+	on issue_format (issue_id);
+
+create index story_issue_story_id_index
+	on story_issue (story_id);
+
+create index story_issue_issue_id_index
+	on story_issue (issue_id);
+
+-- covers lookups by period alone as well
+drop index issue_period_index;
+
+create index issue_period_at_index
+	on issue (period, at);
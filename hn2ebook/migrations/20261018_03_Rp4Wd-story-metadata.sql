@@ -0,0 +1,31 @@
+-- story metadata
+-- depends: 20261018_02_Xb7Lm-add-indexes
+
+create table hn_story
+(
+	story_id integer not null
+		constraint hn_story_pk
+			primary key,
+	title text not null,
+	author text not null,
+	url text not null,
+	time integer not null,
+	score integer not null,
+	descendants integer not null,
+	updated_at datetime not null
+);
+
+create index hn_story_time_index
+	on hn_story (time);
+
+create table hn_story_snapshot
+(
+	story_id integer not null
+		references hn_story,
+	at datetime not null,
+	score integer not null,
+	descendants integer not null
+);
+
+create index hn_story_snapshot_story_id_index
+	on hn_story_snapshot (story_id, at);
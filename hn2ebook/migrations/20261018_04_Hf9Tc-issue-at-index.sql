@@ -0,0 +1,5 @@
+-- issue at index
+-- depends: 20261018_03_Rp4Wd-story-metadata
+
+create index issue_at_index
+	on issue (at, id);
@@ -0,0 +1,12 @@
+-- backfill checkpoint
+-- depends: 20261018_04_Hf9Tc-issue-at-index
+
+create table backfill_checkpoint
+(
+	source text not null,
+	day date not null,
+	num_stories integer not null,
+	at datetime not null,
+	constraint backfill_checkpoint_pk
+		primary key (source, day)
+);
@@ -0,0 +1,27 @@
+-- hn item
+-- depends: 20261018_05_Wm2Qa-backfill-checkpoint
+
+create table hn_item
+(
+	id integer not null
+		constraint hn_item_pk
+			primary key,
+	type text,
+	by text,
+	time integer,
+	parent integer,
+	kids text,
+	title text,
+	url text,
+	text text,
+	score integer,
+	descendants integer,
+	dead integer,
+	deleted integer
+);
+
+create index hn_item_parent_index
+	on hn_item (parent);
+
+create index hn_item_type_time_index
+	on hn_item (type, time);
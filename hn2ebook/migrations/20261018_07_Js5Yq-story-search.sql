@@ -0,0 +1,17 @@
+-- story search
+-- depends: 20261018_06_Tn8Ke-hn-item
+
+create virtual table story_text using fts5
+(
+	title,
+	article,
+	comments,
+	tokenize = 'porter unicode61 remove_diacritics 2'
+);
+
+-- the text of the stories of earlier issues is gone, but their titles can
+-- still be found
+insert into story_text (rowid, title, article, comments)
+	select s.story_id, s.title, '', ''
+	from hn_story s
+	where s.story_id in (select story_id from story_issue);
@@ -0,0 +1,25 @@
+-- build job
+-- depends: 20261018_07_Js5Yq-story-search
+
+create table build_job
+(
+	id text not null
+		constraint build_job_pk
+			primary key,
+	key text not null,
+	params text not null,
+	status text not null,
+	phase text,
+	done integer not null default 0,
+	total integer not null default 0,
+	file_name text,
+	error text,
+	created_at datetime not null,
+	updated_at datetime not null
+);
+
+create index build_job_key_index
+	on build_job (key, created_at);
+
+create index build_job_status_index
+	on build_job (status, created_at);
@@ -54,3 +54,13 @@ def explain_errors(errors, log):
 def is_dir(field, value, error):
     if not os.path.isdir(value):
         error(field, f"Must be an existing directory ({value})")
+
+
+def is_cron_spec(field, value, error):
+    from hn2ebook import schedule
+
+    if value:
+        try:
+            schedule.parse_cron(value)
+        except ValueError as e:
+            error(field, str(e))
@@ -0,0 +1,22 @@
+import os
+import threading
+
+import requests
+
+_local = threading.local()
+
+
+def session():
+    """
+    Returns the http session of the calling thread, so the connections to
+    the HN API are kept alive from one request to the next. Sessions are not
+    shared between threads, nor with the processes forked by a pool.
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.session = requests.Session()
+    return _local.session
+
+
+def get(url, **kwargs):
+    return session().get(url, **kwargs)
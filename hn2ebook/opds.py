@@ -0,0 +1,312 @@
+import re
+import html
+import hashlib
+import urllib.parse
+from datetime import datetime, timezone
+
+from flask import Response, abort, request
+
+from hn2ebook import __version__
+from hn2ebook import core
+from hn2ebook import db
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("opds")
+
+# the feed pages rendered by the server, by url, along with the version of
+# the issues they were rendered from. A page is its compressed variants, etag
+# and last modification time
+rendered_pages = {}
+
+FEEDS = [
+    {
+        "period": "daily",
+        "name": "Hacker News Daily",
+        "url": f"/daily.xml",
+        "up_url": f"/index.xml",
+        "start_url": f"/index.xml",
+        "content": "Daily periodicals of the best stories on Hacker News",
+    },
+    {
+        "period": "weekly",
+        "name": "Hacker News Weekly",
+        "url": f"/weekly.xml",
+        "up_url": f"/index.xml",
+        "start_url": f"/index.xml",
+        "content": "Weekly periodicals of the best stories on Hacker News",
+    },
+    {
+        "period": "monthly",
+        "name": "Hacker News Monthly",
+        "url": f"/monthly.xml",
+        "up_url": f"/index.xml",
+        "start_url": f"/index.xml",
+        "content": "Monthly periodicals of the best stories on Hacker News",
+    },
+]
+
+
+def instance_for(cfg):
+    return {
+        "root_url": cfg["root_url"],
+        "name": cfg["instance_name"],
+        "url": "/index.xml",
+    }
+
+
+def server_instance(cfg):
+    """
+    The instance as the server presents it. Only the server can answer
+    searches, so only the feeds it renders link to the search.
+    """
+    return dict(
+        instance_for(cfg),
+        search_url="/opensearch.xml",
+        search_results_url="/search.xml",
+    )
+
+
+def feed_for(period):
+    for feed in FEEDS:
+        if feed["period"] == period:
+            return feed
+    return None
+
+
+def page_url(feed, page):
+    """
+    The head of a feed (page None) lives at the feed url, the archive pages
+    next to it, numbered from the oldest.
+    """
+    if page is None:
+        return feed["url"]
+    return "%s-%d.xml" % (feed["url"][: -len(".xml")], page)
+
+
+def page_layout(n_issues, page_size):
+    """
+    Returns (number of archive pages, number of issues in the head).
+
+    Archive page k holds the issues k*page_size-page_size+1 to k*page_size,
+    counting from the oldest, and never changes once written. The head holds
+    the newest 1 to page_size issues, so a new issue only ever touches the
+    head, and when it overflows, the archive page it spills into.
+    """
+    n_pages = max(0, (n_issues - 1) // page_size)
+    return n_pages, n_issues - n_pages * page_size
+
+
+def feed_page(feed, page, n_pages):
+    """
+    Returns the feed description of one page, with its navigation links.
+    """
+    newer = None if page is None else (None if page == n_pages else page + 1)
+    older = n_pages if page is None else page - 1
+    return dict(
+        feed,
+        url=page_url(feed, page),
+        first_url=page_url(feed, None),
+        last_url=page_url(feed, 1) if n_pages else page_url(feed, None),
+        prev_url=page_url(feed, newer) if page is not None else None,
+        next_url=page_url(feed, older) if older else None,
+    )
+
+
+def write_page(cfg, instance, feed, page, n_pages, issues):
+    core.generate_opds(cfg, instance, feed_page(feed, page, n_pages), issues)
+
+
+def generate_feed(cfg, conn, instance, feed):
+    """
+    Writes every page of a feed, reading the issues one page at a time.
+    """
+    page_size = cfg["opds_page_size"]
+    n_pages, head_size = page_layout(db.count_issues(conn, feed["period"]), page_size)
+    pages = [(None, head_size)] + [(page, page_size) for page in range(n_pages, 0, -1)]
+    after = None
+    for page, size in pages:
+        issues = db.issues_page(conn, feed["period"], after, size)
+        write_page(cfg, instance, feed, page, n_pages, issues)
+        if issues:
+            after = db.page_cursor(issues)
+
+
+def generate_all(cfg, conn):
+    instance = instance_for(cfg)
+    for feed in FEEDS:
+        generate_feed(cfg, conn, instance, feed)
+    core.generate_opds_index(cfg, instance, FEEDS)
+
+
+def update_feed(cfg, conn, period, full=False):
+    """
+    Brings the feed of a period up to date after a new issue was added,
+    rewriting the head and, when the head overflowed, the archive page it
+    spilled into and the one before it, whose newer link changes. A feed
+    that was never written, or with full, is written in full.
+    """
+    feed = feed_for(period)
+    if not feed:
+        return
+    instance = instance_for(cfg)
+    if full or not core.feed_path(cfg, feed["url"]).is_file():
+        log.info(f"writing all pages of {feed['url']}")
+        generate_feed(cfg, conn, instance, feed)
+        if not core.feed_path(cfg, instance["url"]).is_file():
+            core.generate_opds_index(cfg, instance, FEEDS)
+        return
+
+    page_size = cfg["opds_page_size"]
+    n_pages, head_size = page_layout(db.count_issues(conn, period), page_size)
+    head = db.issues_page(conn, period, None, head_size)
+    write_page(cfg, instance, feed, None, n_pages, head)
+    if head_size != 1 or n_pages == 0:
+        return
+
+    after = db.page_cursor(head)
+    for page in [n_pages, n_pages - 1]:
+        if page < 1:
+            break
+        issues = db.issues_page(conn, period, after, page_size)
+        write_page(cfg, instance, feed, page, n_pages, issues)
+        after = db.page_cursor(issues)
+
+
+def parse_feed_url(url):
+    """
+    Returns the (feed, page) a url points to, or None when it is no feed page.
+    """
+    match = re.match(r"^(/[a-z]+)(?:-(\d+))?\.xml$", url)
+    if not match:
+        return None
+    for feed in FEEDS:
+        if feed["url"] == f"{match.group(1)}.xml":
+            page = match.group(2)
+            return feed, int(page) if page else None
+    return None
+
+
+def render_page(cfg, conn, instance, feed, page, updated=None):
+    """
+    Renders one page of a feed straight from the database, or returns None
+    when the feed has no such page.
+    """
+    page_size = cfg["opds_page_size"]
+    n_pages, head_size = page_layout(db.count_issues(conn, feed["period"]), page_size)
+    if page is None:
+        offset, limit = 0, head_size
+    elif 1 <= page <= n_pages:
+        offset, limit = head_size + (n_pages - page) * page_size, page_size
+    else:
+        return None
+    issues = db.issues_page(conn, feed["period"], limit=limit, offset=offset)
+    chunks = core.render_opds(instance, feed_page(feed, page, n_pages), issues, updated)
+    return "".join(chunks).encode("utf-8")
+
+
+def page_validators(url, version):
+    """
+    Returns the etag and last modification time of the page at url rendered
+    from the given version of the issues. They only depend on the database,
+    so every server process hands out the same validators for a page.
+    """
+    last_id, newest_at = version
+    payload = f"{__version__}:{url}:{last_id}:{newest_at}".encode("utf-8")
+    if newest_at:
+        last_modified = datetime.fromisoformat(str(newest_at))
+    else:
+        last_modified = datetime(1970, 1, 1)
+    return hashlib.sha1(payload).hexdigest(), last_modified.replace(microsecond=0)
+
+
+def cached_page(cfg, conn, url):
+    """
+    Returns the rendered feed page at url, or None when there is no such
+    page. Pages are rendered and compressed once, and served from memory until
+    a new issue row appears.
+    """
+    version = db.issues_version(conn)
+    cached = rendered_pages.get(url)
+    if cached and cached[0] == version:
+        return cached[1]
+
+    etag, last_modified = page_validators(url, version)
+    instance = server_instance(cfg)
+    if url == instance["url"]:
+        xml = core.render_opds_index(instance, FEEDS, last_modified).encode("utf-8")
+    else:
+        parsed = parse_feed_url(url)
+        if not parsed:
+            return None
+        xml = render_page(cfg, conn, instance, *parsed, last_modified)
+        if xml is None:
+            return None
+    log.debug(f"rendered {url}")
+    page = {
+        "variants": core.compress_variants(xml),
+        "etag": etag,
+        "last_modified": last_modified.replace(tzinfo=timezone.utc),
+    }
+    rendered_pages[url] = (version, page)
+    return page
+
+
+@core.app.route("/<name>.xml")
+def serve_feed(name):
+    cfg = core.app.config.get("hn2ebook")
+    url = f"/{name}.xml"
+    if not cfg or (url != "/index.xml" and not parse_feed_url(url)):
+        return core.serve_resource(url[1:])
+    page = cached_page(cfg, db.connect(cfg["db_path"]), url)
+    if page is None:
+        abort(404)
+
+    encoding = core.accepted_encoding(page["variants"])
+    body = page["variants"][encoding]
+    response = Response(
+        body,
+        mimetype="application/atom+xml;profile=opds-catalog;kind=navigation",
+    )
+    # every encoding is a different representation, with its own strong etag
+    response.set_etag(f"{page['etag']}-{encoding}" if encoding else page["etag"])
+    response.last_modified = page["last_modified"]
+    response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.cache_control.no_cache = True
+    return response.make_conditional(
+        request, accept_ranges=True, complete_length=len(body)
+    )
+
+
+@core.app.route("/opensearch.xml")
+def serve_opensearch():
+    cfg = core.app.config.get("hn2ebook")
+    if not cfg:
+        abort(404)
+    return Response(
+        core.render_opensearch(server_instance(cfg)),
+        mimetype="application/opensearchdescription+xml",
+    )
+
+
+@core.app.route("/search.xml")
+def serve_search():
+    """
+    Answers a search with a feed of the issues holding the matching stories.
+    """
+    cfg = core.app.config.get("hn2ebook")
+    if not cfg:
+        abort(404)
+    text = request.args.get("q", "")
+    issues = db.search_issues(db.connect(cfg["db_path"]), text)
+    instance = server_instance(cfg)
+    feed = {
+        "name": f"Search results for {html.escape(text)}",
+        "url": f"{instance['search_results_url']}?q={urllib.parse.quote(text)}",
+        "up_url": instance["url"],
+        "start_url": instance["url"],
+    }
+    return Response(
+        "".join(core.render_opds(instance, feed, issues)),
+        mimetype="application/atom+xml;profile=opds-catalog;kind=acquisition",
+    )
@@ -0,0 +1,82 @@
+from datetime import timedelta
+
+# the fields of a cron spec, with the range of their values
+CRON_FIELDS = [
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    # 0 and 7 are both sunday
+    ("weekday", 0, 7),
+]
+
+
+def parse_field(field, low, high):
+    values = set()
+    for part in field.split(","):
+        part, _, step = part.partition("/")
+        step = int(step) if step else 1
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start, end = [int(v) for v in part.split("-")]
+        else:
+            start = int(part)
+            end = high if step > 1 else start
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"{field} is out of range {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+def parse_cron(spec):
+    """
+    Parses a cron spec of five fields: minute, hour, day of month, month and
+    day of week (0 or 7 is sunday). Fields are *, numbers, ranges a-b, steps
+    */n or a-b/n, and lists of those. Raises ValueError on invalid specs.
+    """
+    fields = spec.split()
+    if len(fields) != len(CRON_FIELDS):
+        raise ValueError(f"cron spec '{spec}' needs {len(CRON_FIELDS)} fields")
+    try:
+        parsed = {
+            name: parse_field(field, low, high)
+            for field, (name, low, high) in zip(fields, CRON_FIELDS)
+        }
+    except ValueError as e:
+        raise ValueError(f"invalid cron spec '{spec}': {e}")
+    parsed["weekday"] = {day % 7 for day in parsed["weekday"]}
+    # like cron, when both the day of month and the day of week are
+    # restricted, a day matching either of them matches. A field starting
+    # with * (*/2 too) doesn't count as restricted
+    parsed["any_day"] = fields[2].startswith("*") or fields[4].startswith("*")
+    return parsed
+
+
+def day_matches(cron, dt):
+    if dt.month not in cron["month"]:
+        return False
+    day = dt.day in cron["day"]
+    weekday = (dt.weekday() + 1) % 7 in cron["weekday"]
+    return (day and weekday) if cron["any_day"] else (day or weekday)
+
+
+def next_run(cron, after):
+    """
+    Returns the first minute strictly after the datetime after that matches
+    the cron spec.
+    """
+    dt = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    # any valid spec matches within a few years, days and hours that can not
+    # match are skipped whole
+    limit = dt + timedelta(days=5 * 366)
+    while dt < limit:
+        if not day_matches(cron, dt):
+            dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+        elif dt.hour not in cron["hour"]:
+            dt = (dt + timedelta(hours=1)).replace(minute=0)
+        elif dt.minute not in cron["minute"]:
+            dt += timedelta(minutes=1)
+        else:
+            return dt
+    raise ValueError("the cron spec never matches")
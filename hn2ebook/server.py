@@ -0,0 +1,48 @@
+import multiprocessing
+
+from gunicorn.app.base import BaseApplication
+
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("server")
+
+
+class Server(BaseApplication):
+    """
+    Runs a wsgi app under gunicorn: a pool of worker processes, each serving
+    requests on a pool of threads. Files sent by the app are handed to the
+    kernel with sendfile, and on SIGTERM the workers finish the requests in
+    flight before exiting.
+    """
+
+    def __init__(self, wsgi_app, options):
+        self.wsgi_app = wsgi_app
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.wsgi_app
+
+
+def serve(wsgi_app, host, port, n_workers, n_threads, graceful_timeout):
+    n_workers = n_workers or multiprocessing.cpu_count()
+    log.info(
+        f"serving on {host}:{port} with {n_workers} workers of {n_threads} threads"
+    )
+    Server(
+        wsgi_app,
+        {
+            "bind": f"{host}:{port}",
+            "workers": n_workers,
+            "threads": n_threads,
+            "worker_class": "gthread",
+            "sendfile": True,
+            "graceful_timeout": graceful_timeout,
+            "preload_app": True,
+            "accesslog": "-",
+        },
+    ).run()
@@ -0,0 +1,234 @@
+import os
+import json
+import gzip
+import fcntl
+import shutil
+from pathlib import Path
+from datetime import datetime, timezone
+
+from hn2ebook import cache
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("store")
+
+# the fields of a resolved story that are kept in memory, everything else
+# (the rendered html) only lives on disk
+SUMMARY_KEYS = ["id", "title", "points", "num_comments", "time", "author", "source"]
+
+# the steps a story of a build goes through, each one checkpointed in the
+# working directory: chosen with its summary, article extracted, comments
+# crawled (the story is resolved), chapter rendered
+STORY_STATES = ["summary", "article", "comments", "chapter"]
+
+
+def work_dir(cfg, build_id):
+    return Path(cfg["data_dir"]).joinpath("work", build_id)
+
+
+class StoryStore:
+    """
+    Holds the resolved stories of a build in a working directory instead of
+    in memory.
+
+    Each story is written gzip compressed to its own file as soon as it is
+    resolved, and read back one at a time when iterated. Only a small summary
+    of every story is kept in memory.
+
+    The directory is the checkpoint of the build: it keeps the build record,
+    the chosen stories, and for every story the extracted article, the
+    resolved story and the rendered chapter as each step completes. It is
+    left behind when a build fails, so a later build can resume from it.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.stories_path = self.path.joinpath("stories")
+        self.stories_path.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.path.joinpath("index.json")
+        self.index = read_json(self.index_path) or []
+        self.lock_file = None
+
+    @classmethod
+    def for_build(cls, cfg, build_id):
+        return cls(work_dir(cfg, build_id))
+
+    @property
+    def build_id(self):
+        return self.path.name
+
+    def lock(self):
+        """
+        Takes the lock of the working directory, which is held until it is
+        unlocked, the store is removed or the process exits. Returns False if
+        another build holds it.
+        """
+        if self.lock_file:
+            return True
+        f = open(self.path.joinpath("lock"), "w")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return False
+        self.lock_file = f
+        return True
+
+    def record(self):
+        return read_json(self.path.joinpath("build.json"))
+
+    def write_record(self, record):
+        write_json(self.path.joinpath("build.json"), record)
+
+    def choose(self, summaries):
+        """
+        Checkpoints the summaries of the stories chosen for the build.
+        """
+        write_json(
+            self.path.joinpath("chosen.json"),
+            [{k: s[k] for k in SUMMARY_KEYS if k in s} for s in summaries],
+        )
+
+    def chosen(self):
+        """
+        Returns the summaries of the chosen stories, or None if the build
+        didn't get that far.
+        """
+        summaries = read_json(self.path.joinpath("chosen.json"))
+        if summaries is None:
+            return None
+        for summary in summaries:
+            summary["datetime"] = datetime.fromtimestamp(
+                summary["time"], tz=timezone.utc
+            )
+        return summaries
+
+    def story_path(self, story_id):
+        return self.stories_path.joinpath(f"{story_id}.json.gz")
+
+    def article_path(self, story_id):
+        return self.stories_path.joinpath(f"{story_id}.article.html.gz")
+
+    def chapter_path(self, story_id):
+        return self.stories_path.joinpath(f"{story_id}.chapter.zip")
+
+    def put_article(self, story_id, body):
+        write_gzip(self.article_path(story_id), body)
+
+    def get_article(self, story_id):
+        """
+        Returns the article extracted for a story, or None if it wasn't.
+        """
+        try:
+            with gzip.open(self.article_path(story_id), "rt", encoding="utf-8") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put_chapter(self, chapter):
+        cache.write_chapter(self.chapter_path(chapter["story_id"]), chapter)
+
+    def get_chapter(self, story_id):
+        """
+        Returns the chapter rendered for a story, or None if it wasn't.
+        """
+        return cache.read_chapter(self.chapter_path(story_id))
+
+    def put(self, story):
+        payload = {k: v for k, v in story.items() if k != "datetime"}
+        write_gzip(self.story_path(story["id"]), json.dumps(payload))
+
+        self.index = [s for s in self.index if s["id"] != story["id"]]
+        self.index.append({k: story[k] for k in SUMMARY_KEYS if k in story})
+        write_json(self.index_path, self.index)
+
+    def get(self, story_id):
+        with gzip.open(self.story_path(story_id), "rt", encoding="utf-8") as f:
+            story = json.load(f)
+        story["datetime"] = datetime.fromtimestamp(story["time"], tz=timezone.utc)
+        return story
+
+    def state(self, story_id):
+        """
+        Returns the last step the build completed for a chosen story.
+        """
+        if self.chapter_path(story_id).is_file():
+            return "chapter"
+        if self.story_path(story_id).is_file():
+            return "comments"
+        if self.article_path(story_id).is_file():
+            return "article"
+        return "summary"
+
+    def summaries(self):
+        return self.index
+
+    def __contains__(self, story_id):
+        return any(s["id"] == story_id for s in self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for summary in self.index:
+            yield self.get(summary["id"])
+
+    def unlock(self):
+        if self.lock_file:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def remove(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.unlock()
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def write_json(path, data):
+    tmp_path = path.with_suffix(".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def write_gzip(path, text):
+    tmp_path = path.with_suffix(".tmp")
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def unfinished_builds(cfg):
+    """
+    Yields the record and the store of every build that was left behind in
+    the working directory.
+    """
+    for path in Path(cfg["data_dir"]).joinpath("work").glob("*/build.json"):
+        record = read_json(path)
+        if record:
+            yield record, StoryStore(path.parent)
+
+
+def expire_builds(cfg, max_age):
+    """
+    Removes the working directories of the unfinished builds started more
+    than max_age ago, unless a process is still running them. Returns the
+    number of builds removed.
+    """
+    before = datetime.utcnow() - max_age
+    n = 0
+    for record, stories in unfinished_builds(cfg):
+        created_at = datetime.fromisoformat(record["created_at"].rstrip("Z"))
+        if created_at < before and stories.lock():
+            log.info(
+                f"removing build {stories.build_id}, unfinished since {record['created_at']}"
+            )
+            stories.remove()
+            n += 1
+    return n
@@ -0,0 +1,327 @@
+import os
+import zlib
+import struct
+import importlib.resources
+from collections import deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+
+import jinja2
+
+from hn2ebook.misc.log import logger
+
+log = logger.get_logger("writer")
+
+templates = jinja2.Environment(
+    loader=jinja2.PackageLoader("hn2ebook", "resources"),
+    autoescape=True,
+    trim_blocks=True,
+    lstrip_blocks=True,
+)
+
+ROOT = "EPUB"
+XHTML = "application/xhtml+xml"
+
+# payloads of these types are already compressed, deflating them again costs
+# cpu time for next to no gain
+STORED_MIMETYPES = ["image/png", "image/jpeg", "image/gif", "image/webp"]
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_UTF8_FLAG = 0x800
+ZIP_MAX_SIZE = 0xFFFFFFFF
+
+# the data of a zip entry as it is stored in the file, still compressed
+RawEntry = namedtuple("RawEntry", ["method", "crc", "size", "data"])
+
+
+def load_resource_bytes(file_name):
+    return importlib.resources.read_binary("hn2ebook.resources", file_name)
+
+
+def dos_datetime(dt):
+    return (
+        (dt.hour << 11) | (dt.minute << 5) | (dt.second // 2),
+        ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day,
+    )
+
+
+def read_raw_entry(z, f, info):
+    """
+    Returns the entry described by info in the zip file z without
+    decompressing it, reading the data from f, a binary file handle on the same
+    file. Entries compressed with anything but deflate are decompressed.
+    """
+    if info.compress_type not in [ZIP_STORED, ZIP_DEFLATED]:
+        return z.read(info)
+    f.seek(info.header_offset)
+    header = f.read(30)
+    name_length, extra_length = struct.unpack("<2H", header[26:30])
+    f.seek(info.header_offset + 30 + name_length + extra_length)
+    return RawEntry(
+        info.compress_type, info.CRC, info.file_size, f.read(info.compress_size)
+    )
+
+
+def compress_entry(payload, method, level):
+    """
+    Returns (method, crc, uncompressed size, data) for a zip entry. zlib
+    releases the GIL, so entries compress in parallel on a thread pool.
+    """
+    crc = zlib.crc32(payload)
+    if method == ZIP_DEFLATED:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        data = compressor.compress(payload) + compressor.flush()
+    else:
+        data = payload
+    return method, crc, len(payload), data
+
+
+class ZipPackage:
+    """
+    A write-only zip file whose entries are compressed ahead of time.
+
+    Entries are compressed on a thread pool but written to the file in the
+    order they were added, with at most a few entries per thread held in
+    memory at any time. The zip is written next to path and only moved there
+    once it is complete, so path never holds a partial file.
+    """
+
+    def __init__(self, path, compress_level, n_threads):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.file = open(self.tmp_path, "wb")
+        self.compress_level = compress_level
+        self.n_threads = n_threads
+        self.pool = ThreadPoolExecutor(n_threads)
+        self.pending = deque()
+        self.central_directory = []
+        self.time, self.date = dos_datetime(datetime.now())
+
+    def add(self, name, payload, compress=True):
+        """
+        Queues an entry. A RawEntry payload is copied into the zip as it is.
+        """
+        if isinstance(payload, RawEntry):
+            future = Future()
+            future.set_result(payload)
+        else:
+            if isinstance(payload, str):
+                payload = payload.encode("utf-8")
+            method = ZIP_DEFLATED if compress else ZIP_STORED
+            future = self.pool.submit(
+                compress_entry, payload, method, self.compress_level
+            )
+        self.pending.append((name, future))
+        self.flush(block=len(self.pending) > 4 * self.n_threads)
+
+    def flush(self, block=False, wait_all=False):
+        """
+        Writes out the entries at the head of the queue that are ready. With
+        block, waits for the first one to be ready, with wait_all for all.
+        """
+        while self.pending:
+            name, future = self.pending[0]
+            if not (block or wait_all or future.done()):
+                return
+            block = False
+            self.pending.popleft()
+            self.write_entry(name, *future.result())
+
+    def write_entry(self, name, method, crc, size, data):
+        encoded_name = name.encode("utf-8")
+        offset = self.file.tell()
+        if offset + len(data) > ZIP_MAX_SIZE or size > ZIP_MAX_SIZE:
+            raise ValueError(f"{name} does not fit in a zip without zip64")
+        self.file.write(
+            struct.pack(
+                "<4s5H3L2H",
+                b"PK\x03\x04",
+                20,
+                ZIP_UTF8_FLAG,
+                method,
+                self.time,
+                self.date,
+                crc,
+                len(data),
+                size,
+                len(encoded_name),
+                0,
+            )
+        )
+        self.file.write(encoded_name)
+        self.file.write(data)
+        self.central_directory.append(
+            struct.pack(
+                "<4s6H3L5H2L",
+                b"PK\x01\x02",
+                (3 << 8) | 20,
+                20,
+                ZIP_UTF8_FLAG,
+                method,
+                self.time,
+                self.date,
+                crc,
+                len(data),
+                size,
+                len(encoded_name),
+                0,
+                0,
+                0,
+                0,
+                0o100644 << 16,
+                offset,
+            )
+            + encoded_name
+        )
+
+    def close(self):
+        self.flush(wait_all=True)
+        self.pool.shutdown()
+        offset = self.file.tell()
+        for record in self.central_directory:
+            self.file.write(record)
+        size = self.file.tell() - offset
+        n = len(self.central_directory)
+        self.file.write(
+            struct.pack("<4s4H2LH", b"PK\x05\x06", 0, 0, n, n, size, offset, 0)
+        )
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+    def abort(self):
+        self.pool.shutdown(cancel_futures=True)
+        self.file.close()
+        try:
+            os.remove(self.tmp_path)
+        except FileNotFoundError:
+            pass
+
+
+class EpubWriter:
+    """
+    Writes an EPUB 3 file incrementally.
+
+    Every item is appended to the zip as soon as it is added, and only its
+    manifest entry is kept around. The package document, the NCX and the nav
+    page are written on close, once everything they list is known. Memory use
+    is bounded by the largest single item instead of the whole book.
+
+    Text items are deflated at compress_level on n_threads threads (0 for one
+    per cpu core), images that are already compressed are stored as they are.
+    """
+
+    def __init__(self, path, metadata, description, compress_level=6, n_threads=0):
+        self.path = path
+        self.metadata = metadata
+        self.description = description
+        self.manifest = []
+        self.spine = ["nav"]
+        self.toc = []
+        self.cover_id = None
+        self.zip = ZipPackage(path, compress_level, n_threads or os.cpu_count())
+        # the mimetype must be the first entry and stored uncompressed
+        self.zip.add("mimetype", "application/epub+zip", compress=False)
+        self.zip.add(
+            "META-INF/container.xml", load_resource_bytes("epub-container.xml")
+        )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.zip.abort()
+            return
+        try:
+            self.close()
+        except BaseException:
+            self.zip.abort()
+            raise
+
+    def add_item(self, uid, file_name, media_type, content, properties=None):
+        self.zip.add(
+            f"{ROOT}/{file_name}",
+            content,
+            compress=media_type not in STORED_MIMETYPES,
+        )
+        self.manifest.append(
+            {
+                "id": uid,
+                "href": file_name,
+                "media_type": media_type,
+                "properties": properties,
+            }
+        )
+
+    def add_page(self, uid, file_name, content):
+        self.add_item(uid, file_name, XHTML, content)
+        self.spine.append(uid)
+
+    def set_cover(self, file_name, content):
+        self.cover_id = "cover-img"
+        self.add_item(self.cover_id, file_name, "image/png", content, "cover-image")
+        self.add_item(
+            "cover", "cover.xhtml", XHTML, load_resource_bytes("epub-cover.xhtml")
+        )
+
+    def add_chapter(self, chapter):
+        """
+        Appends the images and pages of a built chapter, and records its table
+        of contents entry. Split chapters get one sub-entry per page.
+        """
+        for image in chapter["images"]:
+            self.add_item(
+                image["uid"], image["file_name"], image["mimetype"], image["payload"]
+            )
+        uids = []
+        for part in chapter["parts"]:
+            uid = part["file_name"].rpartition(".")[0]
+            self.add_page(uid, part["file_name"], part["content"])
+            uids.append(uid)
+
+        first = chapter["parts"][0]
+        entry = {
+            "id": uids[0],
+            "title": chapter["title"],
+            "href": first["file_name"],
+            "children": [],
+        }
+        if len(chapter["parts"]) > 1:
+            entry["children"] = [
+                {"id": f"toc_{uid}", "title": part["label"], "href": part["file_name"]}
+                for uid, part in zip(uids, chapter["parts"])
+            ]
+        self.toc.append(entry)
+
+    def render(self, template_name, **kwargs):
+        template = templates.get_template(template_name)
+        return template.render(metadata=self.metadata, **kwargs)
+
+    def close(self):
+        self.add_item(
+            "ncx",
+            "toc.ncx",
+            "application/x-dtbncx+xml",
+            self.render("epub-toc.ncx.j2", toc=self.toc),
+        )
+        self.add_item(
+            "nav",
+            "nav.xhtml",
+            XHTML,
+            self.render("epub-nav.xhtml.j2", toc=self.toc),
+            "nav",
+        )
+        self.zip.add(
+            f"{ROOT}/content.opf",
+            self.render(
+                "epub-content.opf.j2",
+                modified=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                description=self.description,
+                cover_id=self.cover_id,
+                manifest=self.manifest,
+                spine=self.spine,
+            ),
+        )
+        self.zip.close()
+        log.debug(f"wrote {len(self.manifest)} items to {self.path}")
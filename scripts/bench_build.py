@@ -0,0 +1,120 @@
+"""
+Benchmarks building the chapters of an issue with a growing number of
+worker processes.
+
+Synthetic stories with large comment trees are written to a throwaway story
+store, then the same epub is built once per worker count. No network access
+is needed: the stories have no images and the chapter cache is disabled.
+
+    python scripts/bench_build.py --stories 40 --workers 1,2,4,8
+"""
+
+import sys
+import time
+import random
+import argparse
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from hn2ebook.misc.log import setup_logging
+
+setup_logging(None, "WARNING", None)
+
+from hn2ebook import core
+from hn2ebook.store import StoryStore
+
+
+def synthetic_comments(rnd, story_id, n_threads, max_depth, max_kids):
+    next_id = [story_id]
+
+    def comment(parent, depth):
+        next_id[0] += 1
+        comment_id = next_id[0]
+        n_kids = rnd.randint(0, max_kids) if depth < max_depth else 0
+        return {
+            "id": comment_id,
+            "parent": parent,
+            "by": "user%d" % rnd.randint(0, 500),
+            "time": 1617000000 + comment_id,
+            "text": "<p>%s</p>" % " ".join(["lorem ipsum dolor"] * rnd.randint(5, 60)),
+            "children": [comment(comment_id, depth + 1) for _ in range(n_kids)],
+        }
+
+    return [comment(story_id, 0) for _ in range(n_threads)]
+
+
+def synthetic_story(rnd, story_id, n_threads):
+    story = {
+        "id": story_id,
+        "title": f"Synthetic story {story_id}",
+        "by": "op",
+        "url": f"https://example.com/{story_id}",
+        "body": "<p>%s</p>" % " ".join(["article text"] * 2000),
+        "children": synthetic_comments(rnd, story_id * 100000, n_threads, 5, 3),
+    }
+    return {
+        "id": str(story_id),
+        "title": story["title"],
+        "points": 100,
+        "num_comments": 0,
+        "time": 1617000000,
+        "author": story["by"],
+        "source": story["url"],
+        "html": core.story_to_html(story),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--stories", type=int, default=40)
+    parser.add_argument(
+        "--threads", type=int, default=60, help="comment threads per story"
+    )
+    parser.add_argument("--workers", default="1,2,4,8")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cfg = {
+            "data_dir": tmp,
+            "srcsetparser_bin": "srcset-parser",
+            "use_chrome": False,
+            "chapter_max_bytes": 300000,
+            "chapter_max_comments": 300,
+            "chapter_cache": False,
+        }
+        store = StoryStore(Path(tmp).joinpath("work", "bench"))
+        rnd = random.Random(42)
+        for story_id in range(1, args.stories + 1):
+            store.put(synthetic_story(rnd, story_id, args.threads))
+        metadata = {
+            "identifier": "urn:uuid:bench",
+            "title": "Hacker News Bench",
+            "longtitle": "Hacker News Bench",
+            "subtitle": "for benchmarking",
+            "num_stories": len(store),
+            "headlines": [s["title"] for s in store.summaries()],
+            "authors": ["hn2ebook"],
+            "language": "en",
+            "DC": {"subject": "News", "date": "2021-04-10T00:00:00Z"},
+        }
+        # the cover needs system fonts, and isn't what is being measured
+        core.epub_cover = lambda metadata: b""
+
+        baseline = None
+        for n_workers in [int(n) for n in args.workers.split(",")]:
+            cfg["n_build_workers"] = n_workers
+            out = Path(tmp).joinpath(f"bench-{n_workers}.epub")
+            start = time.perf_counter()
+            core.build_epub(cfg, store, metadata, out)
+            elapsed = time.perf_counter() - start
+            baseline = baseline or elapsed
+            print(
+                "workers=%-3d %6.2fs  speedup x%.2f  %d bytes"
+                % (n_workers, elapsed, baseline / elapsed, out.stat().st_size)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""
+Load tests a running hn2ebook server the way a crowd of e-readers syncing at
+the same time would: every client fetches the feed index, pages through a
+feed, then downloads the issues it links to.
+
+The feeds and epubs to request are discovered in a local data dir, which
+must be the data dir the server serves. Clients revalidate what they fetched
+before with If-None-Match, like readers polling the catalog do.
+
+    hn2ebook server --port 3000 &
+    python scripts/loadtest.py --data-dir ./data --url http://127.0.0.1:3000 \
+        --clients 50 --duration 30
+"""
+
+import sys
+import time
+import random
+import argparse
+import threading
+from pathlib import Path
+
+import requests
+
+
+def discover(data_dir):
+    data_dir = Path(data_dir)
+    feeds = sorted("/" + p.name for p in data_dir.glob("*.xml"))
+    epubs = sorted(
+        "/" + str(p.relative_to(data_dir)) for p in data_dir.glob("issues/*.epub")
+    )
+    return feeds, epubs
+
+
+def client(base_url, feeds, epubs, n_epubs, deadline, results, lock, rnd):
+    session = requests.Session()
+    etags = {}
+    while time.monotonic() < deadline:
+        paths = feeds + rnd.sample(epubs, min(n_epubs, len(epubs)))
+        for path in paths:
+            headers = {"Accept-Encoding": "gzip, br"}
+            if path in etags:
+                headers["If-None-Match"] = etags[path]
+            start = time.perf_counter()
+            try:
+                response = session.get(base_url + path, headers=headers)
+                size = len(response.content)
+                status = response.status_code
+                if "ETag" in response.headers:
+                    etags[path] = response.headers["ETag"]
+            except requests.RequestException:
+                size, status = 0, None
+            elapsed = time.perf_counter() - start
+            with lock:
+                results.append((status, elapsed, size))
+            if time.monotonic() >= deadline:
+                return
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--data-dir", required=True)
+    parser.add_argument("--url", default="http://127.0.0.1:3000")
+    parser.add_argument("--clients", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument(
+        "--epubs", type=int, default=2, help="epubs downloaded per client round"
+    )
+    args = parser.parse_args()
+
+    feeds, epubs = discover(args.data_dir)
+    if not feeds:
+        sys.exit(f"no feeds found in {args.data_dir}, run generate-feed first")
+    print(f"{len(feeds)} feeds and {len(epubs)} epubs, {args.clients} clients")
+
+    results = []
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(
+            target=client,
+            args=(
+                args.url.rstrip("/"),
+                feeds,
+                epubs,
+                args.epubs,
+                deadline,
+                results,
+                lock,
+                random.Random(i),
+            ),
+        )
+        for i in range(args.clients)
+    ]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    latencies = sorted(r[1] for r in results)
+    statuses = {}
+    for status, _, _ in results:
+        statuses[status] = statuses.get(status, 0) + 1
+    n_bytes = sum(r[2] for r in results)
+    print(
+        "%d requests in %.1fs, %.1f req/s, %.1f MB/s"
+        % (len(results), elapsed, len(results) / elapsed, n_bytes / elapsed / 1e6)
+    )
+    if latencies:
+        print(
+            "latency p50 %.1fms  p95 %.1fms  p99 %.1fms  max %.1fms"
+            % tuple(1000 * percentile(latencies, p) for p in [0.5, 0.95, 0.99, 1.0])
+        )
+    print(
+        "statuses: "
+        + ", ".join(f"{k}: {v}" for k, v in sorted(statuses.items(), key=str))
+    )
+    if statuses.get(None) or any(s and s >= 500 for s in statuses):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
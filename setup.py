@@ -8,10 +8,12 @@ setup(
     install_requires=[
         "toml",
         "Flask",
+        "gunicorn",
+        "Jinja2",
         "requests",
         "requests_cache",
-        "ebooklib",
         "Pillow",
+        "lxml",
         "selenium",
         "Click",
         "cerberus",
@@ -19,5 +21,6 @@ setup(
         "yoyo-migrations",
         "python-dateutil",
     ],
+    extras_require={"brotli": ["brotli"]},
     entry_points={"console_scripts": ["hn2ebook=hn2ebook.cli:app"],},
 )
@@ -0,0 +1,136 @@
+"""
+A local stand-in for the algolia hn search api. It serves a file of hits the
+way /search_by_date does: filtered by tags and creation time, newest first,
+paginated, and never more than ALGOLIA_MAX_HITS hits for one query however
+it is paginated.
+
+    python tests/algolia_standin.py tests/data/algolia_hits.json.gz --port 3001
+
+then backfill with algolia_url = "http://127.0.0.1:3001/api/v1".
+"""
+
+import re
+import gzip
+import json
+import argparse
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# algolia never returns more hits than this for one query
+ALGOLIA_MAX_HITS = 1000
+
+NUMERIC_FILTER_RE = re.compile(r"^(\w+)(>=|<=|>|<|=)(\d+)$")
+OPERATORS = {
+    ">=": lambda a, b: a >= b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    "<": lambda a, b: a < b,
+    "=": lambda a, b: a == b,
+}
+
+
+def load_hits(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def parse_tags(tags):
+    """
+    Parses algolia tag filters into a list of alternatives that must all
+    match: tags separated by commas are ANDed, tags in parentheses are ORed.
+    """
+    groups = re.findall(r"\(([^)]*)\)|([^,()]+)", tags or "")
+    return [
+        set(t for t in (group or single).split(",") if t)
+        for group, single in groups
+        if group or single
+    ]
+
+
+def parse_numeric_filters(filters):
+    parsed = []
+    for f in filter(None, (filters or "").split(",")):
+        m = NUMERIC_FILTER_RE.match(f)
+        if not m:
+            raise ValueError(f"unsupported numeric filter {f}")
+        parsed.append((m.group(1), OPERATORS[m.group(2)], int(m.group(3))))
+    return parsed
+
+
+def search_by_date(hits, params):
+    tags = parse_tags(params.get("tags"))
+    numeric = parse_numeric_filters(params.get("numericFilters"))
+    page = int(params.get("page", 0))
+    hits_per_page = int(params.get("hitsPerPage", 20))
+    matching = [
+        hit
+        for hit in hits
+        if all(group & set(hit["_tags"]) for group in tags)
+        and all(op(hit[key], value) for key, op, value in numeric)
+    ]
+    matching.sort(key=lambda hit: hit["created_at_i"], reverse=True)
+    # like algolia, only the first ALGOLIA_MAX_HITS hits can be paged to
+    reachable = matching[:ALGOLIA_MAX_HITS]
+    start = page * hits_per_page
+    return {
+        "hits": reachable[start : start + hits_per_page],
+        "nbHits": len(matching),
+        "page": page,
+        "nbPages": -(-len(reachable) // hits_per_page) if hits_per_page else 0,
+        "hitsPerPage": hits_per_page,
+    }
+
+
+class StandIn(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, hits, address=("127.0.0.1", 0)):
+        super().__init__(address, Handler)
+        self.hits = hits
+        self.queries = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/api/v1"
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        if url.path != "/api/v1/search_by_date":
+            self.send_error(404)
+            return
+        params = dict(urllib.parse.parse_qsl(url.query))
+        with self.server.lock:
+            self.server.queries.append(params)
+        try:
+            body = json.dumps(search_by_date(self.server.hits, params)).encode()
+        except ValueError as e:
+            self.send_error(400, str(e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("hits")
+    parser.add_argument("--port", type=int, default=3001)
+    args = parser.parse_args()
+    server = StandIn(load_hits(args.hits), ("127.0.0.1", args.port))
+    print(f"serving {len(server.hits)} hits at {server.url}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
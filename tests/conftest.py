@@ -0,0 +1,4 @@
+from hn2ebook.misc.log import setup_logging
+
+# the hn2ebook modules get their loggers when imported
+setup_logging(None, "WARNING", None)
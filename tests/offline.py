@@ -0,0 +1,101 @@
+"""
+Builds issues without the network: a config for a data dir, and a stand-in
+for HN and the article extraction that counts what the builds fetch and can
+be told to fail on a story, like a crawl or a headless chrome that dies
+halfway through a build.
+"""
+
+from cerberus import Validator
+
+from hn2ebook import cli
+from hn2ebook import core
+
+# 2020-09-13 12:26:40 UTC
+EPOCH = 1600000000
+
+
+def config(tmp_path, **overrides):
+    """
+    Returns the normalized config for a data dir and database under
+    tmp_path, building chapters in the main process.
+    """
+    doc = {
+        "hn2ebook": dict(
+            {
+                "readability_bin": "readability-extractor",
+                "srcsetparser_bin": "srcset-parser",
+                "chromedriver_bin": "chromedriver",
+                "root_url": "http://hn2ebook.test",
+                "data_dir": str(tmp_path.joinpath("data")),
+                "db_path": str(tmp_path.joinpath("hn2ebook.sqlite")),
+                "n_build_workers": 1,
+                "n_compress_threads": 1,
+            },
+            **overrides,
+        )
+    }
+    validator = Validator(cli.config_schema)
+    assert validator.validate(doc), validator.errors
+    cfg = validator.normalized(doc)
+    cfg["hn2ebook"]["data_dir"] = tmp_path.joinpath("data")
+    cfg["hn2ebook"]["data_dir"].mkdir(exist_ok=True)
+    return cfg
+
+
+class Context:
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+
+class FakeHN:
+    """
+    Serves every story id as a story without comments. calls lists the story
+    ids every step was taken for, fail maps a step ("article", "comments" or
+    "chapter") to the id of the story it fails on.
+    """
+
+    def __init__(self, monkeypatch):
+        self.calls = {"item": [], "article": [], "comments": [], "chapter": []}
+        self.fail = {}
+        self.build_chapter = core.build_chapter
+        monkeypatch.setattr(core, "get_item", self.get_item)
+        monkeypatch.setattr(core, "expand_body", self.expand_body)
+        monkeypatch.setattr(core, "expand_item", self.expand_item)
+        monkeypatch.setattr(core, "build_chapter", self.build)
+        monkeypatch.setattr(core, "use_local_items", lambda db_path: None)
+
+    def step(self, step, story_id):
+        if self.fail.get(step) == str(story_id):
+            raise RuntimeError(f"{step} failed for story {story_id}")
+        self.calls[step].append(str(story_id))
+
+    def reset(self):
+        self.fail.clear()
+        for calls in self.calls.values():
+            calls.clear()
+
+    def get_item(self, id):
+        self.calls["item"].append(str(id))
+        return {
+            "id": int(id),
+            "type": "story",
+            "title": f"story {id}",
+            "score": int(id),
+            "descendants": 0,
+            "time": EPOCH + int(id),
+            "by": "pg",
+            "url": f"https://example.com/{id}",
+        }
+
+    def expand_body(self, cfg, story):
+        self.step("article", story["id"])
+        return f"<p>the article of story {story['id']}</p>"
+
+    def expand_item(self, pool, item, parent=None):
+        self.step("comments", item["id"])
+        item["children"] = []
+        return item
+
+    def build(self, cfg, story):
+        self.step("chapter", story["id"])
+        return self.build_chapter(cfg, story)
@@ -0,0 +1,98 @@
+"""
+Runs the algolia backfill source against the local stand-in, serving a day
+of stories in the shape algolia returns them: 1500 stories on 2024-01-15,
+more than one query can page through, a few of them on the front page, and
+some stories on the days around it.
+"""
+
+import threading
+from pathlib import Path
+from datetime import date, datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from hn2ebook import db
+from hn2ebook import hn
+
+import algolia_standin
+
+HITS_PATH = Path(__file__).parent.joinpath("data", "algolia_hits.json.gz")
+DAY = date(2024, 1, 15)
+
+
+@pytest.fixture(scope="module")
+def hits():
+    return algolia_standin.load_hits(HITS_PATH)
+
+
+@pytest.fixture
+def algolia(hits):
+    server = algolia_standin.StandIn(hits)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def hits_on(hits, day, tag):
+    start, end = hn.day_timestamps(day)
+    return [
+        hit
+        for hit in hits
+        if start <= hit["created_at_i"] < end and tag in hit["_tags"]
+    ]
+
+
+def test_stand_in_caps_hits_like_algolia():
+    assert algolia_standin.ALGOLIA_MAX_HITS == hn.ALGOLIA_MAX_HITS
+
+
+def test_story_ids_in_range_splits_windows(hits, algolia):
+    day_hits = hits_on(hits, DAY, "story")
+    assert len(day_hits) > hn.ALGOLIA_MAX_HITS
+
+    start = datetime(2024, 1, 15, tzinfo=timezone.utc)
+    end = datetime(2024, 1, 16, tzinfo=timezone.utc)
+    story_ids = hn.story_ids_in_range(start, end, algolia.url)
+
+    expected = sorted(day_hits, key=lambda hit: hit["created_at_i"])
+    assert story_ids == [hit["objectID"] for hit in expected]
+    # the day had to be split to page through all of its stories
+    counts = [q for q in algolia.queries if q["hitsPerPage"] == "0"]
+    assert len(counts) > 1
+
+
+def test_best_stories_algolia(hits, algolia):
+    with ThreadPoolExecutor(4) as request_pool:
+        stories = hn.best_stories_algolia(DAY, request_pool, algolia.url)
+
+    front_page = hits_on(hits, DAY, "front_page")
+    assert [story["id"] for story in stories] == [
+        int(hit["objectID"])
+        for hit in sorted(front_page, key=lambda hit: hit["created_at_i"])
+    ]
+    ask_hn = [s for s in stories if s["url"].startswith("https://news.ycombinator")]
+    assert all(s["title"].startswith("Ask HN") for s in ask_hn)
+
+
+def test_backfill_from_algolia(tmp_path, hits, algolia):
+    db_path = str(tmp_path.joinpath("hn2ebook.sqlite"))
+    db.migrate(db_path)
+    conn = db.connect(db_path)
+
+    failed = hn.backfill(
+        conn, "algolia", DAY, date(2024, 1, 16), 2, 4, algolia_url=algolia.url
+    )
+
+    assert failed == 0
+    assert db.completed_backfill_days(conn, "algolia", DAY, date(2024, 1, 16)) == {
+        str(DAY)
+    }
+    recorded = {
+        story_id for story_id, _ in db.best_stories_for(conn, DAY, date(2024, 1, 16))
+    }
+    assert recorded == {
+        int(hit["objectID"]) for hit in hits_on(hits, DAY, "front_page")
+    }
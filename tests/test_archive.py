@@ -0,0 +1,177 @@
+"""
+Imports small dumps of HN items and checks what ends up in the database:
+the items, the replies linked to items that came without kids, the stories
+and the best stories derived from them.
+"""
+
+import gzip
+import json
+from datetime import datetime, timezone
+
+import pytest
+
+from hn2ebook import archive
+from hn2ebook import core
+from hn2ebook import db
+
+# 2024-01-15 00:00:00 UTC
+DAY = 1705276800
+HOUR = 3600
+
+
+def story(id, time, score, **kwargs):
+    return dict(
+        id=id,
+        type="story",
+        by="pg",
+        time=time,
+        title=f"story {id}",
+        score=score,
+        descendants=0,
+        url=f"https://example.com/{id}",
+        **kwargs,
+    )
+
+
+def comment(id, parent, time, **kwargs):
+    return dict(
+        id=id,
+        type="comment",
+        by="dang",
+        time=time,
+        parent=parent,
+        text=f"comment {id}",
+        **kwargs,
+    )
+
+
+ITEMS = [
+    story(1, DAY + HOUR, 10, kids=[12, 11]),
+    comment(11, 1, DAY + 2 * HOUR),
+    comment(12, 1, DAY + 3 * HOUR),
+    story(2, DAY + 2 * HOUR, 30),
+    comment(21, 2, DAY + 3 * HOUR),
+    comment(23, 21, DAY + 5 * HOUR),
+    comment(22, 21, DAY + 4 * HOUR),
+    story(3, DAY + 3 * HOUR, 20),
+    story(4, DAY + 4 * HOUR, 20),
+    story(5, DAY + 5 * HOUR, 50, dead=True),
+    dict(story(6, DAY + 6 * HOUR, 1), text="<p>Ask HN</p>"),
+    story(7, DAY + 24 * HOUR + HOUR, 5),
+    story(8, DAY + 24 * HOUR + 2 * HOUR, 15),
+]
+
+
+@pytest.fixture
+def conn(tmp_path):
+    db_path = str(tmp_path.joinpath("hn2ebook.sqlite"))
+    db.migrate(db_path)
+    return db.connect(db_path)
+
+
+def write_dump(path, lines, compress=False):
+    opener = gzip.open if compress else open
+    with opener(path, "wt", encoding="utf-8") as f:
+        for line in lines:
+            f.write((line if isinstance(line, str) else json.dumps(line)) + "\n")
+    return path
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_import_skips_what_is_not_an_item(conn, tmp_path, compress):
+    lines = ITEMS[:3] + ["", "null", "{not json", '{"no": "id"}']
+    path = write_dump(tmp_path.joinpath("items.json"), lines, compress)
+
+    assert archive.import_dump(conn, path, 2, False, 0) == 3
+    assert db.get_item(conn, 11) == ITEMS[1]
+    assert db.get_item(conn, 2) is None
+
+
+def test_import_replaces_items(conn, tmp_path):
+    archive.import_dump(
+        conn, write_dump(tmp_path.joinpath("a.json"), ITEMS), 5, False, 0
+    )
+    updated = dict(ITEMS[0], score=99)
+    archive.import_dump(
+        conn, write_dump(tmp_path.joinpath("b.json"), [updated]), 5, False, 0
+    )
+
+    assert db.get_item(conn, 1)["score"] == 99
+
+
+def test_import_records_stories(conn, tmp_path):
+    archive.import_dump(
+        conn, write_dump(tmp_path.joinpath("items.json"), ITEMS), 5, False, 0
+    )
+
+    rows = {
+        row["story_id"]: dict(row)
+        for row in conn.execute("SELECT * FROM hn_story").fetchall()
+    }
+    assert sorted(rows) == [1, 2, 3, 4, 6, 7, 8]
+    assert rows[1]["url"] == "https://example.com/1"
+    assert rows[6]["url"] == "https://news.ycombinator.com/item?id=6"
+    snapshots = conn.execute("SELECT COUNT(*) FROM hn_story_snapshot").fetchone()[0]
+    assert snapshots == len(rows)
+
+
+def test_link_item_kids(conn, tmp_path):
+    archive.import_dump(
+        conn, write_dump(tmp_path.joinpath("items.json"), ITEMS), 5, False, 0
+    )
+
+    # kids the dump came with keep their ranked order
+    assert db.get_item(conn, 1)["kids"] == [12, 11]
+    # the others are linked from the parents, oldest first
+    assert db.get_item(conn, 2)["kids"] == [21]
+    assert db.get_item(conn, 21)["kids"] == [22, 23]
+    assert "kids" not in db.get_item(conn, 3)
+    # nothing is left to link
+    assert db.link_item_kids(conn) == 0
+
+
+def test_derive_best_stories(conn, tmp_path):
+    path = write_dump(tmp_path.joinpath("items.json"), ITEMS)
+    archive.import_dump(conn, path, 5, True, 2)
+
+    best = conn.execute(
+        "SELECT day, story_id FROM hn_best_story ORDER BY day, story_id"
+    ).fetchall()
+    # the dead story scored the most, stories 3 and 4 tie and the older wins
+    assert [tuple(row) for row in best] == [
+        ("2024-01-15", 2),
+        ("2024-01-15", 3),
+        ("2024-01-16", 7),
+        ("2024-01-16", 8),
+    ]
+    # deriving again records nothing new
+    assert db.derive_best_stories(conn, DAY, DAY + 48 * HOUR, 2) == 0
+
+
+def test_recent_items_are_fetched_again(conn, tmp_path, monkeypatch):
+    now = datetime.now(timezone.utc).timestamp()
+    old = story(1, int(now - 30 * 24 * HOUR), 10)
+    recent = story(2, int(now - 24 * HOUR), 10)
+    archive.import_dump(
+        conn, write_dump(tmp_path.joinpath("items.json"), [old, recent]), 5, False, 0
+    )
+
+    fetched = []
+
+    class Response:
+        def __init__(self, url):
+            fetched.append(url)
+
+        def raise_for_status(self):
+            pass
+
+        def json(self):
+            return dict(recent, score=50)
+
+    monkeypatch.setattr(core.net, "get", Response)
+    monkeypatch.setattr(core, "item_db_path", str(tmp_path.joinpath("hn2ebook.sqlite")))
+
+    assert core.get_item(1) == old
+    assert not fetched
+    assert core.get_item(2)["score"] == 50
+    assert fetched == [core.url_for_item(2)]
@@ -0,0 +1,185 @@
+"""
+Checks that the iterative comment renderer writes the same html as the
+recursive renderer it replaced, and that it renders threads too deep for
+recursion.
+"""
+
+import sys
+import random
+from datetime import datetime
+
+import pytest
+
+from hn2ebook import core
+
+# the recursive renderer as it was before comments were rendered
+# iteratively, kept as the reference for the html
+OLD_COMMENT_TEMPLATE = """
+<div id={kid} class="hn2ebook-comment-meta">
+<span class="number">{number}</span> <span class="author">{by}</span> <span class="date">{date}</span> {descendants}
+<div class="comment-links">{links}</div>
+</div>
+<div class="comment-body">
+{text}
+</div>
+<ol>{children}</ol>
+"""
+
+OLD_COMMENT_OP_TEMPLATE = """
+<footer class="hn2ebook-op">{by}</footer>
+{text}
+<ol>{children}</ol>
+"""
+
+
+def when_index(a, i):
+    if 0 <= i < len(a):
+        return a[i]
+    return None
+
+
+def old_to_html_numbers(indices, comment, op, story_id, sibling_pre, sibling_story):
+    children = []
+    for idx, reply in enumerate(comment["children"]):
+        child_sibling_pre = when_index(comment["children"], idx - 1)
+        child_sibling_story = when_index(comment["children"], idx + 1)
+        child_indices = indices + [idx + 1]
+        if "by" in reply:
+            children.append(
+                "<li>"
+                + old_to_html_numbers(
+                    child_indices,
+                    reply,
+                    op,
+                    story_id,
+                    child_sibling_pre,
+                    child_sibling_story,
+                )
+                + "</li>"
+            )
+    if "by" in comment:
+        tmpl = OLD_COMMENT_OP_TEMPLATE if op == comment["by"] else OLD_COMMENT_TEMPLATE
+        text_body = comment["text"]
+    elif "deleted" in comment and comment["deleted"]:
+        tmpl = OLD_COMMENT_TEMPLATE
+        text_body = "deleted"
+    descendants = "<span>(%d)</span>" % (len(children)) if len(children) > 0 else ""
+    return tmpl.format(
+        **{
+            "number": ".".join([str(i) for i in indices]),
+            "kid": comment["id"],
+            "text": text_body,
+            "by": comment.get("by"),
+            "date": datetime.fromtimestamp(comment["time"]).strftime(
+                "%Y-%m-%d %H:%M:%S"
+            ),
+            "descendants": descendants,
+            "children": "".join(children),
+            "links": "{} {} {}".format(
+                core.to_link(
+                    sibling_pre.get("id") if sibling_pre else None, "previous"
+                ),
+                (
+                    core.to_link(comment["parent"], "parent")
+                    if str(comment["parent"]) != str(story_id)
+                    else ""
+                ),
+                core.to_link(
+                    sibling_story.get("id") if sibling_story else None, "next"
+                ),
+            ),
+        }
+    )
+
+
+def old_comments_to_html(story_id, comments):
+    out = "<ol>"
+    for idx, comment in enumerate(comments):
+        sibling_pre = when_index(comments, idx - 1)
+        sibling_story = when_index(comments, idx + 1)
+        out += (
+            "<li>"
+            + old_to_html_numbers(
+                [idx + 1], comment, "op", story_id, sibling_pre, sibling_story
+            )
+            + "</li>"
+        )
+    return out + "</ol>"
+
+
+STORY_ID = 1
+
+
+def comment(id, parent, by="alice", children=(), **kwargs):
+    c = dict(id=id, parent=parent, time=1617000000 + id, children=list(children))
+    if by:
+        c.update(by=by, text=f"<p>comment {id} {{with braces}}</p>")
+    return dict(c, **kwargs)
+
+
+# a thread with op replies, deleted comments at the top and among the
+# replies, and replies with and without siblings
+FIXTURE = [
+    comment(
+        10,
+        STORY_ID,
+        children=[
+            comment(11, 10, by="op", children=[comment(14, 11, by="bob")]),
+            comment(12, 10, by=None, deleted=True, children=[comment(15, 12)]),
+            comment(13, 10, by="carol"),
+        ],
+    ),
+    comment(20, STORY_ID, by=None, deleted=True, children=[comment(21, 20)]),
+    comment(30, STORY_ID, by="op"),
+]
+
+
+def random_tree(rnd, next_id, parent, depth):
+    comments = []
+    for _ in range(rnd.randint(0, 5 if depth < 5 else 0)):
+        id = next(next_id)
+        deleted = rnd.random() < 0.1
+        comments.append(
+            comment(
+                id,
+                parent,
+                by=None if deleted else rnd.choice(["alice", "bob", "op"]),
+                deleted=deleted,
+                children=random_tree(rnd, next_id, id, depth + 1),
+            )
+        )
+    return comments
+
+
+def test_renders_like_the_recursive_renderer():
+    assert core.comments_to_html(STORY_ID, FIXTURE) == old_comments_to_html(
+        STORY_ID, FIXTURE
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_renders_random_trees_like_the_recursive_renderer(seed):
+    rnd = random.Random(seed)
+    comments = random_tree(rnd, iter(range(2, 10**6)), STORY_ID, 0)
+    assert core.comments_to_html(STORY_ID, comments) == old_comments_to_html(
+        STORY_ID, comments
+    )
+
+
+def test_renders_threads_deeper_than_the_recursion_limit():
+    depth = 3 * sys.getrecursionlimit()
+    root = comment(2, STORY_ID)
+    parent = root
+    for id in range(3, depth + 2):
+        reply = comment(id, parent["id"])
+        parent["children"].append(reply)
+        parent = reply
+
+    with pytest.raises(RecursionError):
+        old_comments_to_html(STORY_ID, [root])
+    html = core.comments_to_html(STORY_ID, [root])
+
+    assert html.count("<li>") == html.count("</li>") == depth
+    assert html.count("<ol>") == html.count("</ol>") == depth + 1
+    assert f"<div id={depth + 1} " in html
+    assert ".".join(["1"] * depth) in html
@@ -0,0 +1,152 @@
+"""
+Runs build jobs the way the server's runner does, against a stand-in for
+HN: identical requests share a job, a job interrupted halfway resumes where
+it stopped once it is queued again, and old builds are evicted.
+"""
+
+import os
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+from hn2ebook import db
+from hn2ebook import jobs
+from hn2ebook import store
+
+import offline
+
+PARAMS = {"story_ids": [1, 2, 3, 4, 5]}
+
+
+@pytest.fixture
+def cfg(tmp_path):
+    cfg = offline.config(tmp_path)["hn2ebook"]
+    db.migrate(cfg["db_path"])
+    return cfg
+
+
+@pytest.fixture
+def hn(monkeypatch):
+    return offline.FakeHN(monkeypatch)
+
+
+def claim(cfg):
+    return db.claim_build_job(db.connect(cfg["db_path"]), datetime.utcnow())
+
+
+def test_identical_concurrent_submits_share_one_job(cfg):
+    n = 8
+    barrier = threading.Barrier(n)
+    submitted = []
+
+    def submit(story_ids):
+        # every thread has its own connection, like the server's threads
+        conn = db.connect(cfg["db_path"])
+        barrier.wait()
+        submitted.append(jobs.submit(cfg, conn, {"story_ids": story_ids}))
+
+    # the same issue, requested with the story ids in different orders
+    orders = [PARAMS["story_ids"], list(reversed(PARAMS["story_ids"]))]
+    threads = [threading.Thread(target=submit, args=(orders[i % 2],)) for i in range(n)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(submitted) == n
+    assert len({job["id"] for job in submitted}) == 1
+    conn = db.connect(cfg["db_path"])
+    assert conn.execute("SELECT COUNT(*) FROM build_job").fetchone()[0] == 1
+
+
+def test_done_job_is_served_while_its_epub_is_there(cfg, hn):
+    conn = db.connect(cfg["db_path"])
+    job = jobs.submit(cfg, conn, PARAMS)
+    jobs.run_job(cfg, claim(cfg))
+    done = db.get_build_job(conn, job["id"])
+    assert done["status"] == "done"
+
+    assert jobs.submit(cfg, conn, PARAMS)["id"] == job["id"]
+    jobs.build_path(cfg, done["file_name"]).unlink()
+    again = jobs.submit(cfg, conn, PARAMS)
+    assert again["id"] != job["id"]
+    assert again["status"] == "queued"
+
+
+def test_requeued_job_resumes(cfg, hn):
+    conn = db.connect(cfg["db_path"])
+    job = jobs.submit(cfg, conn, PARAMS)
+
+    # the runner goes away while the chapter of story 3 is being built
+    hn.fail["chapter"] = "3"
+    with pytest.raises(RuntimeError):
+        jobs.build_issue(cfg, claim(cfg), lambda *args: None)
+    assert db.get_build_job(conn, job["id"])["status"] == "running"
+    [(record, left)] = store.unfinished_builds(cfg)
+    assert record["id"] == job["id"]
+    states = [left.state(str(i)) for i in PARAMS["story_ids"]]
+    assert states == ["chapter", "chapter", "comments", "comments", "comments"]
+
+    hn.reset()
+    assert db.requeue_build_jobs(conn, datetime.utcnow()) == 1
+    resumed = claim(cfg)
+    assert resumed["id"] == job["id"]
+    jobs.run_job(cfg, resumed)
+
+    done = db.get_build_job(conn, job["id"])
+    assert done["status"] == "done"
+    assert jobs.build_path(cfg, done["file_name"]).is_file()
+    # nothing was fetched again, only the missing chapters were built
+    assert hn.calls == {
+        "item": [],
+        "article": [],
+        "comments": [],
+        "chapter": ["3", "4", "5"],
+    }
+    assert list(store.unfinished_builds(cfg)) == []
+
+
+def test_evict_builds(cfg, hn):
+    conn = db.connect(cfg["db_path"])
+    old = datetime.utcnow() - timedelta(days=cfg["build_max_age_days"] + 1)
+
+    def finished(params, at):
+        job = jobs.submit(cfg, conn, params)
+        jobs.run_job(cfg, claim(cfg))
+        db.update_build_job(conn, job["id"], at, status="done")
+        return db.get_build_job(conn, job["id"])
+
+    expired = finished({"story_ids": [1]}, old)
+    recent = finished({"story_ids": [2]}, datetime.utcnow())
+    queued = jobs.submit(cfg, conn, {"story_ids": [3]})
+    leftover = jobs.build_path(cfg, ".interrupted.epub")
+    leftover.write_bytes(b"half an epub")
+    os.utime(leftover, (old.timestamp(), old.timestamp()))
+
+    assert jobs.evict_builds(cfg, conn) == 2
+
+    assert not jobs.build_path(cfg, expired["file_name"]).exists()
+    assert not leftover.exists()
+    assert db.get_build_job(conn, expired["id"]) is None
+    assert jobs.build_path(cfg, recent["file_name"]).is_file()
+    assert db.get_build_job(conn, recent["id"])["status"] == "done"
+    assert db.get_build_job(conn, queued["id"])["status"] == "queued"
+
+
+def test_evict_builds_keeps_epubs_of_remaining_jobs(cfg, hn):
+    conn = db.connect(cfg["db_path"])
+    old = datetime.utcnow() - timedelta(days=cfg["build_max_age_days"] + 1)
+    first = jobs.submit(cfg, conn, PARAMS)
+    jobs.run_job(cfg, claim(cfg))
+    db.update_build_job(conn, first["id"], old, status="done")
+    # the epub went missing and the issue was built again under the same name
+    file_name = db.get_build_job(conn, first["id"])["file_name"]
+    jobs.build_path(cfg, file_name).unlink()
+    second = jobs.submit(cfg, conn, PARAMS)
+    jobs.run_job(cfg, claim(cfg))
+    assert db.get_build_job(conn, second["id"])["file_name"] == file_name
+
+    assert jobs.evict_builds(cfg, conn) == 0
+    assert db.get_build_job(conn, first["id"]) is None
+    assert jobs.build_path(cfg, file_name).is_file()
@@ -0,0 +1,85 @@
+"""
+Checks that the feeds the server renders get validators derived from the
+database, so every server process answers conditional requests alike.
+"""
+
+from datetime import datetime
+
+import pytest
+
+from hn2ebook import commands
+from hn2ebook import core
+from hn2ebook import db
+from hn2ebook import opds
+
+
+def add_issue(conn, data_dir, n, at):
+    stories = [{"id": n, "title": f"story {n}"}]
+    meta = commands.issue_meta(
+        stories, {"period": "daily", "as_of": at}, commands.isoformat(at), f"uuid-{n}"
+    )
+    epub_path = data_dir.joinpath(f"hn2ebook-daily-{n}.epub")
+    epub_path.write_bytes(b"epub")
+    commands.persist_epub_meta(conn, at, stories, meta, str(epub_path), "daily")
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    db_path = str(tmp_path.joinpath("hn2ebook.sqlite"))
+    db.migrate(db_path)
+    conn = db.connect(db_path)
+    add_issue(conn, tmp_path, 1, datetime(2024, 1, 15, 1, 2, 3, 456))
+    cfg = {
+        "data_dir": tmp_path,
+        "db_path": db_path,
+        "root_url": "http://hn2ebook.test",
+        "instance_name": "test",
+        "opds_page_size": 10,
+    }
+    monkeypatch.setitem(core.app.config, "hn2ebook", cfg)
+    monkeypatch.setitem(core.app.config, "data_dir", tmp_path)
+    opds.rendered_pages.clear()
+    yield core.app.test_client(), conn
+    opds.rendered_pages.clear()
+
+
+@pytest.mark.parametrize("url", ["/index.xml", "/daily.xml"])
+def test_renders_of_the_same_state_share_validators(client, url):
+    client, _ = client
+    first = client.get(url, headers={"Accept-Encoding": "gzip"})
+    # another server process renders the page on its own
+    opds.rendered_pages.clear()
+    second = client.get(url, headers={"Accept-Encoding": "gzip"})
+
+    assert first.status_code == second.status_code == 200
+    assert first.headers["ETag"] == second.headers["ETag"]
+    assert first.headers["Last-Modified"] == "Mon, 15 Jan 2024 01:02:03 GMT"
+    assert first.headers["Last-Modified"] == second.headers["Last-Modified"]
+    assert first.data == second.data
+
+
+@pytest.mark.parametrize("url", ["/index.xml", "/daily.xml"])
+def test_conditional_requests_are_not_modified(client, url):
+    client, _ = client
+    response = client.get(url)
+    opds.rendered_pages.clear()
+
+    by_etag = client.get(url, headers={"If-None-Match": response.headers["ETag"]})
+    by_date = client.get(
+        url, headers={"If-Modified-Since": response.headers["Last-Modified"]}
+    )
+    assert by_etag.status_code == 304
+    assert by_date.status_code == 304
+
+
+def test_new_issue_changes_validators(client, tmp_path):
+    client, conn = client
+    response = client.get("/daily.xml")
+    add_issue(conn, tmp_path, 2, datetime(2024, 1, 16))
+
+    again = client.get(
+        "/daily.xml", headers={"If-None-Match": response.headers["ETag"]}
+    )
+    assert again.status_code == 200
+    assert again.headers["ETag"] != response.headers["ETag"]
+    assert again.headers["Last-Modified"] == "Tue, 16 Jan 2024 00:00:00 GMT"
@@ -0,0 +1,122 @@
+"""
+Checks that the queries behind listing issues, picking the best stories of a
+range and looking up the issues of stories search the indexes instead of
+scanning their tables, on a database holding years of issues.
+"""
+
+import json
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from hn2ebook import db
+
+YEARS = 5
+STORIES_PER_DAY = 30
+STORIES_PER_ISSUE = 10
+
+
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    db_path = str(tmp_path_factory.mktemp("db").joinpath("hn2ebook.sqlite"))
+    db.migrate(db_path)
+    conn = db.connect(db_path)
+    first_day = date(2021, 1, 1)
+    days = [first_day + timedelta(days=n) for n in range(365 * YEARS)]
+
+    best_stories, issues, formats, story_issues = [], [], [], []
+    for n, day in enumerate(days):
+        story_ids = [n * STORIES_PER_DAY + i for i in range(STORIES_PER_DAY)]
+        best_stories.extend((story_id, day) for story_id in story_ids)
+        periods = ["daily"] + (["weekly"] if day.weekday() == 0 else [])
+        for period in periods:
+            issue_id = len(issues) + 1
+            at = datetime.combine(day, datetime.min.time()).isoformat()
+            issues.append((issue_id, f"uuid-{issue_id}", at, period))
+            formats.append((issue_id, f"hn2ebook-{period}-{day}.epub"))
+            story_issues.extend(
+                (issue_id, story_id) for story_id in story_ids[:STORIES_PER_ISSUE]
+            )
+
+    conn.execute("BEGIN")
+    conn.executemany(
+        "INSERT INTO hn_best_story (story_id, day) VALUES (?, ?)", best_stories
+    )
+    conn.executemany(
+        "INSERT INTO issue (id, uuid, at, num_stories, meta, period) VALUES (?, ?, ?, 10, '{}', ?)",
+        issues,
+    )
+    conn.executemany(
+        "INSERT INTO issue_format (issue_id, file_name, file_size, mimetype) VALUES (?, ?, 1, 'application/epub+zip')",
+        formats,
+    )
+    conn.executemany(
+        "INSERT INTO story_issue (issue_id, story_id) VALUES (?, ?)", story_issues
+    )
+    conn.execute("COMMIT")
+    conn.execute("ANALYZE")
+    return conn
+
+
+def query_plans(conn, fn, *args):
+    """
+    Runs fn and returns the query plan of every statement it executed, as
+    the concatenated plan details.
+    """
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        fn(*args)
+    finally:
+        conn.set_trace_callback(None)
+    plans = []
+    for statement in statements:
+        if statement.split()[0].upper() not in ("SELECT", "DELETE"):
+            continue
+        rows = conn.execute(f"EXPLAIN QUERY PLAN {statement}").fetchall()
+        plans.append(" | ".join(row["detail"] for row in rows))
+    return plans
+
+
+def assert_searches(plan, table, index):
+    assert f"SEARCH {table} USING" in plan and index in plan, plan
+    assert f"SCAN {table}" not in plan.replace(f"SCAN {table} USING", ""), plan
+
+
+def test_best_stories_for_uses_day_index(conn):
+    [plan] = query_plans(
+        conn, db.best_stories_for, conn, date(2023, 3, 1), date(2023, 3, 8)
+    )
+    assert_searches(plan, "hn_best_story", "hn_best_story_day_index")
+
+
+def test_issue_listing_uses_period_at_index(conn):
+    first, formats = query_plans(conn, db.issues_page, conn, "daily", None, 25)
+    assert "issue_period_at_index" in first, first
+    assert "TEMP B-TREE" not in first, first
+    assert_searches(formats, "issue_format", "issue_format_issue_id_index")
+
+
+def test_issue_listing_cursor_uses_period_at_index(conn):
+    after = ("2023-06-01T00:00:00", 900)
+    first, _ = query_plans(conn, db.issues_page, conn, "weekly", after, 25)
+    assert_searches(first, "issue", "issue_period_at_index")
+    assert "TEMP B-TREE" not in first, first
+
+
+def test_daily_issue_files_uses_story_id_index(conn):
+    [plan] = query_plans(conn, db.daily_issue_files, conn, [30000, 30001, 30002])
+    assert_searches(plan, "si", "story_issue_story_id_index")
+
+
+def test_delete_issue_uses_issue_id_indexes(conn):
+    conn.execute("BEGIN")
+    try:
+        story_issue, issue_format, issue = query_plans(
+            conn, db.delete_issue, conn.cursor(), 1000
+        )
+    finally:
+        conn.execute("ROLLBACK")
+    assert_searches(story_issue, "story_issue", "story_issue_issue_id_index")
+    assert_searches(issue_format, "issue_format", "issue_format_issue_id_index")
+    assert_searches(issue, "issue", "INTEGER PRIMARY KEY")
@@ -0,0 +1,157 @@
+"""
+Fails builds at every step against a stand-in for HN and checks that the
+next build picks up from the checkpoints the failed one left: the chosen
+stories, the extracted articles, the resolved stories and the rendered
+chapters.
+"""
+
+from datetime import datetime, timedelta
+
+import click
+import pytest
+
+from hn2ebook import commands
+from hn2ebook import store
+from hn2ebook.store import StoryStore
+
+import offline
+
+STORY_IDS = ["1", "2", "3", "4", "5"]
+PARAMS = {"story_ids": STORY_IDS, "criteria": "points"}
+
+
+@pytest.fixture
+def ctx(tmp_path):
+    return offline.Context(offline.config(tmp_path))
+
+
+@pytest.fixture
+def cfg(ctx):
+    return ctx.cfg["hn2ebook"]
+
+
+@pytest.fixture
+def hn(monkeypatch):
+    return offline.FakeHN(monkeypatch)
+
+
+@pytest.fixture
+def output(tmp_path):
+    return str(tmp_path.joinpath("issue.epub"))
+
+
+def build(ctx, output, resume=None):
+    commands.new_custom_issue(ctx, STORY_IDS, output, "points", resume)
+
+
+def failed_build(ctx, output, hn, step, story_id):
+    hn.fail[step] = story_id
+    with pytest.raises(RuntimeError):
+        build(ctx, output)
+    hn.reset()
+    [(record, stories)] = store.unfinished_builds(ctx.cfg["hn2ebook"])
+    return record, stories
+
+
+def states(stories):
+    return [stories.state(story_id) for story_id in STORY_IDS]
+
+
+def test_story_states(tmp_path):
+    stories = StoryStore(tmp_path.joinpath("build"))
+    assert stories.state("1") == "summary"
+    stories.put_article("1", "<p>article</p>")
+    assert stories.state("1") == "article"
+    stories.put({"id": "1", "title": "story 1", "time": offline.EPOCH})
+    assert stories.state("1") == "comments"
+    stories.put_chapter(
+        {"story_id": "1", "title": "story 1", "parts": [], "images": []}
+    )
+    assert stories.state("1") == "chapter"
+    assert stories.get_article("1") == "<p>article</p>"
+
+
+def test_resume_after_the_comments_crawl_fails(ctx, cfg, hn, output):
+    record, stories = failed_build(ctx, output, hn, "comments", "3")
+    assert record["kind"] == "custom-issue"
+    assert [s["id"] for s in stories.chosen()] == STORY_IDS
+    assert states(stories) == ["comments", "comments", "article", "summary", "summary"]
+
+    build(ctx, output)
+
+    # the chosen stories are kept, only the stories left are fetched
+    assert hn.calls["item"] == ["3", "4", "5"]
+    assert hn.calls["article"] == ["4", "5"]
+    assert hn.calls["comments"] == ["3", "4", "5"]
+    assert hn.calls["chapter"] == STORY_IDS
+    assert list(store.unfinished_builds(cfg)) == []
+    assert not stories.path.exists()
+
+
+def test_resume_after_a_chapter_fails(ctx, cfg, hn, output):
+    _, stories = failed_build(ctx, output, hn, "chapter", "3")
+    assert states(stories) == ["chapter", "chapter", "comments", "comments", "comments"]
+
+    build(ctx, output)
+
+    assert hn.calls == {
+        "item": [],
+        "article": [],
+        "comments": [],
+        "chapter": ["3", "4", "5"],
+    }
+    assert list(store.unfinished_builds(cfg)) == []
+
+
+def test_resume_by_id(ctx, cfg, hn, output):
+    record, _ = failed_build(ctx, output, hn, "comments", "2")
+    build(ctx, output, resume=record["id"])
+    assert hn.calls["item"] == ["2", "3", "4", "5"]
+    assert list(store.unfinished_builds(cfg)) == []
+
+
+def test_resume_errors(ctx, cfg, hn, output):
+    record, stories = failed_build(ctx, output, hn, "comments", "2")
+
+    with pytest.raises(click.BadParameter, match="no unfinished build"):
+        build(ctx, output, resume="nope")
+    with pytest.raises(click.BadParameter, match="other parameters"):
+        commands.new_custom_issue(ctx, ["1"], output, "points", record["id"])
+
+    running = StoryStore.for_build(cfg, record["id"])
+    assert running.lock()
+    with pytest.raises(click.BadParameter, match="still running"):
+        build(ctx, output, resume=record["id"])
+    running.unlock()
+
+
+def test_running_build_is_not_resumed_twice(ctx, cfg, hn, output):
+    record, stories = failed_build(ctx, output, hn, "comments", "2")
+    assert stories.lock()
+
+    # another process with the same parameters starts a build of its own
+    other = commands.open_build(cfg, "custom-issue", PARAMS)
+    assert other.build_id != record["id"]
+    assert other.chosen() is None
+    other.remove()
+
+    stories.unlock()
+    resumed = commands.open_build(cfg, "custom-issue", PARAMS)
+    assert resumed.build_id == record["id"]
+    resumed.unlock()
+
+
+def test_expired_builds_are_removed(ctx, cfg, hn, output):
+    record, stories = failed_build(ctx, output, hn, "comments", "2")
+    created_at = datetime.utcnow() - timedelta(days=cfg["work_max_age_days"] + 1)
+    stories.write_record(dict(record, created_at=commands.isoformat(created_at)))
+
+    # a running build is left alone however old it is
+    assert stories.lock()
+    assert store.expire_builds(cfg, timedelta(days=cfg["work_max_age_days"])) == 0
+    stories.unlock()
+
+    build(ctx, output)
+    assert not stories.path.exists()
+    # the build started over
+    assert hn.calls["item"] == STORY_IDS + STORY_IDS
@@ -0,0 +1,123 @@
+"""
+Table tests for the cron specs of the daemon schedule.
+"""
+
+from datetime import datetime
+
+import pytest
+
+from hn2ebook import schedule
+
+
+def parsed(spec, field):
+    return sorted(schedule.parse_cron(spec)[field])
+
+
+@pytest.mark.parametrize(
+    "spec, field, values",
+    [
+        ("* * * * *", "minute", list(range(60))),
+        ("5 * * * *", "minute", [5]),
+        ("1,2,30 * * * *", "minute", [1, 2, 30]),
+        ("10-13 * * * *", "minute", [10, 11, 12, 13]),
+        ("*/15 * * * *", "minute", [0, 15, 30, 45]),
+        ("10-30/10 * * * *", "minute", [10, 20, 30]),
+        ("50/5 * * * *", "minute", [50, 55]),
+        ("0-5/2,58 * * * *", "minute", [0, 2, 4, 58]),
+        ("* */6 * * *", "hour", [0, 6, 12, 18]),
+        ("* * */10 * *", "day", [1, 11, 21, 31]),
+        ("* * * */4 *", "month", [1, 5, 9]),
+        ("* * * * *", "weekday", [0, 1, 2, 3, 4, 5, 6]),
+        ("* * * * 1-5", "weekday", [1, 2, 3, 4, 5]),
+        # 0 and 7 are both sunday
+        ("* * * * 7", "weekday", [0]),
+        ("* * * * 0,7", "weekday", [0]),
+        ("* * * * 5-7", "weekday", [0, 5, 6]),
+        ("* * * * */2", "weekday", [0, 2, 4, 6]),
+    ],
+)
+def test_parse_cron_fields(spec, field, values):
+    assert parsed(spec, field) == values
+
+
+@pytest.mark.parametrize(
+    "spec",
+    [
+        "",
+        "* * * *",
+        "* * * * * *",
+        "60 * * * *",
+        "* 24 * * *",
+        "* * 0 * *",
+        "* * 32 * *",
+        "* * * 0 *",
+        "* * * 13 *",
+        "* * * * 8",
+        "5-1 * * * *",
+        "*/0 * * * *",
+        "a * * * *",
+        "1- * * * *",
+        "1,,2 * * * *",
+    ],
+)
+def test_parse_cron_rejects(spec):
+    with pytest.raises(ValueError):
+        schedule.parse_cron(spec)
+
+
+@pytest.mark.parametrize(
+    "spec, any_day",
+    [
+        ("0 0 * * *", True),
+        ("0 0 1 * *", True),
+        ("0 0 * * 1", True),
+        ("0 0 */2 * 1", True),
+        ("0 0 1 * */2", True),
+        ("0 0 1 * 1", False),
+        ("0 0 1-7 * 1-5", False),
+    ],
+)
+def test_parse_cron_day_rule(spec, any_day):
+    assert schedule.parse_cron(spec)["any_day"] == any_day
+
+
+@pytest.mark.parametrize(
+    "spec, after, expected",
+    [
+        # strictly after, to the minute
+        ("*/30 * * * *", "2024-01-15 10:00:00", "2024-01-15 10:30"),
+        ("*/30 * * * *", "2024-01-15 10:00:59", "2024-01-15 10:30"),
+        ("*/30 * * * *", "2024-01-15 10:29:59", "2024-01-15 10:30"),
+        ("15 0 * * *", "2024-01-15 00:14:00", "2024-01-15 00:15"),
+        ("15 0 * * *", "2024-01-15 00:15:00", "2024-01-16 00:15"),
+        # the day, month and year roll over
+        ("15 0 * * *", "2024-01-31 23:59:00", "2024-02-01 00:15"),
+        ("15 0 * * *", "2024-12-31 12:00:00", "2025-01-01 00:15"),
+        ("45 0 1 * *", "2024-01-01 00:45:00", "2024-02-01 00:45"),
+        ("45 0 1 * *", "2024-12-15 00:00:00", "2025-01-01 00:45"),
+        ("0 12 31 * *", "2024-04-01 00:00:00", "2024-05-31 12:00"),
+        ("0 0 29 2 *", "2024-03-01 00:00:00", "2028-02-29 00:00"),
+        # 2024-01-15 is a monday
+        ("30 0 * * 1", "2024-01-15 00:30:00", "2024-01-22 00:30"),
+        ("0 9 * * 1-5", "2024-01-19 09:00:00", "2024-01-22 09:00"),
+        ("0 9 * * 0", "2024-01-15 00:00:00", "2024-01-21 09:00"),
+        ("0 9 * * 7", "2024-01-15 00:00:00", "2024-01-21 09:00"),
+        # restricted day of month and day of week: either one matches
+        ("0 0 20 * 3", "2024-01-15 00:00:00", "2024-01-17 00:00"),
+        ("0 0 16 * 3", "2024-01-15 00:00:00", "2024-01-16 00:00"),
+        # one of them unrestricted: both have to match
+        ("0 0 */2 * 1", "2024-01-15 00:00:00", "2024-01-29 00:00"),
+        ("0 0 1 * *", "2024-01-15 00:00:00", "2024-02-01 00:00"),
+        ("0 0 */2 * *", "2024-01-15 00:00:00", "2024-01-17 00:00"),
+    ],
+)
+def test_next_run(spec, after, expected):
+    cron = schedule.parse_cron(spec)
+    after = datetime.fromisoformat(after)
+    assert schedule.next_run(cron, after) == datetime.fromisoformat(expected)
+
+
+def test_next_run_never_matching():
+    cron = schedule.parse_cron("0 0 31 2 *")
+    with pytest.raises(ValueError):
+        schedule.next_run(cron, datetime(2024, 1, 1))
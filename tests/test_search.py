@@ -0,0 +1,125 @@
+"""
+Checks the full text index of stories: what gets indexed for a story, how
+matches rank, and that a story whose chapter is reused from the chapter
+cache is still indexed by its text.
+"""
+
+import pytest
+
+from hn2ebook import core
+from hn2ebook import db
+
+
+@pytest.fixture
+def conn(tmp_path):
+    db_path = str(tmp_path.joinpath("hn2ebook.sqlite"))
+    db.migrate(db_path)
+    return db.connect(db_path)
+
+
+def story(story_id, title, article=None, comments=None):
+    story = {"id": str(story_id), "title": title}
+    if article is not None:
+        story["article_text"] = article
+        story["comments_text"] = comments or ""
+    return story
+
+
+def add_issue(conn, n, at, story_ids):
+    issue = {"uuid": f"uuid-{n}", "at": at, "meta": {}, "num_stories": 1}
+    formats = [
+        {
+            "file_name": f"hn2ebook-daily-{n}.epub",
+            "file_size": 1,
+            "mimetype": "application/epub+zip",
+        }
+    ]
+    db.insert_issue(conn, issue, story_ids, formats, "daily")
+
+
+def test_index_stories_replaces_text(conn):
+    assert db.index_stories(conn, [story(1, "Rust", "about borrowing")]) == 1
+    assert db.index_stories(conn, [story(1, "Rust", "about lifetimes")]) == 1
+
+    assert db.search_stories(conn, "borrowing") == []
+    [hit] = db.search_stories(conn, "lifetimes")
+    assert hit["story_id"] == 1
+
+
+def test_index_stories_keeps_text_of_stories_without_it(conn):
+    db.index_stories(conn, [story(1, "Rust", "about borrowing", "a comment")])
+    # a later issue reusing the chapter without its text
+    assert db.index_stories(conn, [story(1, "Rust"), story(2, "Zig")]) == 1
+
+    assert [s["story_id"] for s in db.search_stories(conn, "comment")] == [1]
+    assert [s["story_id"] for s in db.search_stories(conn, "zig")] == [2]
+
+
+def test_search_stories_lists_their_issues(conn):
+    db.index_stories(conn, [story(1, "Rust"), story(2, "Zig")])
+    add_issue(conn, 1, "2024-01-15 00:00:00", [1, 2])
+    add_issue(conn, 2, "2024-01-16 00:00:00", [1])
+
+    [hit] = db.search_stories(conn, "rust")
+    assert hit["files"] == ["hn2ebook-daily-1.epub", "hn2ebook-daily-2.epub"]
+
+
+@pytest.mark.parametrize("text", ['"', "(", "rust OR", "-", "NEAR(", ""])
+def test_search_takes_no_query_syntax(conn, text):
+    db.index_stories(conn, [story(1, "Rust")])
+    assert db.search_stories(conn, text) == []
+    assert db.search_issues(conn, text) == []
+
+
+def test_search_issues_ranks_title_matches_first(conn):
+    db.index_stories(
+        conn,
+        [
+            story(1, "Compilers", "written about in the comments", "sqlite"),
+            story(2, "SQLite internals", "a database"),
+            story(3, "Databases", "sqlite is everywhere"),
+            story(4, "Unrelated", "nothing to see"),
+        ],
+    )
+    add_issue(conn, 1, "2024-01-15 00:00:00", [1])
+    add_issue(conn, 2, "2024-01-16 00:00:00", [2, 4])
+    add_issue(conn, 3, "2024-01-17 00:00:00", [3])
+    add_issue(conn, 4, "2024-01-18 00:00:00", [4])
+
+    issues = db.search_issues(conn, "sqlite")
+    assert [issue["uuid"] for issue in issues] == ["uuid-2", "uuid-3", "uuid-1"]
+    assert issues[0]["formats"][0]["file_name"] == "hn2ebook-daily-2.epub"
+
+
+def test_search_issues_lists_an_issue_once(conn):
+    db.index_stories(conn, [story(1, "SQLite"), story(2, "SQLite again")])
+    add_issue(conn, 1, "2024-01-15 00:00:00", [1, 2])
+    add_issue(conn, 2, "2024-01-16 00:00:00", [2])
+
+    issues = db.search_issues(conn, "sqlite")
+    assert sorted(issue["uuid"] for issue in issues) == ["uuid-1", "uuid-2"]
+
+
+def test_cached_chapters_keep_the_text_of_their_story(tmp_path, monkeypatch):
+    cfg = {"data_dir": tmp_path, "chapter_cache": True}
+    summary = {"id": "1", "title": "Rust", "num_comments": 2}
+    fetched = dict(summary, article_text="about borrowing", comments_text="nice")
+    monkeypatch.setattr(core, "story_to_data", lambda *args: dict(fetched))
+    monkeypatch.setattr(
+        core,
+        "build_chapter",
+        lambda cfg, story: {
+            "story_id": story["id"],
+            "title": story["title"],
+            "parts": [],
+            "images": [],
+        },
+    )
+
+    # a build that isn't persisted, such as one with --output, fills the cache
+    core.chapter_for_story(cfg, core.resolve_story(cfg, summary))
+    reused = core.resolve_story(cfg, summary)
+
+    assert "chapter_key" in reused
+    assert reused["article_text"] == "about borrowing"
+    assert reused["comments_text"] == "nice"
@@ -0,0 +1,66 @@
+"""
+Checks that the epub writer only ever leaves a complete epub at its output
+path.
+"""
+
+import zipfile
+from datetime import datetime
+
+import pytest
+
+from hn2ebook import commands
+from hn2ebook import writer
+
+META = commands.issue_meta(
+    [{"id": 1, "title": "story 1"}],
+    {"period": "daily", "as_of": datetime(2024, 1, 15)},
+    "2024-01-15T00:00:00Z",
+    "uuid-1",
+)
+
+CHAPTER = {
+    "story_id": "1",
+    "title": "story 1",
+    "parts": [
+        {"file_name": "story_1.xhtml", "label": "story 1", "content": "<p>hi</p>"}
+    ],
+    "images": [],
+}
+
+
+def write_epub(path, fail=False):
+    with writer.EpubWriter(path, META, "an issue", n_threads=2) as book:
+        book.add_chapter(CHAPTER)
+        if fail:
+            raise RuntimeError("the build failed")
+
+
+def test_writes_a_complete_epub(tmp_path):
+    path = tmp_path.joinpath("issue.epub")
+    write_epub(path)
+
+    with zipfile.ZipFile(path) as z:
+        assert z.testzip() is None
+        assert z.namelist()[0] == "mimetype"
+        assert "EPUB/story_1.xhtml" in z.namelist()
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def test_failed_build_leaves_no_file(tmp_path):
+    path = tmp_path.joinpath("issue.epub")
+    with pytest.raises(RuntimeError):
+        write_epub(path, fail=True)
+
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_failed_rebuild_keeps_the_previous_epub(tmp_path):
+    path = tmp_path.joinpath("issue.epub")
+    write_epub(path)
+    previous = path.read_bytes()
+
+    with pytest.raises(RuntimeError):
+        write_epub(path, fail=True)
+
+    assert path.read_bytes() == previous
+    assert list(tmp_path.iterdir()) == [path]